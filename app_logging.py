@@ -0,0 +1,134 @@
+"""
+Logging setup for the backend.
+
+Every subsystem logs through its own ``dump.<subsystem>`` logger. Records are
+handed to a background QueueListener, so request handlers never block on
+stdout. High-frequency events (voice frames, music polls) go through a
+SampledLogger, which drops all but one in N records before any formatting
+happens.
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+from typing import Optional
+
+import config
+
+ROOT_LOGGER = "dump"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Single-line ``time level logger message key=value`` output."""
+
+    def format(self, record):
+        line = "%s %-7s %s %s" % (
+            self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            record.levelname,
+            record.name,
+            record.getMessage(),
+        )
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+class SampledLogger:
+    """
+    Wraps a logger and lets through one in every ``rate`` calls.
+
+    The level check comes first, so a disabled call costs one cached
+    ``isEnabledFor`` lookup and nothing else.
+    """
+
+    def __init__(self, logger: logging.Logger, rate: int):
+        self.logger = logger
+        self.rate = max(1, int(rate))
+        self._counter = itertools.count()
+
+    def _sampled(self, level) -> bool:
+        return self.logger.isEnabledFor(level) and next(self._counter) % self.rate == 0
+
+    # stacklevel=2 so records point at the caller, not at this wrapper
+    def debug(self, msg, *args, **kwargs):
+        if self._sampled(logging.DEBUG):
+            self.logger.log(logging.DEBUG, msg, *args, stacklevel=2, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        if self._sampled(logging.INFO):
+            self.logger.log(logging.INFO, msg, *args, stacklevel=2, **kwargs)
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Return the logger for a subsystem, e.g. ``get_logger("voice")``."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def get_sampled_logger(subsystem: str, event: str) -> SampledLogger:
+    """Return a sampled logger using the rate configured for ``event``."""
+    rate = config.LOG_SAMPLE_RATES.get(event, 1)
+    return SampledLogger(get_logger(subsystem), rate)
+
+
+def setup_logging():
+    """
+    Install the queue handler on the ``dump`` logger tree.
+    Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    if config.LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = KeyValueFormatter()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(config.LOG_LEVEL.upper())
+    root.propagate = False
+
+    for subsystem, level in config.LOG_LEVELS.items():
+        get_logger(subsystem).setLevel(level.upper())
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,87 @@
+"""
+Async variants of the crud functions used by async endpoints.
+
+Reads run on the session from ``database.get_async_db``: an AsyncSession
+when aiosqlite is available, otherwise a sync session driven through the
+bounded ``run_sync`` pool. Writes are queued on the single writer, which
+never blocks the event loop either.
+"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, selectinload
+
+import crud
+import models
+import schemas
+from database import run_sync
+from db_writer import writer
+from message_ingest import message_ingestor
+
+async def _execute(db, statement):
+    if isinstance(db, Session):
+        return await run_sync(db.execute, statement)
+    return await db.execute(statement)
+
+async def _first(db, statement):
+    result = await _execute(db, statement)
+    return result.scalars().first()
+
+# Reads
+async def get_user_by_email(db, email: str) -> Optional[models.User]:
+    return await _first(db, select(models.User).where(models.User.email == email))
+
+async def get_channel(db, channel_id: int) -> Optional[models.Channel]:
+    return await _first(db, select(models.Channel).where(models.Channel.id == channel_id))
+
+async def get_message(db, message_id: int) -> Optional[models.Message]:
+    return await _first(
+        db,
+        select(models.Message)
+        .options(selectinload(models.Message.author), selectinload(models.Message.reaction_counts))
+        .where(models.Message.id == message_id)
+    )
+
+async def get_message_channel_id(db, message_id: int) -> Optional[int]:
+    return await _first(db, select(models.Message.channel_id).where(models.Message.id == message_id))
+
+async def get_server_by_invite_code(db, invite_code: str) -> Optional[models.Server]:
+    return await _first(
+        db,
+        select(models.Server)
+        .join(models.InviteCode, models.InviteCode.server_id == models.Server.id)
+        .where(
+            models.InviteCode.code == invite_code,
+            (models.InviteCode.expires_at.is_(None)) | (models.InviteCode.expires_at >= datetime.utcnow())
+        )
+    )
+
+async def is_user_server_member(db, user_id: int, server_id: int) -> bool:
+    member_id = await _first(
+        db,
+        select(models.ServerMember.id).where(
+            models.ServerMember.user_id == user_id,
+            models.ServerMember.server_id == server_id
+        ).limit(1)
+    )
+    return member_id is not None
+
+# Writes
+async def create_message(message: schemas.MessageCreate, author: models.User, channel_id: int) -> models.Message:
+    """Store a message through the group-commit ingestor; returned ready to serialize."""
+    return await message_ingestor.submit(message, author, channel_id)
+
+async def add_user_to_server(user_id: int, server_id: int, audit: Optional[dict] = None) -> models.ServerMember:
+    if audit is not None:
+        return await writer.run(crud.with_audit_log, crud.add_user_to_server, audit=audit, user_id=user_id, server_id=server_id)
+    return await writer.run(crud.add_user_to_server, user_id=user_id, server_id=server_id)
+
+async def create_audit_log(**kwargs) -> models.AuditLog:
+    return await writer.run(crud.create_audit_log, **kwargs)
+
+async def log_login_attempt(ip_address: str, success: bool) -> None:
+    await writer.run(crud.log_login_attempt, ip_address=ip_address, success=success)
+
+async def update_last_login(user_id: int) -> None:
+    await writer.run(crud.update_last_login, user_id=user_id)
@@ -0,0 +1,261 @@
+"""
+Several API calls in one round trip: ``POST /batch``.
+
+    {"requests": [{"method": "POST", "path": "/servers/1/channels/",
+                   "body": {"name": "general", "type": "text"}},
+                  {"path": "/servers/1/channels/"},
+                  {"method": "POST", "path": "/channels/7/messages",
+                   "form": {"content": "hi"}}],
+     "atomic": false}
+
+The sub-requests run in order against the existing routes, so they get the
+same validation, permission checks and response bodies as separate calls.
+They skip what a separate call pays for: the HTTP round trip, the middleware
+stack (the batch response as a whole is profiled and compressed), token
+decoding and the user lookup (the batch's caller is authenticated once), and
+setting up a database session (they all share one, see
+``database.shared_session``).
+
+The response lists ``{"status", "headers", "body"}`` per sub-request, in
+order; JSON bodies are spliced in as they were rendered. A failing
+sub-request doesn't stop the others.
+
+With ``"atomic": true`` the writes of all sub-requests form one transaction
+(``db_writer.transaction()``), and their reads see the earlier writes. The
+first sub-request with a 4xx/5xx status stops the batch and rolls everything
+back: the remaining ones are answered with 424 and ``committed`` is false.
+Async endpoints reading through the aiosqlite engine don't see uncommitted
+writes of the batch. While an atomic batch runs, other writes wait for it,
+so it may only contain reads and the quick database writes in
+``ATOMIC_WRITES`` (no password hashing, uploads or yt-dlp lookups), and it is
+rolled back once it has held the writer for ``BATCH_ATOMIC_TIMEOUT``
+seconds.
+"""
+import asyncio
+from contextlib import AsyncExitStack
+from urllib.parse import urlencode
+
+from fastapi import Request
+from starlette.middleware.exceptions import ExceptionMiddleware
+from starlette.routing import Match
+
+import auth
+import config
+import fast_json
+import models
+import schemas
+from database import SessionLocal, run_sync, shared_session
+from db_writer import writer
+from app_logging import get_logger
+
+logger = get_logger("batch")
+
+# Batch request headers a sub-request doesn't inherit; its own come from the item
+_OWN_HEADERS = {
+    b"content-length", b"content-type", b"transfer-encoding", b"accept-encoding",
+    b"if-none-match", b"if-match", b"if-modified-since",
+}
+# Response headers left out of the per-item headers
+_DROPPED_HEADERS = {"content-length", "content-encoding", "transfer-encoding", "vary"}
+
+_NOT_RUN = b'{"status":424,"headers":{},"body":{"detail":"Not run: another request in the batch failed"}}'
+
+# Write routes an atomic batch may call: each one only runs a short job on
+# the db writer. Anything slower would keep every other write waiting.
+ATOMIC_WRITES = frozenset({
+    ("PUT", "/users/me/"),
+    ("POST", "/servers/"),
+    ("PUT", "/servers/{server_id}"),
+    ("DELETE", "/servers/{server_id}"),
+    ("POST", "/servers/{server_id}/roles/"),
+    ("PUT", "/roles/{role_id}"),
+    ("DELETE", "/roles/{role_id}"),
+    ("POST", "/servers/{server_id}/channels/"),
+    ("PUT", "/channels/{channel_id}"),
+    ("DELETE", "/channels/{channel_id}"),
+    ("POST", "/channels/{channel_id}/messages"),
+    ("PUT", "/messages/{message_id}"),
+    ("DELETE", "/messages/{message_id}"),
+    ("POST", "/messages/{message_id}/reactions/{emoji}"),
+    ("DELETE", "/messages/{message_id}/reactions/{emoji}"),
+    ("POST", "/channels/{channel_id}/games/"),
+    ("POST", "/games/{game_id}/players/"),
+    ("PUT", "/games/{game_id}/players/{user_id}"),
+    ("PUT", "/music/{music_id}/status"),
+    ("DELETE", "/music/{music_id}"),
+    ("POST", "/servers/{server_id}/invite"),
+    ("POST", "/servers/join/{invite_code}"),
+    ("POST", "/servers/{server_id}/members"),
+    ("PUT", "/servers/{server_id}/members/{user_id}"),
+    ("DELETE", "/servers/{server_id}/members/{user_id}"),
+})
+
+_TIMED_OUT = b'{"status":504,"headers":{},"body":{"detail":"The atomic batch took too long and was rolled back"}}'
+
+class BatchDispatcher:
+    def __init__(self, app):
+        self.app = app
+        self._handler = None
+
+    @property
+    def handler(self):
+        # The router with the app's exception handlers (HTTPException -> JSON
+        # error body) but without its middleware; built on first use, once
+        # every route and handler is registered.
+        if self._handler is None:
+            self._handler = ExceptionMiddleware(self.app.router, handlers=self.app.exception_handlers)
+        return self._handler
+
+    async def run(self, request: Request, batch: schemas.BatchRequest, user: models.User) -> bytes:
+        """Run the sub-requests and return the JSON body of the batch response."""
+        token = auth.batch_user.set(user)
+        try:
+            if batch.atomic:
+                items, committed = await self._run_atomic(request, batch.requests)
+            else:
+                items, committed = await self._run_each(request, batch.requests), None
+        finally:
+            auth.batch_user.reset(token)
+        return (
+            b'{"responses":[' + b",".join(items) + b'],"committed":'
+            + fast_json.dumps(committed) + b"}"
+        )
+
+    async def _run_each(self, request: Request, requests: list) -> list:
+        db = SessionLocal()
+        try:
+            with shared_session(db):
+                items = []
+                for item in requests:
+                    status, body = await self._call(request, item)
+                    items.append(body)
+                    # End whatever the sub-request left open and forget what it
+                    # loaded, so the next one reads what has been committed since
+                    await run_sync(db.rollback)
+                return items
+        finally:
+            await run_sync(db.close)
+
+    async def _run_atomic(self, request: Request, requests: list) -> tuple:
+        refused = [self._refuse_atomic(item) for item in requests]
+        if any(refused):
+            # Checked up front, before the writer is held
+            return [body or _NOT_RUN for body in refused], False
+
+        items = []
+        async with writer.transaction() as transaction:
+            with shared_session(transaction.session):
+                try:
+                    await asyncio.wait_for(
+                        self._run_until_failure(request, requests, items, transaction), config.BATCH_ATOMIC_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning("Atomic batch of %s requests timed out, rolling back", len(requests))
+                    transaction.rollback = True
+                    items.append(_TIMED_OUT)
+        if transaction.rollback:
+            items += [_NOT_RUN] * (len(requests) - len(items))
+        return items, not transaction.rollback
+
+    async def _run_until_failure(self, request: Request, requests: list, items: list, transaction):
+        for item in requests:
+            status, body = await self._call(request, item)
+            items.append(body)
+            if status >= 400:
+                transaction.rollback = True
+                break
+
+    def _refuse_atomic(self, item: schemas.BatchItem) -> bytes:
+        """The error item for a sub-request an atomic batch can't run, or b"" if it can."""
+        if item.method == "GET":
+            return b""
+        scope = {"type": "http", "method": item.method, "path": item.path.partition("?")[0]}
+        for route in self.app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                if (item.method, route.path) in ATOMIC_WRITES:
+                    return b""
+                break
+        return _item(400, {}, b'{"detail":"Not allowed in an atomic batch"}')
+
+    async def _call(self, request: Request, item: schemas.BatchItem) -> tuple:
+        """(status, JSON of the item's response) for one sub-request."""
+        path, _, query = item.path.partition("?")
+        if path.rstrip("/") == "/batch":
+            return 400, _item(400, {}, b'{"detail":"Batches can\'t be nested"}')
+
+        headers = [(name, value) for name, value in request.headers.raw if name not in _OWN_HEADERS]
+        body = b""
+        if item.form is not None:
+            body = urlencode({name: str(value) for name, value in item.form.items()}).encode()
+            headers.append((b"content-type", b"application/x-www-form-urlencoded"))
+        elif item.body is not None:
+            body = fast_json.dumps(item.body)
+            headers.append((b"content-type", b"application/json"))
+        headers.append((b"content-length", str(len(body)).encode()))
+        headers += [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in item.headers.items()]
+
+        scope = {
+            "type": "http",
+            "asgi": request.scope.get("asgi", {"version": "3.0"}),
+            "http_version": request.scope.get("http_version", "1.1"),
+            "method": item.method,
+            "scheme": request.url.scheme,
+            "server": request.scope.get("server"),
+            "client": request.scope.get("client"),
+            "root_path": request.scope.get("root_path", ""),
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "headers": headers,
+            "app": self.app,
+            "state": dict(request.scope.get("state", {})),
+        }
+        received = False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Never disconnects: a streamed response runs to its end
+            await asyncio.Event().wait()
+
+        start, chunks = None, []
+
+        async def send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        try:
+            # FastAPI closes yield dependencies through this stack, which its
+            # middleware would otherwise provide
+            async with AsyncExitStack() as stack:
+                scope["fastapi_astack"] = stack
+                await self.handler(scope, receive, send)
+        except Exception:
+            logger.exception("Batch sub-request %s %s failed", item.method, path)
+            return 500, _item(500, {}, b'{"detail":"Internal Server Error"}')
+        if start is None:
+            return 500, _item(500, {}, b'{"detail":"No response"}')
+
+        response_headers = {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in start.get("headers", [])
+            if name.decode("latin-1") not in _DROPPED_HEADERS
+        }
+        content = b"".join(chunks)
+        if not content:
+            content = b"null"
+        elif not response_headers.get("content-type", "").startswith("application/json"):
+            content = fast_json.dumps(content.decode("utf-8", "replace"))
+        return start["status"], _item(start["status"], response_headers, content)
+
+def _item(status: int, headers: dict, body: bytes) -> bytes:
+    return (
+        b'{"status":' + str(status).encode() + b',"headers":' + fast_json.dumps(headers)
+        + b',"body":' + body + b"}"
+    )
@@ -0,0 +1,77 @@
+"""
+Cold import cost of the API module.
+
+Imports a module (``main`` by default) in fresh interpreters with
+``python -X importtime`` and prints the median wall time of the import, the
+slowest imports by cumulative time and the self time grouped per top-level
+package. Run it before and after adding a dependency to an eagerly imported
+module; anything only some endpoints need belongs in a function-level
+import.
+
+    python benchmarks/import_time.py [--module main] [--runs 5] [--top 25]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_once(module: str):
+    """Import ``module`` in a new interpreter; returns (wall seconds, importtime rows)."""
+    code = (
+        "import time; started = time.perf_counter(); "
+        f"import {module}; "
+        "print(time.perf_counter() - started)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return float(result.stdout.strip().splitlines()[-1]), rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    walls = []
+    samples = defaultdict(list)  # module -> [(self, cumulative)] across runs
+    for _ in range(args.runs):
+        wall, rows = import_once(args.module)
+        walls.append(wall)
+        for name, self_us, cumulative_us in rows:
+            samples[name].append((self_us, cumulative_us))
+
+    print(f"import {args.module}: median {statistics.median(walls) * 1000:.1f} ms "
+          f"over {args.runs} runs (min {min(walls) * 1000:.1f} ms)\n")
+
+    medians = {
+        name: (statistics.median(s for s, _ in values), statistics.median(c for _, c in values))
+        for name, values in samples.items()
+    }
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for name, (self_us, cumulative_us) in sorted(medians.items(), key=lambda item: -item[1][1])[:args.top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:8.1f}  {name}")
+
+    packages = defaultdict(float)
+    for name, (self_us, _) in medians.items():
+        packages[name.split(".")[0]] += self_us
+    print(f"\n{'self ms':>8}  top-level package")
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{self_us / 1000:8.1f}  {package}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Query plans and timings for the hot queries, before and after migrations.
+
+Builds a scratch database from models, drops the indexes the migrations add
+(what an existing pre-migration database looks like), seeds it, then prints
+EXPLAIN QUERY PLAN and the median time of each query before and after
+running migrations.run_migrations().
+
+    python benchmarks/query_plans.py [--rows 200000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, event, text  # noqa: E402
+
+import database  # noqa: E402
+import migrations  # noqa: E402
+import models  # noqa: E402
+
+QUERIES = {
+    "channel history": (
+        "SELECT id FROM messages WHERE channel_id = :channel ORDER BY created_at DESC LIMIT 50",
+        {"channel": 7},
+    ),
+    "membership check": (
+        "SELECT id FROM server_members WHERE server_id = :server AND user_id = :user LIMIT 1",
+        {"server": 3, "user": 42},
+    ),
+    "reaction lookup": (
+        "SELECT 1 FROM message_reactions WHERE message_id = :message AND user_id = :user AND emoji = :emoji",
+        {"message": 1234, "user": 5, "emoji": "+1"},
+    ),
+    "audit log page": (
+        "SELECT id FROM audit_logs WHERE server_id = :server ORDER BY created_at DESC LIMIT 100",
+        {"server": 3},
+    ),
+    "failed logins": (
+        "SELECT count(*) FROM login_history WHERE user_id = :user AND ip_address = :ip "
+        "AND success = 0 AND login_time >= :since",
+        {"user": 5, "ip": "10.0.0.5", "since": datetime(2024, 1, 1)},
+    ),
+    "channel media": (
+        "SELECT id FROM media WHERE channel_id = :channel ORDER BY created_at DESC LIMIT 100",
+        {"channel": 7},
+    ),
+    "music queue": (
+        "SELECT id FROM music_queues WHERE channel_id = :channel ORDER BY position",
+        {"channel": 7},
+    ),
+}
+
+
+def seed(conn, rows):
+    rng = random.Random(1)
+    start = datetime(2024, 1, 1)
+    conn.execute(
+        text("INSERT INTO messages (channel_id, author_id, content, created_at) VALUES (:c, :a, 'x', :t)"),
+        [{"c": rng.randrange(50), "a": rng.randrange(500), "t": start + timedelta(seconds=i)} for i in range(rows)],
+    )
+    conn.execute(
+        text("INSERT INTO server_members (server_id, user_id) VALUES (:s, :u)"),
+        [{"s": s, "u": u} for s in range(20) for u in range(rows // 200)],
+    )
+    conn.execute(
+        text("INSERT INTO message_reactions (message_id, user_id, emoji) VALUES (:m, :u, :e)"),
+        [{"m": rng.randrange(rows), "u": rng.randrange(500), "e": rng.choice(["+1", "heart", "smile"])}
+         for _ in range(rows)],
+    )
+    conn.execute(
+        text("INSERT INTO audit_logs (server_id, user_id, action, created_at) VALUES (:s, 1, 'x', :t)"),
+        [{"s": rng.randrange(20), "t": start + timedelta(seconds=i)} for i in range(rows // 2)],
+    )
+    conn.execute(
+        text("INSERT INTO login_history (user_id, ip_address, success, login_time) VALUES (:u, :ip, :ok, :t)"),
+        [{"u": rng.randrange(500), "ip": f"10.0.0.{rng.randrange(50)}", "ok": rng.random() > 0.2,
+          "t": start + timedelta(seconds=i)} for i in range(rows)],
+    )
+    conn.execute(
+        text("INSERT INTO media (channel_id, name, created_at) VALUES (:c, 'f', :t)"),
+        [{"c": rng.randrange(50), "t": start + timedelta(seconds=i)} for i in range(rows // 4)],
+    )
+    conn.execute(
+        text("INSERT INTO music_queues (channel_id, title, position) VALUES (:c, 't', :p)"),
+        [{"c": rng.randrange(50), "p": i} for i in range(rows // 4)],
+    )
+
+
+def measure(engine, label):
+    print(f"\n== {label}")
+    with engine.connect() as conn:
+        for name, (sql, params) in QUERIES.items():
+            plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql), params).fetchall()
+            timings = []
+            for _ in range(20):
+                started = time.perf_counter()
+                conn.execute(text(sql), params).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{name:18} {statistics.median(timings):8.3f} ms  " + " | ".join(row[-1] for row in plan))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        event.listen(engine, "connect", lambda conn, record: database.apply_sqlite_pragmas(conn))
+        models.Base.metadata.create_all(engine)
+
+        # Recreate the pre-migration schema: drop the composite indexes
+        with engine.begin() as conn:
+            for table in models.Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    if len(index.columns) > 1:
+                        conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            seed(conn, args.rows)
+            conn.execute(text("ANALYZE"))
+
+        measure(engine, "before migrations")
+        started = time.perf_counter()
+        migrations.run_migrations(engine)
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+        print(f"\nmigrations applied in {time.perf_counter() - started:.2f} s")
+        measure(engine, "after migrations")
+
+
+if __name__ == "__main__":
+    main()
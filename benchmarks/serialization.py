@@ -0,0 +1,150 @@
+"""
+Throughput of the list endpoints' serialization paths.
+
+Seeds a scratch database, then for each list endpoint loads a page and turns
+it into the response body, the three ways the API can:
+
+  response_model  ORM objects, FastAPI's validate + serialize, json module
+  + orjson        the same, encoded by fast_json.JSONResponse (orjson)
+  fast path       projected rows encoded directly, or for messages ORM
+                  objects through the precompiled TypeAdapter to bytes
+
+The query is part of every iteration, since projection saves ORM loading as
+well as serialization. Prints pages per second and the speedup of the fast
+path over response_model.
+
+    python benchmarks/serialization.py [--page 100] [--seconds 2]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+
+import crud  # noqa: E402
+import database  # noqa: E402
+import fast_json  # noqa: E402
+import models  # noqa: E402
+import schemas  # noqa: E402
+
+def seed(Session, page: int):
+    start = datetime(2024, 1, 1)
+    with Session() as db:
+        users = [
+            models.User(email=f"u{i}@example.com", username=f"user{i}", hashed_password="x",
+                        created_at=start, is_online=False)
+            for i in range(20)
+        ]
+        db.add_all(users)
+        db.flush()
+        server = models.Server(name="bench", owner_id=users[0].id, created_at=start, settings={})
+        db.add(server)
+        db.flush()
+        channel = models.Channel(name="general", type="text", server_id=server.id, position=0, created_at=start)
+        db.add(channel)
+        db.flush()
+        for i in range(page):
+            at = start + timedelta(seconds=i)
+            message = models.Message(content=f"message {i} with some text", author_id=users[i % 20].id,
+                                     channel_id=channel.id, created_at=at, media_type="text")
+            db.add(message)
+            db.flush()
+            db.add_all([models.MessageReactionCount(message_id=message.id, emoji=e, count=i % 5 + 1)
+                        for e in ("+1", "heart")])
+            db.add(models.AuditLog(server_id=server.id, user_id=users[0].id, action="update_channel",
+                                   target_type="channel", target_id=channel.id,
+                                   changes={"name": f"c{i}", "position": i}, created_at=at))
+            db.add(models.LoginHistory(user_id=users[0].id, ip_address="10.0.0.1", user_agent="Mozilla/5.0",
+                                       login_time=at, success=i % 7 != 0))
+            db.add(models.Media(url=f"/media/{i}.png", type=models.MediaType.IMAGE, name=f"{i}.png", size=1024 * i,
+                                uploaded_by_id=users[i % 20].id, channel_id=channel.id, created_at=at))
+        db.commit()
+        return server.id, channel.id, users[0].id
+
+def endpoints(server_id: int, channel_id: int, user_id: int, page: int):
+    """name -> (schema, load ORM objects, load projected rows or None)"""
+    return {
+        "read_messages": (
+            schemas.Message,
+            lambda db: crud.get_channel_messages(db, channel_id, limit=page),
+            None,
+        ),
+        "get_channel_media": (
+            schemas.Media,
+            lambda db: crud.get_channel_media(db, channel_id, 0, page),
+            lambda db: crud.get_channel_media(db, channel_id, 0, page,
+                                              columns=fast_json.project(schemas.Media, models.Media)),
+        ),
+        "read_audit_logs": (
+            schemas.AuditLog,
+            lambda db: crud.get_server_audit_logs(db, server_id, 0, page),
+            lambda db: crud.get_server_audit_logs(db, server_id, 0, page,
+                                                  columns=fast_json.project(schemas.AuditLog, models.AuditLog)),
+        ),
+        "read_login_history": (
+            schemas.LoginHistory,
+            lambda db: crud.get_login_history(db, user_id, 0, page),
+            lambda db: crud.get_login_history(db, user_id, 0, page,
+                                              columns=fast_json.project(schemas.LoginHistory, models.LoginHistory)),
+        ),
+    }
+
+async def rate(Session, build, seconds: float) -> float:
+    """Pages per second of ``build(db)``, each in a fresh session like a request."""
+    done = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        with Session() as db:
+            await build(db)
+        done += 1
+    return done / (time.perf_counter() - started)
+
+async def run(Session, ids, page: int, seconds: float):
+    print(f"{'endpoint':20} {'response_model':>15} {'+ orjson':>10} {'fast path':>10} {'speedup':>8}  (pages/s, {page} rows)")
+    for name, (schema, load, project) in endpoints(*ids, page).items():
+        field = create_response_field(name=f"Response_{name}", type_=List[schema])
+        serializer = fast_json.ListSerializer(schema)
+
+        async def response_model(db, response_class=JSONResponse):
+            content = await serialize_response(field=field, response_content=load(db), is_coroutine=True)
+            return response_class(content).body
+
+        async def with_orjson(db):
+            return await response_model(db, fast_json.JSONResponse)
+
+        async def fast_path(db):
+            return serializer.dump((project or load)(db))
+
+        with Session() as db:
+            assert await response_model(db) == await fast_path(db), f"{name}: bodies differ"
+        rates = [await rate(Session, build, seconds) for build in (response_model, with_orjson, fast_path)]
+        print(f"{name:20} {rates[0]:15.0f} {rates[1]:10.0f} {rates[2]:10.0f} {rates[2] / rates[0]:7.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--page", type=int, default=100, help="rows per page")
+    parser.add_argument("--seconds", type=float, default=2.0, help="per endpoint and path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        event.listen(engine, "connect", lambda conn, record: database.apply_sqlite_pragmas(conn))
+        models.Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine, expire_on_commit=False)
+        ids = seed(Session, args.page)
+        asyncio.run(run(Session, ids, args.page, args.seconds))
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Compare SQLite defaults against config.SQLITE_PRAGMAS.
+
+Runs a read-heavy (90% reads) and a write-heavy (80% writes) mix of
+message-table operations from several threads, each operation in its own
+transaction like a request would, and prints operations per second.
+
+    python benchmarks/sqlite_profile.py [--threads 8] [--ops 2000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+
+SCHEMA = """
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY,
+    content TEXT,
+    author_id INTEGER,
+    channel_id INTEGER,
+    created_at DATETIME
+);
+CREATE INDEX ix_messages_channel ON messages (channel_id, created_at);
+"""
+
+MIXES = {"read-heavy": 0.9, "write-heavy": 0.2}
+
+
+def connect(path, pragmas):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
+def seed(path, pragmas, rows=20000):
+    conn = connect(path, pragmas)
+    conn.executescript(SCHEMA)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO messages (content, author_id, channel_id, created_at) VALUES (?, ?, ?, datetime('now'))",
+        [(f"message {i}", i % 50, i % 20) for i in range(rows)],
+    )
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def worker(path, pragmas, read_ratio, ops, errors):
+    conn = connect(path, pragmas)
+    rng = random.Random()
+    for _ in range(ops):
+        try:
+            if rng.random() < read_ratio:
+                conn.execute(
+                    "SELECT id, content FROM messages WHERE channel_id = ? ORDER BY created_at DESC LIMIT 50",
+                    (rng.randrange(20),),
+                ).fetchall()
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "INSERT INTO messages (content, author_id, channel_id, created_at) VALUES (?, ?, ?, datetime('now'))",
+                    ("hello", rng.randrange(50), rng.randrange(20)),
+                )
+                conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            errors.append(1)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+    conn.close()
+
+
+def run(pragmas, read_ratio, threads, ops):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        seed(path, pragmas)
+        errors = []
+        pool = [
+            threading.Thread(target=worker, args=(path, pragmas, read_ratio, ops, errors))
+            for _ in range(threads)
+        ]
+        started = time.perf_counter()
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        elapsed = time.perf_counter() - started
+        return threads * ops / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    profiles = {
+        "default": {"busy_timeout": 5000},
+        "tuned": config.SQLITE_PRAGMAS,
+    }
+    print(f"sqlite {sqlite3.sqlite_version}, {args.threads} threads x {args.ops} ops")
+    for mix, read_ratio in MIXES.items():
+        for name, pragmas in profiles.items():
+            ops_per_sec, errors = run(pragmas, read_ratio, args.threads, args.ops)
+            print(f"{mix:12} {name:8} {ops_per_sec:10.0f} ops/s  lock errors: {errors}")
+
+
+if __name__ == "__main__":
+    main()
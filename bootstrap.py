@@ -0,0 +1,163 @@
+"""
+Everything a client needs on startup, in one streamed response.
+
+Opening the app used to take a waterfall of requests: the user, their
+servers, then per server its channels, roles and members, then the first
+message page. ``GET /bootstrap`` returns all of it as one JSON object:
+
+    {"user": {...},
+     "servers": [{...server, "channels": [...], "roles": [...],
+                  "members": {"total": n, "online": n, "items": [...]}}],
+     "voice_participants": {"<channel_id>": n},
+     "sync_cursor": seq,
+     "messages": {"channel_id": id, "next_cursor": ..., "prev_cursor": ...,
+                  "items": [...]} or null}
+
+The query count doesn't depend on the number of servers: one each for the
+servers, their channels, their roles and their members (ranked with window
+functions, ``BOOTSTRAP_MEMBERS_PER_SERVER`` per server, online first), plus
+at most two for the message page, which usually comes from the hot message
+cache, and one for ``sync_cursor``. That is the change feed position (see
+changes.py), read before anything else, so ``GET /sync?since=`` from it
+misses nothing the payload doesn't already have. Rows are projected to the
+response schemas' columns and encoded directly (see fast_json.py).
+
+The body is written as it is built: the user goes out first, then the
+servers once their four queries are done, then the message page. The
+compression middleware flushes every chunk, so a client can start parsing
+before the last query has run.
+"""
+from collections import defaultdict
+from typing import Dict, Iterator, Optional
+
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+import changes
+import config
+import crud
+import fast_json
+import models
+import pagination
+import schemas
+from database import ReadSessionLocal
+from message_cache import message_cache
+from permissions import authorize
+
+SERVER_LIST = fast_json.ListSerializer(schemas.Server)
+CHANNEL_LIST = fast_json.ListSerializer(schemas.Channel)
+ROLE_LIST = fast_json.ListSerializer(schemas.Role)
+MESSAGE_LIST = fast_json.ListSerializer(schemas.Message)
+SERVER_COLUMNS = fast_json.project(schemas.Server, models.Server)
+CHANNEL_COLUMNS = fast_json.project(schemas.Channel, models.Channel)
+ROLE_COLUMNS = fast_json.project(schemas.Role, models.Role)
+
+def _as_dicts(serializer: fast_json.ListSerializer, rows) -> list:
+    return [dict(zip(serializer.fields, row)) for row in rows]
+
+def load_servers(db: Session, user_id: int, members_per_server: int = config.BOOTSTRAP_MEMBERS_PER_SERVER) -> list:
+    """The user's servers with channels, roles and a member summary: four queries."""
+    servers = _as_dicts(SERVER_LIST, db.execute(
+        select(*SERVER_COLUMNS)
+        .join(models.ServerMember, models.ServerMember.server_id == models.Server.id)
+        .where(models.ServerMember.user_id == user_id)
+        .order_by(models.Server.id)
+    ).all())
+    if not servers:
+        return servers
+    server_ids = [server["id"] for server in servers]
+
+    channels = defaultdict(list)
+    for channel in _as_dicts(CHANNEL_LIST, db.execute(
+        select(*CHANNEL_COLUMNS)
+        .where(models.Channel.server_id.in_(server_ids))
+        .order_by(models.Channel.server_id, models.Channel.position, models.Channel.id)
+    ).all()):
+        channels[channel["server_id"]].append(channel)
+
+    roles = defaultdict(list)
+    for role in _as_dicts(ROLE_LIST, db.execute(
+        select(*ROLE_COLUMNS)
+        .where(models.Role.server_id.in_(server_ids))
+        .order_by(models.Role.server_id, models.Role.id)
+    ).all()):
+        roles[role["server_id"]].append(role)
+
+    members = {server_id: {"total": 0, "online": 0, "items": []} for server_id in server_ids}
+    per_server = models.ServerMember.server_id
+    ranked = select(
+        per_server,
+        models.User.id.label("user_id"),
+        models.User.username,
+        models.User.avatar,
+        models.User.is_online,
+        models.ServerMember.role_type,
+        models.ServerMember.role_id,
+        func.row_number().over(
+            partition_by=per_server,
+            order_by=(models.User.is_online.desc(), models.User.username)
+        ).label("rank"),
+        func.count().over(partition_by=per_server).label("total"),
+        func.sum(case((models.User.is_online, 1), else_=0)).over(partition_by=per_server).label("online"),
+    ).join(models.User, models.User.id == models.ServerMember.user_id)\
+        .where(per_server.in_(server_ids))\
+        .subquery()
+    for row in db.execute(select(ranked).where(ranked.c.rank <= members_per_server).order_by(ranked.c.server_id, ranked.c.rank)):
+        summary = members[row.server_id]
+        summary["total"], summary["online"] = row.total, row.online
+        summary["items"].append({
+            "user_id": row.user_id,
+            "username": row.username,
+            "avatar": row.avatar,
+            "is_online": bool(row.is_online),
+            "role_type": row.role_type,
+            "role_id": row.role_id,
+        })
+
+    for server in servers:
+        server["channels"] = channels[server["id"]]
+        server["roles"] = roles[server["id"]]
+        server["members"] = members[server["id"]]
+    return servers
+
+def newest_messages(db: Session, channel_id: int, limit: int) -> bytes:
+    """The newest message page with its cursors, from the cache or at most two queries."""
+    page = message_cache.get_newest(channel_id, limit)
+    if page is not None:
+        body, oldest, newest, count = page.body, page.oldest, page.newest, page.count
+    else:
+        generation = message_cache.generation(channel_id)
+        messages = crud.get_channel_messages(db=db, channel_id=channel_id, limit=max(limit, message_cache.per_channel))
+        message_cache.fill(channel_id, generation, messages)
+        messages = messages[-limit:]
+        body = MESSAGE_LIST.dump(messages)
+        count = len(messages)
+        oldest = pagination.message_key(messages[0]) if messages else None
+        newest = pagination.message_key(messages[-1]) if messages else None
+    older, newer = pagination.page_cursors(oldest, newest, count, limit)
+    header = fast_json.dumps({"channel_id": channel_id, "next_cursor": older, "prev_cursor": newer})
+    return header[:-1] + b',"items":' + body + b"}"
+
+def authorize_channel(user_id: int, channel_id: int):
+    """Raise 404/403 before streaming starts, while a status can still be sent."""
+    with ReadSessionLocal() as db:
+        authorize(db, user_id, channel_id=channel_id)
+
+def stream(user: models.User, channel_id: Optional[int], limit: int, voice_participants: Dict[int, int]) -> Iterator[bytes]:
+    """
+    The bootstrap document in chunks. ``channel_id`` must already be
+    authorized; ``voice_participants`` is a snapshot of channel -> count.
+    """
+    yield b'{"user":' + schemas.User.model_validate(user).model_dump_json().encode()
+    with ReadSessionLocal() as db:
+        cursor, _ = changes.positions(db)
+        servers = load_servers(db, user.id)
+        visible = {channel["id"] for server in servers for channel in server["channels"]}
+        voice = {str(cid): count for cid, count in voice_participants.items() if cid in visible}
+        yield (
+            b',"servers":' + fast_json.dumps(servers)
+            + b',"voice_participants":' + fast_json.dumps(voice)
+            + b',"sync_cursor":' + fast_json.dumps(cursor)
+        )
+        messages = newest_messages(db, channel_id, limit) if channel_id is not None else b"null"
+        yield b',"messages":' + messages + b"}"
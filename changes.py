@@ -0,0 +1,299 @@
+"""
+Change feed for delta sync.
+
+A client coming back from sleep used to refetch every server, channel, role
+and member list it had. Instead, every committed change to those rows (and
+every message edit or delete) is appended to ``change_log`` with a sequence
+number, and ``GET /sync?since=<seq>`` returns just what changed after the
+client's cursor:
+
+    {"cursor": seq, "has_more": bool, "reset": bool,
+     "servers": [...], "channels": [...], "roles": [...], "members": [...],
+     "messages": [...],
+     "deleted": {"servers": [id], "channels": [id], "roles": [id],
+                 "members": [{"server_id": id, "user_id": id}], "messages": [id]}}
+
+Entries are written by session flush hooks, in the same transaction as the
+change itself, so every crud mutator records its changes without knowing
+about the feed and a rolled back write leaves no entry. ``seq`` is an
+AUTOINCREMENT key handed out under SQLite's write lock, so seq order is
+commit order and a reader never sees a gap fill in behind its cursor. New
+messages aren't logged: they arrive over the websocket and through the
+message history cursors.
+
+An entry is visible to the members of its ``server_id`` at read time, or to
+its ``user_id`` alone (a user's own membership changes, and the per-member
+tombstones of a deleted server). Joining a server is sent as the server with
+all its channels and roles; leaving it, or its deletion, as a server
+tombstone. Several entries for one row fold into the latest, and upserts are
+answered with the row as it is now, so a page never has the same row twice.
+
+Compaction (run by the retention scheduler) drops entries superseded by a
+later one for the same row, and expires entries older than
+``SYNC_RETENTION_DAYS``. Expiry leaves a ``horizon`` marker at the newest
+expired seq; a client whose cursor is behind it gets ``reset: true`` and a
+fresh cursor, and reloads through ``/bootstrap``.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, delete, event, func, insert, or_, select
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+import config
+import fast_json
+import models
+import schemas
+
+UPSERT = "upsert"
+DELETE = "delete"
+HORIZON = "horizon"
+
+Entry = models.ChangeLogEntry
+
+# Recording: entries are inserted on the flushing connection
+_DELETED_SERVER_MEMBERS_KEY = "change_log_deleted_server_members"
+
+_insert_entries = insert(Entry.__table__).values(
+    # message entries only know their channel
+    server_id=func.coalesce(
+        bindparam("sid"),
+        select(models.Channel.server_id).where(models.Channel.id == bindparam("cid")).scalar_subquery()
+    )
+)
+
+def _entry(instance, op: str):
+    """(entity, entity_id, server_id, user_id, channel_id) params for a changed row, or None."""
+    if isinstance(instance, models.Server):
+        entity, server_id, user_id, channel_id = "server", instance.id, None, None
+    elif isinstance(instance, models.Channel):
+        entity, server_id, user_id, channel_id = "channel", instance.server_id, None, None
+    elif isinstance(instance, models.Role):
+        entity, server_id, user_id, channel_id = "role", instance.server_id, None, None
+    elif isinstance(instance, models.ServerMember):
+        if instance.server_id is None:  # detached from a deleted server, see below
+            return None
+        entity, server_id, user_id, channel_id = "member", instance.server_id, instance.user_id, None
+    elif isinstance(instance, models.Message):
+        entity, server_id, user_id, channel_id = "message", None, None, instance.channel_id
+    else:
+        return None
+    return {
+        "entity": entity, "entity_id": instance.id, "op": op,
+        "sid": server_id, "user_id": user_id, "cid": channel_id,
+    }
+
+@event.listens_for(Session, "before_flush")
+def _collect_deleted_server_members(session: Session, flush_context, instances):
+    # The flush detaches a deleted server's members, so look them up first:
+    # each of them gets a tombstone of their own
+    deleted = [instance.id for instance in session.deleted if isinstance(instance, models.Server)]
+    if deleted:
+        session.info.setdefault(_DELETED_SERVER_MEMBERS_KEY, []).extend(session.connection().execute(
+            select(models.ServerMember.server_id, models.ServerMember.user_id)
+            .where(models.ServerMember.server_id.in_(deleted))
+        ).all())
+
+@event.listens_for(Session, "after_flush")
+def _record_changes(session: Session, flush_context):
+    entries = []
+    for instance in session.new:
+        if not isinstance(instance, models.Message):
+            entries.append(_entry(instance, UPSERT))
+    for instance in session.dirty:
+        if session.is_modified(instance, include_collections=False):
+            entries.append(_entry(instance, UPSERT))
+    for instance in session.deleted:
+        entries.append(_entry(instance, DELETE))
+    for server_id, user_id in session.info.pop(_DELETED_SERVER_MEMBERS_KEY, ()):
+        entries.append({
+            "entity": "server", "entity_id": server_id, "op": DELETE,
+            "sid": None, "user_id": user_id, "cid": None,
+        })
+    entries = [entry for entry in entries if entry is not None]
+    if entries:
+        session.connection().execute(_insert_entries, entries)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_deleted_server_members(session: Session):
+    session.info.pop(_DELETED_SERVER_MEMBERS_KEY, None)
+
+# Reading
+SERVER_LIST = fast_json.ListSerializer(schemas.Server)
+CHANNEL_LIST = fast_json.ListSerializer(schemas.Channel)
+ROLE_LIST = fast_json.ListSerializer(schemas.Role)
+MESSAGE_LIST = fast_json.ListSerializer(schemas.Message)
+SERVER_COLUMNS = fast_json.project(schemas.Server, models.Server)
+CHANNEL_COLUMNS = fast_json.project(schemas.Channel, models.Channel)
+ROLE_COLUMNS = fast_json.project(schemas.Role, models.Role)
+
+def _as_dicts(serializer: fast_json.ListSerializer, rows) -> list:
+    return [dict(zip(serializer.fields, row)) for row in rows]
+
+def _page(cursor: int, has_more: bool = False, reset: bool = False) -> dict:
+    return {
+        "cursor": cursor, "has_more": has_more, "reset": reset,
+        "servers": [], "channels": [], "roles": [], "members": [], "messages": [],
+        "deleted": {"servers": [], "channels": [], "roles": [], "members": [], "messages": []},
+    }
+
+def positions(db: Session) -> tuple:
+    """(head, horizon): the newest seq and the newest compacted-away one."""
+    head, horizon = db.execute(select(
+        select(func.max(Entry.seq)).scalar_subquery(),
+        select(func.max(Entry.seq)).where(Entry.entity == HORIZON).scalar_subquery(),
+    )).one()
+    return head or 0, horizon or 0
+
+def read_changes(db: Session, user_id: int, since: int, limit: int = config.SYNC_PAGE_SIZE) -> dict:
+    """
+    One page of the user's changes after ``since``: at most ``limit`` entries,
+    folded to the current rows, in up to eight queries. The rows are read
+    after the entries and may be newer than the cursor; the entries in
+    between are sent again next time, which is harmless since applying an
+    upsert or tombstone twice changes nothing.
+    """
+    head, horizon = positions(db)
+    if since < horizon or since > head:
+        return _page(head, reset=True)
+
+    memberships = select(models.ServerMember.server_id).where(models.ServerMember.user_id == user_id)
+    entries = db.execute(
+        select(Entry.seq, Entry.entity, Entry.entity_id, Entry.op, Entry.server_id, Entry.user_id)
+        .where(Entry.seq > since, Entry.seq <= head, or_(Entry.server_id.in_(memberships), Entry.user_id == user_id))
+        .order_by(Entry.seq)
+        .limit(limit + 1)
+    ).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    page = _page(entries[-1].seq if has_more else head, has_more=has_more)
+
+    # Fold to the latest op per row. Members are keyed by (server, user) so a
+    # rejoin replaces the earlier leave; the user's own membership also stands
+    # for the server as a whole.
+    latest, member_ids, joined = {}, {}, set()
+    for entry in entries:
+        if entry.entity == "member":
+            key = ("member", (entry.server_id, entry.user_id))
+            member_ids[key[1]] = entry.entity_id
+            if entry.user_id == user_id:
+                latest[("server", entry.server_id)] = entry.op
+                if entry.op == UPSERT:
+                    joined.add(entry.server_id)
+                else:
+                    joined.discard(entry.server_id)
+        else:
+            key = (entry.entity, entry.entity_id)
+        latest[key] = entry.op
+    upserts = {"server": [], "channel": [], "role": [], "member": [], "message": []}
+    for (entity, entity_id), op in latest.items():
+        if op == UPSERT:
+            upserts[entity].append(entity_id)
+        elif entity == "member":
+            page["deleted"]["members"].append({"server_id": entity_id[0], "user_id": entity_id[1]})
+        else:
+            page["deleted"][entity + "s"].append(entity_id)
+    gone = set(page["deleted"]["servers"])
+
+    def load(entity: str, serializer, columns, model, **also):
+        """Current rows of the upserted ids (plus ``also`` matches); vanished ids become tombstones."""
+        ids = upserts[entity]
+        if not ids and not any(also.values()):
+            return []
+        conditions = [model.id.in_(ids)] + [getattr(model, name).in_(values) for name, values in also.items()]
+        rows = [
+            row for row in _as_dicts(serializer, db.execute(
+                select(*columns).where(or_(*conditions)).order_by(model.id)
+            ).all())
+            if row.get("server_id", row["id"]) not in gone
+        ]
+        found = {row["id"] for row in rows}
+        page["deleted"][entity + "s"].extend(entity_id for entity_id in ids if entity_id not in found)
+        return rows
+
+    page["servers"] = load("server", SERVER_LIST, SERVER_COLUMNS, models.Server, id=joined)
+    page["channels"] = load("channel", CHANNEL_LIST, CHANNEL_COLUMNS, models.Channel, server_id=joined)
+    page["roles"] = load("role", ROLE_LIST, ROLE_COLUMNS, models.Role, server_id=joined)
+
+    if upserts["member"]:
+        ids = {member_ids[key] for key in upserts["member"]}
+        upserts["member"] = set(upserts["member"])
+        found = set()
+        for row in db.execute(
+            select(
+                models.ServerMember.server_id,
+                models.ServerMember.user_id,
+                models.User.username,
+                models.User.avatar,
+                models.User.is_online,
+                models.ServerMember.role_type,
+                models.ServerMember.role_id,
+                models.ServerMember.joined_at,
+            ).join(models.User, models.User.id == models.ServerMember.user_id)
+            .where(models.ServerMember.id.in_(ids))
+            .order_by(models.ServerMember.server_id, models.ServerMember.user_id)
+        ):
+            key = (row.server_id, row.user_id)
+            # a deleted server's members keep their rows, detached from it
+            if key not in upserts["member"] or row.server_id in gone:
+                continue
+            found.add(key)
+            page["members"].append({**row._asdict(), "is_online": bool(row.is_online)})
+        page["deleted"]["members"].extend(
+            {"server_id": server_id, "user_id": member_user_id}
+            for server_id, member_user_id in upserts["member"]
+            if (server_id, member_user_id) not in found and server_id not in gone
+        )
+
+    if upserts["message"]:
+        messages = db.query(models.Message)\
+            .options(joinedload(models.Message.author), selectinload(models.Message.reaction_counts))\
+            .filter(models.Message.id.in_(upserts["message"]))\
+            .order_by(models.Message.id).all()
+        adapter = MESSAGE_LIST.adapter
+        page["messages"] = adapter.dump_python(adapter.validate_python(messages, from_attributes=True), mode="json")
+        found = {message.id for message in messages}
+        page["deleted"]["messages"].extend(message_id for message_id in upserts["message"] if message_id not in found)
+    return page
+
+# Compaction jobs, run on the db writer (see maintenance.py)
+def drop_superseded(db: Session, limit: int) -> int:
+    """Delete up to ``limit`` entries that have a later entry for the same row."""
+    later = Entry.__table__.alias("later")
+    superseded = select(Entry.seq).where(
+        select(later.c.seq).where(
+            later.c.entity == Entry.entity,
+            later.c.entity_id == Entry.entity_id,
+            # SQLite reuses the ids of deleted rows; the same id in another
+            # server is another row
+            later.c.server_id.is_(Entry.server_id),
+            later.c.user_id.is_(Entry.user_id),
+            later.c.seq > Entry.seq,
+        ).exists(),
+        Entry.entity != HORIZON,
+    ).limit(limit)
+    result = db.execute(delete(Entry).where(Entry.seq.in_(superseded.scalar_subquery())))
+    db.commit()
+    return result.rowcount
+
+def expire(db: Session, cutoff: datetime, limit: int) -> int:
+    """
+    Delete up to ``limit`` of the oldest entries from before ``cutoff`` and
+    move the horizon marker up to the newest of them.
+    """
+    expired = db.execute(
+        select(Entry.seq)
+        .where(Entry.created_at < cutoff, Entry.entity != HORIZON)
+        .order_by(Entry.seq)
+        .limit(limit)
+    ).scalars().all()
+    if not expired:
+        return 0
+    db.execute(delete(Entry).where(Entry.seq.in_(expired)))
+    # The marker takes over the freed seq; older markers are dropped
+    db.execute(delete(Entry).where(Entry.entity == HORIZON, Entry.seq < expired[-1]))
+    db.execute(insert(Entry).values(seq=expired[-1], entity=HORIZON, entity_id=0, op=DELETE))
+    db.commit()
+    return len(expired)
+
+def expiry_cutoff(days: int = config.SYNC_RETENTION_DAYS) -> datetime:
+    return datetime.utcnow() - timedelta(days=days)
@@ -0,0 +1,236 @@
+"""
+Response compression.
+
+Message pages, member lists and audit logs are repetitive JSON that shrinks
+5-10x. The middleware here picks the best encoding the client accepts
+(``Accept-Encoding`` q-values, ties broken by ``COMPRESSION_ENCODINGS``
+order): zstd and brotli when the ``zstandard`` / ``brotli`` packages are
+installed, gzip always.
+
+Only compressible types (``COMPRESSIBLE_CONTENT_TYPES``) of at least
+``COMPRESSION_MIN_SIZE`` bytes are compressed. Responses that already have a
+``Content-Encoding``, ask for ``no-transform``, or live under an excluded
+prefix (the ``/media`` mount serves files that are compressed already) pass
+through untouched. A complete body is compressed in one go and sent as is
+if that didn't make it smaller. Streamed bodies are compressed chunk by
+chunk, each chunk flushed so the client can decode it as it arrives.
+
+zlib, brotli and zstd release the GIL, so bodies and chunks over
+``COMPRESSION_OFFLOAD_SIZE`` are compressed on a small thread pool instead
+of blocking the event loop. A compressed response's ETag becomes weak (the
+bytes differ per encoding); ``If-None-Match`` compares weakly, so the tag
+still revalidates.
+"""
+import asyncio
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AVAILABLE_ENCODINGS = tuple(
+    encoding for encoding in config.COMPRESSION_ENCODINGS
+    if encoding == "gzip"
+    or (encoding == "br" and brotli is not None)
+    or (encoding == "zstd" and zstandard is not None)
+)
+
+_executor = ThreadPoolExecutor(max_workers=config.COMPRESSION_THREADS, thread_name_prefix="compress")
+
+def choose_encoding(accept_encoding: str, available=AVAILABLE_ENCODINGS) -> Optional[str]:
+    """The available encoding with the highest q-value, or None (identity)."""
+    offered = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        offered[name] = quality
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = offered.get(encoding, offered.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+class Encoder:
+    """Incremental compressor for one response body."""
+
+    def __init__(self, encoding: str, level: int = None):
+        self.encoding = encoding
+        if level is None:
+            level = config.COMPRESSION_LEVELS[encoding]
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def compress(self, data: bytes, final: bool = True) -> bytes:
+        """Compress ``data``; non-final chunks are flushed so they decode on arrival."""
+        c = self._compressor
+        if self.encoding == "gzip":
+            return c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return c.process(data) + (c.finish() if final else c.flush())
+        return c.compress(data) + c.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+class CompressionStats:
+    def __init__(self):
+        self._totals: dict = {}
+        self._lock = threading.Lock()
+
+    def add(self, encoding: str, raw: int, compressed: int, streamed: bool):
+        with self._lock:
+            totals = self._totals.setdefault(
+                encoding, {"responses": 0, "streamed": 0, "bytes_in": 0, "bytes_out": 0}
+            )
+            totals["responses"] += not streamed
+            totals["streamed"] += streamed
+            totals["bytes_in"] += raw
+            totals["bytes_out"] += compressed
+
+    def report(self) -> dict:
+        with self._lock:
+            report = {encoding: dict(totals) for encoding, totals in self._totals.items()}
+        for totals in report.values():
+            if totals["bytes_out"]:
+                totals["ratio"] = round(totals["bytes_in"] / totals["bytes_out"], 2)
+        return {"available": list(AVAILABLE_ENCODINGS), "encodings": report}
+
+stats = CompressionStats()
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app,
+        minimum_size: int = config.COMPRESSION_MIN_SIZE,
+        offload_size: int = config.COMPRESSION_OFFLOAD_SIZE,
+        excluded_prefixes: tuple = config.COMPRESSION_EXCLUDED_PREFIXES,
+        content_types: tuple = config.COMPRESSIBLE_CONTENT_TYPES
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.excluded_prefixes = tuple(excluded_prefixes)
+        self.content_types = tuple(content_types)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.excluded_prefixes):
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(self, send, encoding))
+
+    def compressible(self, start: dict, body: bytes, more_body: bool) -> bool:
+        if start["status"] < 200 or start["status"] in (204, 304):
+            return False
+        headers = Headers(raw=start.get("headers", []))
+        if "content-encoding" in headers or "no-transform" in headers.get("cache-control", ""):
+            return False
+        if not headers.get("content-type", "").startswith(self.content_types):
+            return False
+        if more_body:
+            length = headers.get("content-length")
+            return length is None or int(length) >= self.minimum_size
+        return len(body) >= self.minimum_size
+
+    async def compress(self, encoder: Encoder, data: bytes, final: bool) -> bytes:
+        if len(data) < self.offload_size:
+            return encoder.compress(data, final)
+        return await asyncio.get_running_loop().run_in_executor(_executor, encoder.compress, data, final)
+
+class _CompressingSend:
+    """The ``send`` of one response: holds the start message until the first body chunk."""
+
+    def __init__(self, middleware: CompressionMiddleware, send, encoding: str):
+        self.middleware = middleware
+        self.send = send
+        self.encoding = encoding
+        self.start = None
+        self.encoder = None
+        self.passthrough = False
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.encoder is None:
+            if not self.middleware.compressible(self.start, body, more_body):
+                await self._pass_through(message)
+                return
+            self.encoder = Encoder(self.encoding)
+            if not more_body:
+                compressed = await self.middleware.compress(self.encoder, body, True)
+                if len(compressed) >= len(body):
+                    await self._pass_through(message)
+                    return
+                self._set_headers(len(compressed))
+                await self.send(self.start)
+                await self.send({"type": "http.response.body", "body": compressed})
+                stats.add(self.encoding, len(body), len(compressed), streamed=False)
+                return
+            self._set_headers(None)
+            await self.send(self.start)
+
+        compressed = await self.middleware.compress(self.encoder, body, not more_body)
+        self.raw_bytes += len(body)
+        self.compressed_bytes += len(compressed)
+        if compressed or not more_body:
+            await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        if not more_body:
+            stats.add(self.encoding, self.raw_bytes, self.compressed_bytes, streamed=True)
+
+    async def _pass_through(self, message):
+        self.passthrough = True
+        await self.send(self.start)
+        await self.send(message)
+
+    def _set_headers(self, length: Optional[int]):
+        headers = MutableHeaders(scope=self.start)
+        headers["content-encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if length is None:
+            del headers["content-length"]
+        else:
+            headers["content-length"] = str(length)
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["etag"] = "W/" + etag
@@ -1,45 +1,178 @@
-# Server configuration
-SERVER_IP = "0.0.0.0"  # Network IP address
-SERVER_PORT = 8000
-
-# Database configuration
-import os
-DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
-os.makedirs(DB_DIR, exist_ok=True)
-DATABASE_URL = f"sqlite:///{os.path.join(DB_DIR, 'dump.db')}"
-
-# JWT Configuration
-SECRET_KEY = "hui228"  # Match with main.py and auth.py
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-# Media configuration
-UPLOAD_DIR = "uploads"
-MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
-ALLOWED_EXTENSIONS = {
-    "image": ["jpg", "jpeg", "png", "gif"],
-    "video": ["mp4", "webm", "mov"],
-    "audio": ["mp3", "wav", "ogg"],
-    "document": ["pdf", "doc", "docx", "txt"]
-}
-
-# Game configuration
-MAX_PLAYERS_PER_GAME = 10
-GAME_TYPES = ["CHESS", "TIC_TAC_TOE", "HANGMAN", "QUIZ"]
-
-# Music configuration
-MAX_QUEUE_SIZE = 50
-SUPPORTED_AUDIO_FORMATS = ["mp3", "wav", "ogg"]
-
-# CORS configuration
-CORS_ORIGINS = [
-    "http://localhost:3000",  # React development server
-    "http://127.0.0.1:3000",
-    "http://localhost:8000",  # API server
-    "ws://localhost:8000",    # WebSocket
-    "wss://localhost:8000",   # Secure WebSocket
-    f"http://{SERVER_IP}:3000",  # Network React server
-    f"http://{SERVER_IP}:8000",  # Network API server
-    f"ws://{SERVER_IP}:8000",    # Network WebSocket
-    f"wss://{SERVER_IP}:8000"    # Network Secure WebSocket
+# Server configuration
+SERVER_IP = "0.0.0.0"  # Network IP address
+SERVER_PORT = 8000
+
+# Database configuration
+import os
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+os.makedirs(DB_DIR, exist_ok=True)
+DATABASE_URL = os.getenv("DUMP_DATABASE_URL", f"sqlite:///{os.path.join(DB_DIR, 'dump.db')}")  # tests use a scratch file
+DB_POOL_SIZE = 8  # SQLite-соединения дешёвые, но PRAGMA применяются на каждое новое
+
+# SQLite tuning, applied to every new connection (see database.py).
+# Benchmark numbers for these settings are in README.md.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block the writer and vice versa
+    "synchronous": "NORMAL",  # fsync on checkpoint, not on every commit (safe with WAL)
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative = KiB, i.e. 64 MiB page cache per connection
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,  # ms to wait for a lock instead of failing with "database is locked"
+}
+
+# Write serialization: all queued writes go through one connection and are
+# committed in groups (see db_writer.py); reads use a read-only pool.
+DB_SINGLE_WRITER = True
+DB_WRITER_MAX_BATCH = 64  # max jobs committed in one transaction
+DB_READ_POOL_SIZE = 8
+
+# Async endpoints read through an aiosqlite engine; remaining blocking calls
+# run on a bounded thread pool instead of the event loop.
+DB_ASYNC_ENABLED = True
+DB_THREADPOOL_SIZE = 16
+# Raise if a synchronous query runs on the event loop thread (dev/tests)
+DB_LOOP_GUARD = os.getenv("DUMP_DB_LOOP_GUARD") == "1"
+# Strict loading (dev/tests): lazy relationship loads raise instead of
+# silently issuing one query per row, and list endpoints that exceed their
+# query budget fail instead of logging a warning.
+DB_STRICT_LOADING = os.getenv("DUMP_DB_STRICT") == "1"
+
+# New messages are gathered this long and inserted in one transaction
+# (see message_ingest.py)
+MESSAGE_INGEST_LINGER_MS = 3
+MESSAGE_INGEST_MAX_BATCH = 256
+
+# Hot message cache: the newest messages of recently read channels, already
+# serialized (see message_cache.py)
+MESSAGE_CACHE_ENABLED = True
+MESSAGE_CACHE_PER_CHANNEL = 100  # ring buffer length, also the max page size
+MESSAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # LRU eviction across channels past this
+
+# Cached (server, user) -> permission bitmask entries (see permissions.py)
+PERMISSION_CACHE_SIZE = 50000
+
+# List endpoints serialize pages with precompiled TypeAdapters straight to
+# JSON bytes instead of going through response_model (see fast_json.py)
+FAST_JSON_ENABLED = True
+
+# Response compression (see compression.py). zstd and br are used when the
+# zstandard / brotli packages are installed, in this order of preference.
+COMPRESSION_ENABLED = True
+COMPRESSION_ENCODINGS = ("zstd", "br", "gzip")
+COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+COMPRESSION_MIN_SIZE = 1024  # bytes; smaller bodies go out as they are
+COMPRESSION_OFFLOAD_SIZE = 64 * 1024  # larger bodies/chunks compress on a worker thread
+COMPRESSION_THREADS = 4
+COMPRESSION_EXCLUDED_PREFIXES = ("/media",)  # uploads are images/video/audio already
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "text/", "application/javascript", "application/xml", "image/svg+xml")
+
+# Cache-Control per conditional GET route (see etags.py). "no-cache" lets the
+# client keep its copy but revalidate it with If-None-Match on every use.
+CACHE_CONTROL = {
+    "server_list": "private, no-cache",
+    "server": "private, no-cache",
+    "channels": "private, no-cache",
+    "roles": "private, no-cache",
+}
+
+# Threads: deepest reply level returned by GET /messages/{id}/thread
+THREAD_MAX_DEPTH = 50
+
+# GET /bootstrap: members listed per server (online first); totals are exact
+BOOTSTRAP_MEMBERS_PER_SERVER = 100
+
+# GET /sync: change feed entries per response, and how long entries are kept
+# (see changes.py). Clients whose cursor is older get a reset.
+SYNC_PAGE_SIZE = 500
+SYNC_RETENTION_DAYS = 30
+
+# POST /batch: sub-requests per call (see batch.py). An atomic batch holds the
+# writer for its whole run and is rolled back after BATCH_ATOMIC_TIMEOUT seconds.
+BATCH_MAX_REQUESTS = 20
+BATCH_ATOMIC_TIMEOUT = 5.0
+
+# Realtime events over /ws (see realtime.py): events queued per connection.
+# A client that falls further behind is disconnected and resyncs via GET /sync.
+REALTIME_QUEUE_SIZE = 256
+
+# Message search (see search.py)
+SEARCH_PAGE_SIZE = 25
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_SNIPPET_MARKERS = ("<mark>", "</mark>")
+SEARCH_SNIPPET_TOKENS = 16  # words of context around the match
+
+# Retention for append-only log tables (see maintenance.py). Rows older than
+# ``days`` are deleted in batches; ``archive`` first copies them to gzip JSONL
+# segments under RETENTION_ARCHIVE_DIR.
+RETENTION_ENABLED = True
+RETENTION_POLICIES = {
+    "login_history": {"days": 90, "archive": False},
+    "audit_logs": {"days": 365, "archive": True},
+}
+RETENTION_INTERVAL_SECONDS = 6 * 60 * 60
+RETENTION_BATCH_SIZE = 500  # rows per write transaction
+RETENTION_BATCH_PAUSE_MS = 50  # gives queued writes a turn between batches
+RETENTION_ARCHIVE_DIR = os.path.join(DB_DIR, "archive")
+RETENTION_VACUUM_PAGES = 2000  # pages returned to the OS per run, 0 disables
+
+# SQL profiling (see sql_profiler.py): one in N requests gets its statements
+# timed, a Server-Timing header and slow statements logged with their plan.
+# 0 disables sampling; DUMP_SQL_PROFILE=1 profiles every request.
+SQL_PROFILE_ENABLED = True
+SQL_PROFILE_SAMPLE_EVERY = 1 if os.getenv("DUMP_SQL_PROFILE") == "1" else 50
+SQL_PROFILE_KEEP_SLOWEST = 3  # statements per request kept for the debug log
+SQL_SLOW_QUERY_MS = 100
+SQL_SLOW_LOG_SIZE = 200
+
+# Emails of the users allowed to read GET /stats/* (statement text, request
+# paths, cache and connection counters). Comma separated; empty = nobody.
+STATS_USERS = {email.strip() for email in os.getenv("DUMP_STATS_USERS", "").split(",") if email.strip()}
+
+# Logging configuration
+LOG_LEVEL = os.getenv("DUMP_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("DUMP_LOG_FORMAT", "text")  # text или json
+# Per-subsystem overrides, e.g. {"voice": "DEBUG"}
+LOG_LEVELS = {
+    "db": "WARNING",
+}
+# Only one in N records of these high-frequency events is emitted
+LOG_SAMPLE_RATES = {
+    "voice.frames": 200,
+    "music.poll": 50,
+}
+
+# JWT Configuration
+SECRET_KEY = "hui228"  # Match with main.py and auth.py
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# Media configuration
+UPLOAD_DIR = "uploads"
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+ALLOWED_EXTENSIONS = {
+    "image": ["jpg", "jpeg", "png", "gif"],
+    "video": ["mp4", "webm", "mov"],
+    "audio": ["mp3", "wav", "ogg"],
+    "document": ["pdf", "doc", "docx", "txt"]
+}
+
+# Game configuration
+MAX_PLAYERS_PER_GAME = 10
+GAME_TYPES = ["CHESS", "TIC_TAC_TOE", "HANGMAN", "QUIZ"]
+
+# Music configuration
+MAX_QUEUE_SIZE = 50
+SUPPORTED_AUDIO_FORMATS = ["mp3", "wav", "ogg"]
+
+# CORS configuration
+CORS_ORIGINS = [
+    "http://localhost:3000",  # React development server
+    "http://127.0.0.1:3000",
+    "http://localhost:8000",  # API server
+    "ws://localhost:8000",    # WebSocket
+    "wss://localhost:8000",   # Secure WebSocket
+    f"http://{SERVER_IP}:3000",  # Network React server
+    f"http://{SERVER_IP}:8000",  # Network API server
+    f"ws://{SERVER_IP}:8000",    # Network WebSocket
+    f"wss://{SERVER_IP}:8000"    # Network Secure WebSocket
 ] 
\ No newline at end of file
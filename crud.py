@@ -1,564 +1,830 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
-from datetime import datetime, timedelta
-import models, schemas
-from typing import List, Optional, Dict, Any
-from fastapi import HTTPException
-import secrets
-
-# User operations
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
-
-def get_user_by_email(db: Session, email: str):
-    print(f"Looking up user with email: {email}")
-    user = db.query(models.User).filter(models.User.email == email).first()
-    print(f"User found: {user is not None}")
-    if user:
-        print(f"User details: id={user.id}, username={user.username}, is_active={user.is_active}")
-    return user
-
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
-
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
-
-def create_user(db: Session, user: schemas.UserCreate):
-    from auth import get_password_hash  # import inside function to avoid circular dependency
-    
-    print(f"Creating user with email: {user.email}")
-    print(f"Password: {user.password}")
-    print(f"Password length: {len(user.password)}")
-    print(f"Password bytes: {[ord(c) for c in user.password]}")
-    
-    hashed_password = get_password_hash(user.password)
-    print(f"Generated hash: {hashed_password}")
-    
-    # Verify the hash immediately
-    from auth import verify_password
-    verification_result = verify_password(user.password, hashed_password)
-    print(f"Immediate verification of generated hash: {verification_result}")
-    
-    db_user = models.User(
-        email=user.email,
-        username=user.username,
-        hashed_password=hashed_password,
-        is_active=True,
-        is_verified=False,
-        created_at=datetime.utcnow()
-    )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
-
-def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
-    db_user = get_user(db, user_id)
-    if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    update_data = user.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(db_user, field, value)
-    
-    db.commit()
-    db.refresh(db_user)
-    return db_user
-
-def create_login_history(db: Session, user_id: int, ip_address: str, user_agent: str, success: bool = True):
-    db_history = models.LoginHistory(
-        user_id=user_id,
-        ip_address=ip_address,
-        user_agent=user_agent,
-        success=success
-    )
-    db.add(db_history)
-    db.commit()
-    db.refresh(db_history)
-    return db_history
-
-def log_login_attempt(db: Session, ip_address: str, success: bool) -> None:
-    """
-    Log a login attempt.
-    """
-    try:
-        login_history = models.LoginHistory(
-            ip_address=ip_address,
-            success=success,
-            login_time=datetime.utcnow()
-        )
-        db.add(login_history)
-        db.commit()
-    except Exception as e:
-        print(f"Error logging login attempt: {str(e)}")
-        db.rollback()
-
-def get_login_history(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.LoginHistory)\
-        .filter(models.LoginHistory.user_id == user_id)\
-        .order_by(models.LoginHistory.login_time.desc())\
-        .offset(skip).limit(limit).all()
-
-# Server operations
-def get_server(db: Session, server_id: int):
-    return db.query(models.Server).filter(models.Server.id == server_id).first()
-
-def get_servers(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Server).offset(skip).limit(limit).all()
-
-def get_user_servers(db: Session, user_id: int):
-    return db.query(models.Server)\
-        .join(models.ServerMember)\
-        .filter(models.ServerMember.user_id == user_id)\
-        .all()
-
-def create_server(db: Session, server: schemas.ServerCreate, owner_id: int):
-    db_server = models.Server(
-        **server.dict(),
-        owner_id=owner_id,
-        created_at=datetime.utcnow()
-    )
-    db.add(db_server)
-    db.commit()
-    db.refresh(db_server)
-    
-    # Добавляем владельца как участника сервера с ролью ADMIN
-    db_member = models.ServerMember(
-        user_id=owner_id,
-        server_id=db_server.id,
-        role_type=models.UserRole.ADMIN,
-        joined_at=datetime.utcnow()
-    )
-    db.add(db_member)
-    db.commit()
-    
-    return db_server
-
-def update_server(db: Session, server_id: int, server: schemas.ServerUpdate):
-    db_server = get_server(db, server_id)
-    if not db_server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    
-    update_data = server.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(db_server, field, value)
-    
-    db.commit()
-    db.refresh(db_server)
-    return db_server
-
-def delete_server(db: Session, server_id: int):
-    db_server = get_server(db, server_id)
-    if not db_server:
-        raise HTTPException(status_code=404, detail="Server not found")
-    
-    db.delete(db_server)
-    db.commit()
-    return {"message": "Server deleted successfully"}
-
-def get_role(db: Session, role_id: int):
-    return db.query(models.Role).filter(models.Role.id == role_id).first()
-
-def get_server_roles(db: Session, server_id: int):
-    return db.query(models.Role).filter(models.Role.server_id == server_id).all()
-
-def create_role(db: Session, role: schemas.RoleCreate, server_id: int):
-    db_role = models.Role(**role.dict(), server_id=server_id)
-    db.add(db_role)
-    db.commit()
-    db.refresh(db_role)
-    return db_role
-
-def update_role(db: Session, role_id: int, role: schemas.RoleUpdate):
-    db_role = get_role(db, role_id)
-    if not db_role:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    update_data = role.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(db_role, field, value)
-    
-    db.commit()
-    db.refresh(db_role)
-    return db_role
-
-def delete_role(db: Session, role_id: int):
-    db_role = get_role(db, role_id)
-    if not db_role:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    db.delete(db_role)
-    db.commit()
-    return {"message": "Role deleted successfully"}
-
-# Channel operations
-def get_channel(db: Session, channel_id: int):
-    return db.query(models.Channel).filter(models.Channel.id == channel_id).first()
-
-def get_server_channels(db: Session, server_id: int):
-    return db.query(models.Channel)\
-        .filter(models.Channel.server_id == server_id)\
-        .order_by(models.Channel.position)\
-        .all()
-
-def create_channel(db: Session, channel: schemas.ChannelCreate, server_id: int):
-    # Get the last position in the server
-    last_channel = db.query(models.Channel)\
-        .filter(models.Channel.server_id == server_id)\
-        .order_by(models.Channel.position.desc())\
-        .first()
-    
-    position = (last_channel.position + 1) if last_channel else 0
-    
-    # Create channel data without position
-    channel_data = channel.dict()
-    channel_data.pop('position', None)  # Remove position from input data
-    
-    db_channel = models.Channel(
-        **channel_data,
-        server_id=server_id,
-        position=position,
-        created_at=datetime.utcnow()
-    )
-    db.add(db_channel)
-    db.commit()
-    db.refresh(db_channel)
-    return db_channel
-
-def update_channel(db: Session, channel_id: int, channel: schemas.ChannelUpdate):
-    db_channel = get_channel(db, channel_id)
-    if not db_channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    update_data = channel.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(db_channel, field, value)
-    
-    db.commit()
-    db.refresh(db_channel)
-    return db_channel
-
-def delete_channel(db: Session, channel_id: int):
-    db_channel = get_channel(db, channel_id)
-    if not db_channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    db.delete(db_channel)
-    db.commit()
-    return {"message": "Channel deleted successfully"}
-
-# Message operations
-def get_message(db: Session, message_id: int):
-    return db.query(models.Message).filter(models.Message.id == message_id).first()
-
-def get_channel_messages(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Message)\
-        .filter(models.Message.channel_id == channel_id)\
-        .join(models.User, models.Message.author_id == models.User.id)\
-        .order_by(models.Message.created_at.asc())\
-        .offset(skip).limit(limit).all()
-
-def create_message(db: Session, message: schemas.MessageCreate, author_id: int, channel_id: int):
-    db_message = models.Message(
-        **message.dict(),
-        author_id=author_id,
-        channel_id=channel_id,
-        created_at=datetime.utcnow()
-    )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    return db_message
-
-def update_message(db: Session, message_id: int, message: schemas.MessageUpdate):
-    db_message = get_message(db, message_id)
-    if not db_message:
-        raise HTTPException(status_code=404, detail="Message not found")
-    
-    update_data = message.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(db_message, field, value)
-    
-    db_message.is_edited = True
-    db_message.edited_at = datetime.utcnow()
-    
-    db.commit()
-    db.refresh(db_message)
-    return db_message
-
-def delete_message(db: Session, message_id: int):
-    db_message = get_message(db, message_id)
-    if not db_message:
-        raise HTTPException(status_code=404, detail="Message not found")
-    
-    db.delete(db_message)
-    db.commit()
-    return {"message": "Message deleted successfully"}
-
-def add_message_reaction(db: Session, message_id: int, user_id: int, emoji: str):
-    db.execute(
-        models.message_reactions.insert().values(
-            message_id=message_id,
-            user_id=user_id,
-            emoji=emoji
-        )
-    )
-    db.commit()
-    return {"message": "Reaction added successfully"}
-
-def remove_message_reaction(db: Session, message_id: int, user_id: int, emoji: str):
-    db.execute(
-        models.message_reactions.delete().where(
-            and_(
-                models.message_reactions.c.message_id == message_id,
-                models.message_reactions.c.user_id == user_id,
-                models.message_reactions.c.emoji == emoji
-            )
-        )
-    )
-    db.commit()
-    return {"message": "Reaction removed successfully"}
-
-def create_audit_log(db: Session, server_id: int, user_id: int, action: str, target_type: str, target_id: int, changes: Dict[str, Any]):
-    db_log = models.AuditLog(
-        server_id=server_id,
-        user_id=user_id,
-        action=action,
-        target_type=target_type,
-        target_id=target_id,
-        changes=changes
-    )
-    db.add(db_log)
-    db.commit()
-    db.refresh(db_log)
-    return db_log
-
-def get_server_audit_logs(db: Session, server_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.AuditLog)\
-        .filter(models.AuditLog.server_id == server_id)\
-        .order_by(models.AuditLog.created_at.desc())\
-        .offset(skip).limit(limit).all()
-
-# Media operations
-def get_media(db: Session, media_id: int):
-    return db.query(models.Media).filter(models.Media.id == media_id).first()
-
-def get_channel_media(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Media)\
-        .filter(models.Media.channel_id == channel_id)\
-        .order_by(models.Media.created_at.desc())\
-        .offset(skip).limit(limit).all()
-
-def create_media(db: Session, media: schemas.MediaCreate, uploaded_by_id: int, channel_id: int):
-    db_media = models.Media(
-        **media.dict(),
-        uploaded_by_id=uploaded_by_id,
-        channel_id=channel_id
-    )
-    db.add(db_media)
-    db.commit()
-    db.refresh(db_media)
-    return db_media
-
-def delete_media(db: Session, media_id: int):
-    db_media = get_media(db, media_id)
-    if not db_media:
-        raise HTTPException(status_code=404, detail="Media not found")
-    
-    db.delete(db_media)
-    db.commit()
-    return {"message": "Media deleted successfully"}
-
-# Game operations
-def get_game_session(db: Session, game_id: int):
-    return db.query(models.GameSession).filter(models.GameSession.id == game_id).first()
-
-def get_channel_games(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.GameSession)\
-        .filter(models.GameSession.channel_id == channel_id)\
-        .order_by(models.GameSession.created_at.desc())\
-        .offset(skip).limit(limit).all()
-
-def create_game_session(db: Session, game: schemas.GameSessionCreate, created_by_id: int, channel_id: int):
-    db_game = models.GameSession(
-        **game.dict(),
-        created_by_id=created_by_id,
-        channel_id=channel_id,
-        status="active"
-    )
-    db.add(db_game)
-    db.commit()
-    db.refresh(db_game)
-    return db_game
-
-def update_game_session(db: Session, game_id: int, game: Dict[str, Any]):
-    db_game = get_game_session(db, game_id)
-    if not db_game:
-        raise HTTPException(status_code=404, detail="Game session not found")
-    
-    for field, value in game.items():
-        setattr(db_game, field, value)
-    
-    db.commit()
-    db.refresh(db_game)
-    return db_game
-
-def add_game_player(db: Session, game_id: int, user_id: int):
-    db_player = models.GamePlayer(
-        game_id=game_id,
-        user_id=user_id,
-        status="active"
-    )
-    db.add(db_player)
-    db.commit()
-    db.refresh(db_player)
-    return db_player
-
-def update_game_player(db: Session, game_id: int, user_id: int, player_data: Dict[str, Any]):
-    db_player = db.query(models.GamePlayer)\
-        .filter(
-            models.GamePlayer.game_id == game_id,
-            models.GamePlayer.user_id == user_id
-        ).first()
-    
-    if not db_player:
-        raise HTTPException(status_code=404, detail="Player not found")
-    
-    for field, value in player_data.items():
-        setattr(db_player, field, value)
-    
-    db.commit()
-    db.refresh(db_player)
-    return db_player
-
-# Music operations
-def get_music_queue(db: Session, channel_id: int):
-    return db.query(models.MusicQueue)\
-        .filter(models.MusicQueue.channel_id == channel_id)\
-        .order_by(models.MusicQueue.position)\
-        .all()
-
-def add_to_music_queue(db: Session, music: schemas.MusicQueueCreate, added_by_id: int, channel_id: int):
-    # Получаем текущую позицию в очереди
-    last_position = db.query(models.MusicQueue)\
-        .filter(models.MusicQueue.channel_id == channel_id)\
-        .order_by(models.MusicQueue.position.desc())\
-        .first()
-    
-    position = (last_position.position + 1) if last_position else 0
-    
-    db_music = models.MusicQueue(
-        **music.dict(),
-        added_by_id=added_by_id,
-        channel_id=channel_id,
-        position=position,
-        status="queued"
-    )
-    db.add(db_music)
-    db.commit()
-    db.refresh(db_music)
-    return db_music
-
-def update_music_status(db: Session, music_id: int, status: str):
-    db_music = db.query(models.MusicQueue).filter(models.MusicQueue.id == music_id).first()
-    if not db_music:
-        raise HTTPException(status_code=404, detail="Music not found")
-    
-    db_music.status = status
-    db.commit()
-    db.refresh(db_music)
-    return db_music
-
-def remove_from_music_queue(db: Session, music_id: int):
-    db_music = db.query(models.MusicQueue).filter(models.MusicQueue.id == music_id).first()
-    if not db_music:
-        raise HTTPException(status_code=404, detail="Music not found")
-    
-    db.delete(db_music)
-    db.commit()
-    return {"message": "Music removed from queue successfully"}
-
-def create_invite_code(db: Session, server_id: int, user_id: int) -> models.InviteCode:
-    # Generate a random 8-character code
-    code = secrets.token_urlsafe(8)
-    
-    # Create the invite code
-    db_invite = models.InviteCode(
-        code=code,
-        server_id=server_id,
-        created_by=user_id,
-        expires_at=datetime.utcnow() + timedelta(days=7)  # Expires in 7 days
-    )
-    db.add(db_invite)
-    db.commit()
-    db.refresh(db_invite)
-    return db_invite
-
-def get_server_by_invite_code(db: Session, invite_code: str) -> Optional[models.Server]:
-    invite = db.query(models.InviteCode).filter(models.InviteCode.code == invite_code).first()
-    if not invite:
-        return None
-    
-    # Check if invite has expired
-    if invite.expires_at and invite.expires_at < datetime.utcnow():
-        return None
-    
-    return invite.server
-
-def is_user_server_member(db: Session, user_id: int, server_id: int) -> bool:
-    return db.query(models.ServerMember).filter(
-        models.ServerMember.user_id == user_id,
-        models.ServerMember.server_id == server_id
-    ).first() is not None
-
-def add_user_to_server(db: Session, user_id: int, server_id: int) -> models.ServerMember:
-    # Check if user is already a member
-    if is_user_server_member(db, user_id, server_id):
-        return db.query(models.ServerMember).filter(
-            models.ServerMember.user_id == user_id,
-            models.ServerMember.server_id == server_id
-        ).first()
-    
-    # Add user as a member with default role
-    db_member = models.ServerMember(
-        user_id=user_id,
-        server_id=server_id,
-        role_type=models.RoleType.MEMBER
-    )
-    db.add(db_member)
-    db.commit()
-    db.refresh(db_member)
-    return db_member
-
-def update_user_credentials(db: Session, user_id: int, new_username: str, new_password: str):
-    """
-    Update both username and password for a user.
-    """
-    from auth import get_password_hash
-    
-    print(f"Updating credentials for user {user_id}")
-    print(f"New username: {new_username}")
-    print(f"New password: {new_password}")
-    
-    db_user = get_user(db, user_id)
-    if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    # Update username
-    db_user.username = new_username
-    
-    # Update password
-    hashed_password = get_password_hash(new_password)
-    print(f"Generated new hash: {hashed_password}")
-    
-    # Verify the new hash immediately
-    from auth import verify_password
-    verification_result = verify_password(new_password, hashed_password)
-    print(f"Verification of new hash: {verification_result}")
-    
-    db_user.hashed_password = hashed_password
-    
-    db.commit()
-    db.refresh(db_user)
-    return db_user 
\ No newline at end of file
+from sqlalchemy.orm import Session, aliased, joinedload, selectinload
+from sqlalchemy import and_, or_, tuple_, select, literal, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import models, schemas
+import changes  # noqa: F401  flush hooks that write the sync change feed
+import etags
+import mentions
+import search
+from typing import List, Optional, Dict, Any, Tuple
+from fastapi import HTTPException
+import secrets
+from app_logging import get_logger
+
+logger = get_logger("crud")
+
+def _commit(db: Session):
+    """Commit, or just flush when the caller holds a unit_of_work()."""
+    if db.info.get("unit_of_work"):
+        db.flush()
+    else:
+        db.commit()
+
+@contextmanager
+def unit_of_work(db: Session):
+    """
+    Run several crud calls as one transaction. Inside the block their commits
+    become flushes (ids are still assigned), and a single COMMIT is issued on
+    exit, or a rollback if the block raises. Nested blocks join the outer one.
+    """
+    if db.info.get("unit_of_work"):
+        yield db
+        return
+    db.info["unit_of_work"] = True
+    try:
+        yield db
+    except BaseException:
+        db.info.pop("unit_of_work", None)
+        db.rollback()
+        raise
+    db.info.pop("unit_of_work", None)
+    db.commit()
+
+def with_audit_log(db: Session, fn, audit, **kwargs):
+    """
+    Run ``fn(db, **kwargs)`` and write its audit log entry in the same
+    transaction. ``audit`` holds the create_audit_log arguments, or is a
+    callable building them from the result; ``target_id`` defaults to the
+    id of the returned object.
+    """
+    with unit_of_work(db):
+        result = fn(db, **kwargs)
+        entry = audit(result) if callable(audit) else dict(audit)
+        entry.setdefault("target_id", getattr(result, "id", None))
+        create_audit_log(db, **entry)
+    return result
+
+# User operations
+def get_user(db: Session, user_id: int):
+    return db.query(models.User).filter(models.User.id == user_id).first()
+
+def get_user_by_email(db: Session, email: str):
+    return db.query(models.User).filter(models.User.email == email).first()
+
+def get_user_by_username(db: Session, username: str):
+    return db.query(models.User).filter(models.User.username == username).first()
+
+def get_users(db: Session, skip: int = 0, limit: int = 100):
+    return db.query(models.User).offset(skip).limit(limit).all()
+
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: Optional[str] = None):
+    """
+    ``hashed_password`` can be computed beforehand, so bcrypt doesn't run
+    on the writer thread.
+    """
+    if hashed_password is None:
+        from auth import get_password_hash  # import inside function to avoid circular dependency
+        hashed_password = get_password_hash(user.password)
+
+    db_user = models.User(
+        email=user.email,
+        username=user.username,
+        hashed_password=hashed_password,
+        is_active=True,
+        is_verified=False,
+        created_at=datetime.utcnow()
+    )
+    db.add(db_user)
+    _commit(db)
+    return db_user
+
+def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
+    db_user = get_user(db, user_id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    update_data = user.model_dump(exclude_unset=True)
+    for field, value in update_data.items():
+        setattr(db_user, field, value)
+    
+    _commit(db)
+    return db_user
+
+def create_login_history(db: Session, user_id: int, ip_address: str, user_agent: str, success: bool = True):
+    db_history = models.LoginHistory(
+        user_id=user_id,
+        ip_address=ip_address,
+        user_agent=user_agent,
+        success=success
+    )
+    db.add(db_history)
+    _commit(db)
+    return db_history
+
+def log_login_attempt(db: Session, ip_address: str, success: bool) -> None:
+    """
+    Log a login attempt.
+    """
+    try:
+        login_history = models.LoginHistory(
+            ip_address=ip_address,
+            success=success,
+            login_time=datetime.utcnow()
+        )
+        db.add(login_history)
+        _commit(db)
+    except Exception as e:
+        logger.error("Error logging login attempt: %s", e)
+        db.rollback()
+
+def update_last_login(db: Session, user_id: int):
+    db.query(models.User).filter(models.User.id == user_id).update({"last_login": datetime.now()})
+    _commit(db)
+
+def get_login_history(db: Session, user_id: int, skip: int = 0, limit: int = 100, columns: Optional[list] = None):
+    """``columns`` returns plain rows of those columns instead of LoginHistory objects."""
+    return db.query(*(columns or [models.LoginHistory]))\
+        .filter(models.LoginHistory.user_id == user_id)\
+        .order_by(models.LoginHistory.login_time.desc())\
+        .offset(skip).limit(limit).all()
+
+# Server operations
+def get_server(db: Session, server_id: int):
+    return db.query(models.Server).filter(models.Server.id == server_id).first()
+
+def get_servers(db: Session, skip: int = 0, limit: int = 100):
+    return db.query(models.Server).offset(skip).limit(limit).all()
+
+def get_user_servers(db: Session, user_id: int):
+    return db.query(models.Server)\
+        .join(models.ServerMember)\
+        .filter(models.ServerMember.user_id == user_id)\
+        .all()
+
+def create_server(db: Session, server: schemas.ServerCreate, owner_id: int):
+    db_server = models.Server(
+        **server.model_dump(),
+        owner_id=owner_id,
+        created_at=datetime.utcnow()
+    )
+    db.add(db_server)
+    db.flush()
+    
+    # Добавляем владельца как участника сервера с ролью ADMIN
+    db_member = models.ServerMember(
+        user_id=owner_id,
+        server_id=db_server.id,
+        role_type=models.UserRole.ADMIN,
+        joined_at=datetime.utcnow()
+    )
+    db.add(db_member)
+    etags.touch(db, etags.user_servers(owner_id))
+    _commit(db)
+    
+    return db_server
+
+def update_server(db: Session, server_id: int, server: schemas.ServerUpdate):
+    db_server = get_server(db, server_id)
+    if not db_server:
+        raise HTTPException(status_code=404, detail="Server not found")
+    
+    update_data = server.model_dump(exclude_unset=True)
+    for field, value in update_data.items():
+        setattr(db_server, field, value)
+    
+    etags.touch(db, etags.server(server_id), etags.ALL_SERVERS)
+    _commit(db)
+    return db_server
+
+def delete_server(db: Session, server_id: int):
+    db_server = get_server(db, server_id)
+    if not db_server:
+        raise HTTPException(status_code=404, detail="Server not found")
+    
+    db.delete(db_server)
+    etags.touch(
+        db, etags.server(server_id), etags.ALL_SERVERS,
+        etags.server_channels(server_id), etags.server_roles(server_id)
+    )
+    _commit(db)
+    return {"message": "Server deleted successfully"}
+
+def get_role(db: Session, role_id: int):
+    return db.query(models.Role).filter(models.Role.id == role_id).first()
+
+def get_server_roles(db: Session, server_id: int):
+    return db.query(models.Role).filter(models.Role.server_id == server_id).all()
+
+def create_role(db: Session, role: schemas.RoleCreate, server_id: int):
+    db_role = models.Role(**role.model_dump(), server_id=server_id)
+    db.add(db_role)
+    etags.touch(db, etags.server_roles(server_id))
+    _commit(db)
+    return db_role
+
+def update_role(db: Session, role_id: int, role: schemas.RoleUpdate):
+    db_role = get_role(db, role_id)
+    if not db_role:
+        raise HTTPException(status_code=404, detail="Role not found")
+    
+    update_data = role.model_dump(exclude_unset=True)
+    for field, value in update_data.items():
+        setattr(db_role, field, value)
+    
+    etags.touch(db, etags.server_roles(db_role.server_id))
+    _commit(db)
+    return db_role
+
+def delete_role(db: Session, role_id: int):
+    db_role = get_role(db, role_id)
+    if not db_role:
+        raise HTTPException(status_code=404, detail="Role not found")
+    
+    db.delete(db_role)
+    etags.touch(db, etags.server_roles(db_role.server_id))
+    _commit(db)
+    return {"message": "Role deleted successfully"}
+
+# Channel operations
+def get_channel(db: Session, channel_id: int):
+    return db.query(models.Channel).filter(models.Channel.id == channel_id).first()
+
+def get_server_channels(db: Session, server_id: int):
+    return db.query(models.Channel)\
+        .filter(models.Channel.server_id == server_id)\
+        .order_by(models.Channel.position)\
+        .all()
+
+def create_channel(db: Session, channel: schemas.ChannelCreate, server_id: int):
+    # Get the last position in the server
+    last_channel = db.query(models.Channel)\
+        .filter(models.Channel.server_id == server_id)\
+        .order_by(models.Channel.position.desc())\
+        .first()
+    
+    position = (last_channel.position + 1) if last_channel else 0
+    
+    # Create channel data without position
+    channel_data = channel.model_dump()
+    channel_data.pop('position', None)  # Remove position from input data
+    
+    db_channel = models.Channel(
+        **channel_data,
+        server_id=server_id,
+        position=position,
+        created_at=datetime.utcnow()
+    )
+    db.add(db_channel)
+    etags.touch(db, etags.server_channels(server_id))
+    _commit(db)
+    return db_channel
+
+def update_channel(db: Session, channel_id: int, channel: schemas.ChannelUpdate):
+    db_channel = get_channel(db, channel_id)
+    if not db_channel:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    
+    update_data = channel.model_dump(exclude_unset=True)
+    for field, value in update_data.items():
+        setattr(db_channel, field, value)
+    
+    etags.touch(db, etags.server_channels(db_channel.server_id))
+    _commit(db)
+    return db_channel
+
+def delete_channel(db: Session, channel_id: int):
+    db_channel = get_channel(db, channel_id)
+    if not db_channel:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    
+    db.delete(db_channel)
+    etags.touch(db, etags.server_channels(db_channel.server_id))
+    _commit(db)
+    return {"message": "Channel deleted successfully"}
+
+# Message operations
+def get_message(db: Session, message_id: int):
+    return db.query(models.Message)\
+        .options(joinedload(models.Message.author), selectinload(models.Message.reaction_counts))\
+        .filter(models.Message.id == message_id)\
+        .first()
+
+def get_message_position(db: Session, message_id: int):
+    """(id, channel_id, created_at) of a message, for use as a page anchor."""
+    return db.query(models.Message.id, models.Message.channel_id, models.Message.created_at)\
+        .filter(models.Message.id == message_id)\
+        .first()
+
+def get_channel_messages(
+    db: Session,
+    channel_id: int,
+    limit: int = 100,
+    before: Optional[Tuple[datetime, int]] = None,
+    after: Optional[Tuple[datetime, int]] = None
+):
+    """
+    One page of channel history, returned oldest-first.
+
+    Without a key this is the newest page. ``before``/``after`` are
+    (created_at, id) keys; the page continues strictly past them. Every page
+    is a range scan on ix_messages_channel_created (id rides along as the
+    rowid), so page cost doesn't depend on how far back it is. Authors are
+    joined in the same query and reaction totals fetched in one more, since
+    schemas.Message serializes both.
+    """
+    key = tuple_(models.Message.created_at, models.Message.id)
+    query = db.query(models.Message)\
+        .options(joinedload(models.Message.author), selectinload(models.Message.reaction_counts))\
+        .filter(models.Message.channel_id == channel_id)
+    if after is not None:
+        return query.filter(key > tuple_(*after))\
+            .order_by(models.Message.created_at.asc(), models.Message.id.asc())\
+            .limit(limit).all()
+
+    if before is not None:
+        query = query.filter(key < tuple_(*before))
+    messages = query\
+        .order_by(models.Message.created_at.desc(), models.Message.id.desc())\
+        .limit(limit).all()
+    messages.reverse()
+    return messages
+
+def create_message(db: Session, message: schemas.MessageCreate, author_id: int, channel_id: int):
+    row = dict(message.model_dump(), author_id=author_id, channel_id=channel_id, created_at=datetime.utcnow())
+    return create_messages(db, [row])[0]
+
+def create_messages(db: Session, rows: List[Dict[str, Any]]) -> List[models.Message]:
+    """
+    Insert a batch of messages with one multi-row INSERT ... RETURNING and
+    return them in input order with their ids set. Replies bump their
+    parent's reply counters in the same transaction.
+    """
+    db_messages = [models.Message(**row) for row in rows]
+    mentions.resolve(db, db_messages)
+    db.add_all(db_messages)
+    db.flush()
+    search.index_messages(db, db_messages)
+    mentions.store(db, db_messages)
+    _count_replies(db, [m for m in db_messages if m.parent_id is not None])
+    _commit(db)
+    return db_messages
+
+def _count_replies(db: Session, replies: List[models.Message]):
+    by_parent: Dict[Tuple[int, int], List[models.Message]] = {}
+    for reply in replies:
+        by_parent.setdefault((reply.parent_id, reply.channel_id), []).append(reply)
+    for (parent_id, channel_id), group in by_parent.items():
+        latest = max(reply.created_at for reply in group)
+        updated = db.query(models.Message)\
+            .filter(models.Message.id == parent_id, models.Message.channel_id == channel_id)\
+            .update({
+                models.Message.reply_count: models.Message.reply_count + len(group),
+                models.Message.last_reply_at: func.max(func.coalesce(models.Message.last_reply_at, latest), latest)
+            }, synchronize_session=False)
+        if not updated:
+            raise HTTPException(status_code=400, detail="Parent message not found in this channel")
+
+def _uncount_reply(db: Session, reply: models.Message):
+    other_replies = select(func.max(models.Message.created_at))\
+        .where(models.Message.parent_id == reply.parent_id, models.Message.id != reply.id)\
+        .scalar_subquery()
+    db.query(models.Message)\
+        .filter(models.Message.id == reply.parent_id)\
+        .update({
+            models.Message.reply_count: func.max(models.Message.reply_count - 1, 0),
+            models.Message.last_reply_at: other_replies
+        }, synchronize_session=False)
+
+def get_thread(db: Session, message_id: int, user_id: int, max_depth: int) -> List[models.Message]:
+    """
+    A message and its replies down to ``max_depth`` levels, oldest first,
+    each with a ``depth`` attribute (0 for the root). The tree comes from one
+    recursive CTE walking ix_messages_parent; it is empty unless ``user_id``
+    is a member of the message's server.
+    """
+    thread = select(models.Message.id, literal(0).label("depth"))\
+        .join(models.Channel, models.Channel.id == models.Message.channel_id)\
+        .join(models.ServerMember, and_(
+            models.ServerMember.server_id == models.Channel.server_id,
+            models.ServerMember.user_id == user_id
+        ))\
+        .where(models.Message.id == message_id)\
+        .cte("thread", recursive=True)
+    reply = aliased(models.Message)
+    thread = thread.union_all(
+        select(reply.id, thread.c.depth + 1)
+        .join(thread, reply.parent_id == thread.c.id)
+        .where(thread.c.depth < max_depth)
+    )
+    rows = db.query(models.Message, thread.c.depth)\
+        .join(thread, models.Message.id == thread.c.id)\
+        .options(joinedload(models.Message.author), selectinload(models.Message.reaction_counts))\
+        .order_by(models.Message.created_at, models.Message.id)\
+        .all()
+    messages = []
+    for db_message, depth in rows:
+        db_message.depth = depth
+        messages.append(db_message)
+    return messages
+
+def update_message(db: Session, message_id: int, message: schemas.MessageUpdate):
+    db_message = get_message(db, message_id)
+    if not db_message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    update_data = message.model_dump(exclude_unset=True)
+    for field, value in update_data.items():
+        setattr(db_message, field, value)
+    
+    db_message.is_edited = True
+    db_message.edited_at = datetime.utcnow()
+    
+    if "content" in update_data:
+        mentions.resolve(db, [db_message])
+        mentions.store(db, [db_message], replace=True)
+    search.reindex_message(db, db_message)
+    _commit(db)
+    return db_message
+
+def delete_message(db: Session, message_id: int):
+    db_message = get_message(db, message_id)
+    if not db_message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    if db_message.parent_id is not None:
+        _uncount_reply(db, db_message)
+    search.unindex_message(db, message_id)
+    mentions.unstore(db, [message_id])
+    db.execute(models.message_reactions.delete().where(models.message_reactions.c.message_id == message_id))
+    db.execute(
+        models.MessageReactionCount.__table__.delete()
+        .where(models.MessageReactionCount.message_id == message_id)
+    )
+    db.delete(db_message)
+    _commit(db)
+    return {"message": "Message deleted successfully"}
+
+def add_message_reaction(db: Session, message_id: int, user_id: int, emoji: str):
+    """
+    Add a reaction and bump its count in the same transaction. Reacting twice
+    with the same emoji is a no-op thanks to the unique index.
+    """
+    added = db.execute(
+        sqlite_insert(models.message_reactions)
+        .values(message_id=message_id, user_id=user_id, emoji=emoji)
+        .on_conflict_do_nothing()
+    ).rowcount
+    if added:
+        counts = models.MessageReactionCount.__table__
+        db.execute(
+            sqlite_insert(counts)
+            .values(message_id=message_id, emoji=emoji, count=1)
+            .on_conflict_do_update(
+                index_elements=[counts.c.message_id, counts.c.emoji],
+                set_={"count": counts.c.count + 1}
+            )
+        )
+    _commit(db)
+    return {"message": "Reaction added successfully"}
+
+def remove_message_reaction(db: Session, message_id: int, user_id: int, emoji: str):
+    removed = db.execute(
+        models.message_reactions.delete().where(
+            and_(
+                models.message_reactions.c.message_id == message_id,
+                models.message_reactions.c.user_id == user_id,
+                models.message_reactions.c.emoji == emoji
+            )
+        )
+    ).rowcount
+    if removed:
+        counts = models.MessageReactionCount.__table__
+        key = and_(counts.c.message_id == message_id, counts.c.emoji == emoji)
+        db.execute(counts.update().where(key).values(count=counts.c.count - removed))
+        db.execute(counts.delete().where(key, counts.c.count <= 0))
+    _commit(db)
+    return {"message": "Reaction removed successfully"}
+
+def get_user_mentions(db: Session, user_id: int, limit: int = 50, before_id: Optional[int] = None):
+    """
+    Newest messages mentioning a user, in servers they are still a member
+    of. Walks the (user_id, message_id) primary key of message_mentions.
+    """
+    query = db.query(models.Message)\
+        .join(models.MessageMention, models.MessageMention.message_id == models.Message.id)\
+        .join(models.Channel, models.Channel.id == models.Message.channel_id)\
+        .join(models.ServerMember, and_(
+            models.ServerMember.server_id == models.Channel.server_id,
+            models.ServerMember.user_id == user_id
+        ))\
+        .options(joinedload(models.Message.author), selectinload(models.Message.reaction_counts))\
+        .filter(models.MessageMention.user_id == user_id)
+    if before_id is not None:
+        query = query.filter(models.MessageMention.message_id < before_id)
+    return query.order_by(models.MessageMention.message_id.desc()).limit(limit).all()
+
+def get_reaction_totals(db: Session, message_id: int) -> List[models.MessageReactionCount]:
+    return db.query(models.MessageReactionCount)\
+        .filter(models.MessageReactionCount.message_id == message_id)\
+        .order_by(models.MessageReactionCount.emoji)\
+        .all()
+
+def get_reaction_summaries(db: Session, message_ids: List[int], user_id: int) -> List[schemas.MessageReactionSummary]:
+    """
+    Emoji counts plus the caller's own reactions for a page of messages, in
+    one query over message_reaction_counts. Messages in servers the user
+    isn't a member of are left out.
+    """
+    counts = models.MessageReactionCount.__table__
+    reactions = models.message_reactions
+    reacted = select(literal(1)).where(
+        reactions.c.message_id == counts.c.message_id,
+        reactions.c.emoji == counts.c.emoji,
+        reactions.c.user_id == user_id
+    ).exists()
+    rows = db.execute(
+        select(counts.c.message_id, counts.c.emoji, counts.c.count, reacted)
+        .join(models.Message, models.Message.id == counts.c.message_id)
+        .join(models.Channel, models.Channel.id == models.Message.channel_id)
+        .join(models.ServerMember, and_(
+            models.ServerMember.server_id == models.Channel.server_id,
+            models.ServerMember.user_id == user_id
+        ))
+        .where(counts.c.message_id.in_(message_ids), counts.c.count > 0)
+        .order_by(counts.c.message_id, counts.c.count.desc(), counts.c.emoji)
+    ).all()
+
+    summaries = {message_id: schemas.MessageReactionSummary(message_id=message_id) for message_id in message_ids}
+    for message_id, emoji, count, me in rows:
+        summaries[message_id].reactions.append(schemas.ReactionCount(emoji=emoji, count=count, me=me))
+    return list(summaries.values())
+
+def create_audit_log(db: Session, server_id: int, user_id: int, action: str, target_type: str, target_id: int, changes: Dict[str, Any]):
+    db_log = models.AuditLog(
+        server_id=server_id,
+        user_id=user_id,
+        action=action,
+        target_type=target_type,
+        target_id=target_id,
+        changes=changes
+    )
+    db.add(db_log)
+    _commit(db)
+    return db_log
+
+def get_server_audit_logs(db: Session, server_id: int, skip: int = 0, limit: int = 100, columns: Optional[list] = None):
+    return db.query(*(columns or [models.AuditLog]))\
+        .filter(models.AuditLog.server_id == server_id)\
+        .order_by(models.AuditLog.created_at.desc())\
+        .offset(skip).limit(limit).all()
+
+# Media operations
+def get_media(db: Session, media_id: int):
+    return db.query(models.Media).filter(models.Media.id == media_id).first()
+
+def get_channel_media(db: Session, channel_id: int, skip: int = 0, limit: int = 100, columns: Optional[list] = None):
+    return db.query(*(columns or [models.Media]))\
+        .filter(models.Media.channel_id == channel_id)\
+        .order_by(models.Media.created_at.desc())\
+        .offset(skip).limit(limit).all()
+
+def create_media(db: Session, media: schemas.MediaCreate, uploaded_by_id: int, channel_id: int):
+    db_media = models.Media(
+        **media.model_dump(),
+        uploaded_by_id=uploaded_by_id,
+        channel_id=channel_id
+    )
+    db.add(db_media)
+    _commit(db)
+    return db_media
+
+def delete_media(db: Session, media_id: int):
+    db_media = get_media(db, media_id)
+    if not db_media:
+        raise HTTPException(status_code=404, detail="Media not found")
+    
+    db.delete(db_media)
+    _commit(db)
+    return {"message": "Media deleted successfully"}
+
+# Game operations
+def get_game_session(db: Session, game_id: int):
+    return db.query(models.GameSession).filter(models.GameSession.id == game_id).first()
+
+def get_channel_games(db: Session, channel_id: int, skip: int = 0, limit: int = 100):
+    return db.query(models.GameSession)\
+        .filter(models.GameSession.channel_id == channel_id)\
+        .order_by(models.GameSession.created_at.desc())\
+        .offset(skip).limit(limit).all()
+
+def create_game_session(db: Session, game: schemas.GameSessionCreate, created_by_id: int, channel_id: int):
+    db_game = models.GameSession(
+        **game.model_dump(),
+        created_by_id=created_by_id,
+        channel_id=channel_id,
+        status="active"
+    )
+    db.add(db_game)
+    _commit(db)
+    return db_game
+
+def update_game_session(db: Session, game_id: int, game: Dict[str, Any]):
+    db_game = get_game_session(db, game_id)
+    if not db_game:
+        raise HTTPException(status_code=404, detail="Game session not found")
+    
+    for field, value in game.items():
+        setattr(db_game, field, value)
+    
+    _commit(db)
+    return db_game
+
+def add_game_player(db: Session, game_id: int, user_id: int):
+    db_player = models.GamePlayer(
+        game_id=game_id,
+        user_id=user_id,
+        status="active"
+    )
+    db.add(db_player)
+    _commit(db)
+    return db_player
+
+def update_game_player(db: Session, game_id: int, user_id: int, player_data: Dict[str, Any]):
+    db_player = db.query(models.GamePlayer)\
+        .filter(
+            models.GamePlayer.game_id == game_id,
+            models.GamePlayer.user_id == user_id
+        ).first()
+    
+    if not db_player:
+        raise HTTPException(status_code=404, detail="Player not found")
+    
+    for field, value in player_data.items():
+        setattr(db_player, field, value)
+    
+    _commit(db)
+    return db_player
+
+# Music operations
+def get_music_queue(db: Session, channel_id: int):
+    return db.query(models.MusicQueue)\
+        .filter(models.MusicQueue.channel_id == channel_id)\
+        .order_by(models.MusicQueue.position)\
+        .all()
+
+def add_to_music_queue(db: Session, music: schemas.MusicQueueCreate, added_by_id: int, channel_id: int):
+    # Получаем текущую позицию в очереди
+    last_position = db.query(models.MusicQueue)\
+        .filter(models.MusicQueue.channel_id == channel_id)\
+        .order_by(models.MusicQueue.position.desc())\
+        .first()
+    
+    position = (last_position.position + 1) if last_position else 0
+    
+    db_music = models.MusicQueue(
+        **music.model_dump(),
+        added_by_id=added_by_id,
+        channel_id=channel_id,
+        position=position,
+        status="queued"
+    )
+    db.add(db_music)
+    _commit(db)
+    return db_music
+
+def update_music_status(db: Session, music_id: int, status: str):
+    db_music = db.query(models.MusicQueue).filter(models.MusicQueue.id == music_id).first()
+    if not db_music:
+        raise HTTPException(status_code=404, detail="Music not found")
+    
+    db_music.status = status
+    _commit(db)
+    return db_music
+
+def remove_from_music_queue(db: Session, music_id: int):
+    db_music = db.query(models.MusicQueue).filter(models.MusicQueue.id == music_id).first()
+    if not db_music:
+        raise HTTPException(status_code=404, detail="Music not found")
+    
+    db.delete(db_music)
+    _commit(db)
+    return {"message": "Music removed from queue successfully"}
+
+def create_invite_code(db: Session, server_id: int, user_id: int) -> models.InviteCode:
+    # Generate a random 8-character code
+    code = secrets.token_urlsafe(8)
+    
+    # Create the invite code
+    db_invite = models.InviteCode(
+        code=code,
+        server_id=server_id,
+        created_by=user_id,
+        expires_at=datetime.utcnow() + timedelta(days=7)  # Expires in 7 days
+    )
+    db.add(db_invite)
+    _commit(db)
+    return db_invite
+
+def get_server_by_invite_code(db: Session, invite_code: str) -> Optional[models.Server]:
+    # Expired invites don't resolve
+    return db.query(models.Server)\
+        .join(models.InviteCode, models.InviteCode.server_id == models.Server.id)\
+        .filter(
+            models.InviteCode.code == invite_code,
+            or_(models.InviteCode.expires_at.is_(None), models.InviteCode.expires_at >= datetime.utcnow())
+        ).first()
+
+def is_user_server_member(db: Session, user_id: int, server_id: int) -> bool:
+    return db.query(models.ServerMember).filter(
+        models.ServerMember.user_id == user_id,
+        models.ServerMember.server_id == server_id
+    ).first() is not None
+
+def add_user_to_server(db: Session, user_id: int, server_id: int) -> models.ServerMember:
+    # Already a member: return the existing row
+    db_member = db.query(models.ServerMember).filter(
+        models.ServerMember.user_id == user_id,
+        models.ServerMember.server_id == server_id
+    ).first()
+    if db_member is not None:
+        return db_member
+    
+    # Add user as a member with default role
+    db_member = models.ServerMember(
+        user_id=user_id,
+        server_id=server_id,
+        role_type=models.RoleType.MEMBER
+    )
+    db.add(db_member)
+    etags.touch(db, etags.user_servers(user_id))
+    _commit(db)
+    return db_member
+
+def update_user_credentials(
+    db: Session,
+    user_id: int,
+    new_username: str,
+    new_password: Optional[str] = None,
+    hashed_password: Optional[str] = None
+):
+    """
+    Update both username and password for a user. Pass ``hashed_password``
+    instead of ``new_password`` to hash outside the writer thread.
+    """
+    if hashed_password is None:
+        from auth import get_password_hash
+        hashed_password = get_password_hash(new_password)
+
+    db_user = get_user(db, user_id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Update username
+    db_user.username = new_username
+    
+    # Update password
+    db_user.hashed_password = hashed_password
+    
+    _commit(db)
+    logger.info("Credentials updated for user %s", user_id)
+    return db_user
+
+def fix_swapped_credentials(db: Session, user_id: int):
+    """Swap a user's username and password hash back (see PUT /fix-credentials)."""
+    db_user = get_user(db, user_id)
+    if not db_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    db_user.username, db_user.hashed_password = db_user.hashed_password, db_user.username
+    _commit(db)
+    return db_user
+
+# Server member management
+def _get_member(db: Session, server_id: int, user_id: int) -> models.ServerMember:
+    member = db.query(models.ServerMember).filter(
+        models.ServerMember.server_id == server_id,
+        models.ServerMember.user_id == user_id
+    ).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="Member not found")
+    return member
+
+def _role_type(role) -> models.UserRole:
+    try:
+        return models.UserRole(role)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Unknown role")
+
+def add_server_member(db: Session, server_id: int, user_id: int, role) -> models.ServerMember:
+    db_member = models.ServerMember(
+        server_id=server_id,
+        user_id=user_id,
+        role_type=_role_type(role),
+        joined_at=datetime.utcnow()
+    )
+    db.add(db_member)
+    etags.touch(db, etags.user_servers(user_id))
+    _commit(db)
+    return db_member
+
+def update_member_role(db: Session, server_id: int, user_id: int, role) -> models.ServerMember:
+    member = _get_member(db, server_id, user_id)
+    member.role_type = _role_type(role)
+    _commit(db)
+    return member
+
+def remove_server_member(db: Session, server_id: int, user_id: int):
+    db.delete(_get_member(db, server_id, user_id))
+    etags.touch(db, etags.user_servers(user_id))
+    _commit(db)
@@ -1,29 +1,251 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import config
-
-# Create engine with proper configuration
-engine = create_engine(
-    config.DATABASE_URL,
-    pool_pre_ping=True,  # Enable connection health checks
-    pool_size=5,  # Set connection pool size
-    max_overflow=10  # Allow up to 10 connections beyond pool_size
-)
-
-# Create session factory
-SessionLocal = sessionmaker(
-    autocommit=False,
-    autoflush=False,
-    bind=engine
-)
-
-Base = declarative_base()
-
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close() 
\ No newline at end of file
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import raiseload, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from fastapi import Request
+import config
+from app_logging import get_logger
+
+logger = get_logger("db")
+
+def _is_memory_sqlite(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def _engine_options(url: str, pool_size: int = None) -> dict:
+    """Pick pool settings suited to the database behind ``url``."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite":
+        return {"pool_pre_ping": True, "pool_size": 5, "max_overflow": 10}
+
+    options = {"connect_args": {"check_same_thread": False}}
+    if _is_memory_sqlite(parsed):
+        # In-memory database lives inside a single connection, share it
+        options["poolclass"] = StaticPool
+    else:
+        # A file connection is only opened once and keeps its PRAGMAs and page
+        # cache; pre-ping is pointless for a local file.
+        options["poolclass"] = QueuePool
+        options["pool_size"] = pool_size or config.DB_POOL_SIZE
+        options["max_overflow"] = 0
+        options["pool_timeout"] = 30
+    return options
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas=None):
+    """Run the configured PRAGMA statements on a raw sqlite3 connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in (pragmas or config.SQLITE_PRAGMAS).items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+# journal_mode is a property of the file and can't be set read-only
+READ_PRAGMAS = {k: v for k, v in config.SQLITE_PRAGMAS.items() if k != "journal_mode"}
+READ_PRAGMAS["query_only"] = "ON"
+
+# Create engine with proper configuration
+engine = create_engine(config.DATABASE_URL, **_engine_options(config.DATABASE_URL))
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        apply_sqlite_pragmas(dbapi_connection)
+
+_url = make_url(config.DATABASE_URL)
+
+if _url.get_backend_name() == "sqlite" and not _is_memory_sqlite(_url):
+    # Dedicated connection for db_writer. pysqlite's own transaction handling
+    # breaks SAVEPOINTs, so we switch it off and emit BEGIN IMMEDIATE ourselves:
+    # the write lock is taken up front instead of failing halfway through.
+    writer_engine = create_engine(config.DATABASE_URL, **_engine_options(config.DATABASE_URL, pool_size=1))
+
+    @event.listens_for(writer_engine, "connect")
+    def _on_writer_connect(dbapi_connection, connection_record):
+        apply_sqlite_pragmas(dbapi_connection)
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(writer_engine, "begin")
+    def _on_writer_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    # Read-only pool for query endpoints; WAL lets these run next to the writer
+    _read_url = _url.set(
+        database=f"file:{Path(_url.database).as_posix()}",
+        query={"mode": "ro", "uri": "true"}
+    )
+    read_engine = create_engine(
+        _read_url,
+        **_engine_options(config.DATABASE_URL, pool_size=config.DB_READ_POOL_SIZE)
+    )
+
+    @event.listens_for(read_engine, "connect")
+    def _on_read_connect(dbapi_connection, connection_record):
+        apply_sqlite_pragmas(dbapi_connection, READ_PRAGMAS)
+else:
+    writer_engine = engine
+    read_engine = engine
+
+if config.DB_LOOP_GUARD:
+    def _forbid_event_loop_thread(conn, cursor, statement, parameters, context, executemany):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        raise RuntimeError(f"Blocking database call on the event loop thread: {statement[:80]}")
+
+    for _guarded in {engine, writer_engine, read_engine}:
+        event.listen(_guarded, "before_cursor_execute", _forbid_event_loop_thread)
+
+# Per-request query counting, see query_budget()
+_query_counter = contextvars.ContextVar("query_counter", default=None)
+
+class QueryCounter:
+    """Mutable so the thread pool copies of a request context share it."""
+    def __init__(self):
+        self.count = 0
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+
+for _counted in {engine, writer_engine, read_engine}:
+    event.listen(_counted, "before_cursor_execute", _count_query)
+
+def query_budget(limit: int):
+    """
+    Dependency factory asserting an endpoint issues at most ``limit`` queries,
+    whatever the size of the page it returns. Response serialization is
+    counted too, which is where lazy loads usually hide. Over budget is a
+    warning, or an error with DB_STRICT_LOADING.
+    """
+    async def dependency(request: Request):
+        counter = QueryCounter()
+        token = _query_counter.set(counter)
+        try:
+            yield counter
+        finally:
+            _query_counter.reset(token)
+        if counter.count > limit:
+            message = f"{request.method} {request.url.path} issued {counter.count} queries (budget {limit})"
+            if config.DB_STRICT_LOADING:
+                raise AssertionError(message)
+            logger.warning(message)
+    return dependency
+
+# Async engine for reads from async endpoints (writes go through db_writer)
+async_engine = None
+AsyncSessionLocal = None
+if config.DB_ASYNC_ENABLED and _url.get_backend_name() == "sqlite":
+    try:
+        import aiosqlite  # noqa: F401
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    except ImportError:
+        aiosqlite = None
+
+    # An in-memory database can't be shared with a separate aiosqlite connection
+    if aiosqlite is not None and not _is_memory_sqlite(_url):
+        async_engine = create_async_engine(_read_url.set(drivername="sqlite+aiosqlite"))
+
+        @event.listens_for(async_engine.sync_engine, "connect")
+        def _on_async_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, READ_PRAGMAS)
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", _count_query)
+
+        AsyncSessionLocal = async_sessionmaker(
+            async_engine,
+            autoflush=False,
+            expire_on_commit=False
+        )
+
+# Bounded pool for the blocking calls async endpoints still have to make
+_db_executor = ThreadPoolExecutor(max_workers=config.DB_THREADPOOL_SIZE, thread_name_prefix="db")
+
+async def run_sync(fn, *args, **kwargs):
+    """Run a blocking function on the database thread pool and await it."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await loop.run_in_executor(_db_executor, call)
+
+# Create session factory
+# Objects stay loaded after commit; crud doesn't refresh what it just wrote
+SessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+    bind=engine
+)
+
+ReadSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    bind=read_engine
+)
+
+if config.DB_STRICT_LOADING:
+    @event.listens_for(SessionLocal, "do_orm_execute")
+    @event.listens_for(ReadSessionLocal, "do_orm_execute")
+    def _raise_on_lazy_load(execute_state):
+        # Relationships not named in a loader option raise when they'd need SQL
+        if execute_state.is_select and not (execute_state.is_relationship_load or execute_state.is_column_load):
+            execute_state.statement = execute_state.statement.options(raiseload("*", sql_only=True))
+
+Base = declarative_base()
+
+# Dependency
+# Set while the sub-requests of one /batch call run (see batch.py): they all
+# get this session from get_db() and get_read_db(), and nobody closes it
+_shared_session = contextvars.ContextVar("shared_session", default=None)
+
+@contextmanager
+def shared_session(db):
+    token = _shared_session.set(db)
+    try:
+        yield db
+    finally:
+        _shared_session.reset(token)
+
+def get_db():
+    shared = _shared_session.get()
+    if shared is not None:
+        yield shared
+        return
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_read_db():
+    shared = _shared_session.get()
+    if shared is not None:
+        yield shared
+        return
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_db():
+    """
+    Session for async endpoints: an AsyncSession when aiosqlite is available,
+    otherwise a read-only sync session that async_crud drives via run_sync().
+    """
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = ReadSessionLocal()
+        try:
+            yield db
+        finally:
+            await run_sync(db.close)
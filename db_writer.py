@@ -0,0 +1,309 @@
+"""
+Single-writer queue for SQLite.
+
+SQLite allows one writer at a time, so request sessions that write on their
+own either wait on each other or fail with "database is locked". Write jobs
+submitted here are run by one thread that owns the only writing session. It
+drains whatever jobs are waiting, runs each one inside a SAVEPOINT and then
+commits the whole group with a single COMMIT (one fsync for the group).
+
+A job is any ``crud``-style function taking the session as its first
+argument. Its return value or exception is delivered through a Future.
+
+``transaction()`` groups the writes of several requests (an atomic /batch
+call) into one transaction: a single job holds the writer's session while
+the block runs, and jobs submitted from inside the block run right away on
+that session, each in a savepoint of its own, instead of being queued.
+Leaving the block releases the job, which commits with its group or, if the
+block raised or asked for a rollback, rolls everything back. Other writes
+wait in the queue meanwhile, so keep the block short. Side effects that must
+only happen once the writes are durable go through ``on_commit()``.
+"""
+import asyncio
+import contextvars
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Any, Callable
+
+from sqlalchemy.orm import Session, sessionmaker
+
+import config
+from database import SessionLocal, run_sync, writer_engine
+from app_logging import get_logger
+
+logger = get_logger("db.writer")
+
+class _BatchSession(Session):
+    """
+    Session handed to write jobs. While a group is open, ``commit()`` only
+    flushes (so crud functions can keep calling it and still see their ids)
+    and ``rollback()`` only undoes the current job's savepoint.
+    """
+    in_batch = False
+    job_savepoint = None
+
+    def commit(self):
+        if self.in_batch:
+            self.flush()
+        else:
+            super().commit()
+
+    def rollback(self):
+        if self.in_batch:
+            if self.job_savepoint is not None and self.job_savepoint.is_active:
+                self.job_savepoint.rollback()
+        else:
+            super().rollback()
+
+class _Transaction:
+    """State shared by a transaction() block and the job holding the writer for it."""
+
+    def __init__(self):
+        self.session = None
+        self.rollback = False
+        self.ready = threading.Event()
+        self.released = threading.Event()
+        self.committed = []  # on_commit() callbacks
+        # Taken by each job on the session; once closed, late jobs (e.g. of a
+        # sub-request still running after the block timed out) are refused
+        self.lock = threading.RLock()
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+class _RolledBack(Exception):
+    pass
+
+def _hold(db: _BatchSession, transaction: _Transaction):
+    transaction.session = db
+    transaction.ready.set()
+    transaction.released.wait()
+    if transaction.rollback:
+        raise _RolledBack()
+
+def _wait_until_held(transaction: _Transaction, held: Future):
+    while not transaction.ready.wait(0.1):
+        if held.done():
+            held.result()  # raises whatever kept the job from starting
+
+# The transaction() block the current request runs in, if any
+_transaction = contextvars.ContextVar("writer_transaction", default=None)
+
+class DatabaseWriter:
+    def __init__(self, max_batch: int = config.DB_WRITER_MAX_BATCH):
+        self.max_batch = max_batch
+        self._jobs: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._session_factory = sessionmaker(
+            bind=writer_engine,
+            class_=_BatchSession,
+            autoflush=False,
+            expire_on_commit=False
+        )
+        self.batches = 0
+        self.jobs_done = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Finish queued jobs and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._jobs.put(None)
+            thread.join(timeout)
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queue ``fn(session, *args, **kwargs)`` and return a Future for its result."""
+        future = Future()
+        transaction = _transaction.get()
+        if transaction is not None:
+            self._run_in_transaction(transaction, future, fn, args, kwargs)
+            return future
+        if not config.DB_SINGLE_WRITER:
+            self._run_inline(future, fn, args, kwargs)
+            return future
+        if self._thread is None:
+            self.start()
+        self._jobs.put((fn, args, kwargs, future))
+        return future
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Blocking variant of submit() for sync endpoints."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Awaitable variant of submit() for async endpoints."""
+        if _transaction.get() is not None:
+            # runs on the transaction's session, off the event loop
+            return await run_sync(self.call, fn, *args, **kwargs)
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Run the writes submitted inside the block as one transaction. It
+        commits when the block exits normally, and rolls back when it raises
+        or sets ``rollback`` on the yielded object.
+        """
+        transaction = _Transaction()
+        held = self._start_hold(transaction)
+        await asyncio.get_running_loop().run_in_executor(None, _wait_until_held, transaction, held)
+        token = _transaction.set(transaction)
+        try:
+            yield transaction
+        except BaseException:
+            transaction.rollback = True
+            raise
+        finally:
+            _transaction.reset(token)
+            await run_sync(transaction.close)
+            transaction.released.set()
+            try:
+                await asyncio.wrap_future(held)
+            except _RolledBack:
+                pass
+            else:
+                for callback in transaction.committed:
+                    callback()
+
+    def in_transaction(self) -> bool:
+        return _transaction.get() is not None
+
+    def on_commit(self, callback: Callable[[], Any]):
+        """
+        Call ``callback()`` once the writes made so far are committed: right
+        away, or inside transaction() when the block has committed (never if
+        it rolls back).
+        """
+        transaction = _transaction.get()
+        if transaction is None:
+            callback()
+        else:
+            transaction.committed.append(callback)
+
+    def _start_hold(self, transaction: _Transaction) -> Future:
+        if config.DB_SINGLE_WRITER:
+            return self.submit(_hold, transaction=transaction)
+        # No writer thread to hold: run the job as a group of its own
+        future = Future()
+
+        def run():
+            db = self._session_factory()
+            try:
+                self._run_batch(db, [(_hold, (), {"transaction": transaction}, future)])
+            finally:
+                db.close()
+        threading.Thread(target=run, name="db-transaction", daemon=True).start()
+        return future
+
+    def _run_in_transaction(self, transaction: _Transaction, future: Future, fn, args, kwargs):
+        with transaction.lock:
+            if transaction.closed:
+                future.set_exception(RuntimeError("The writer transaction has already ended"))
+                return
+            self._run_job_in_transaction(transaction, future, fn, args, kwargs)
+
+    def _run_job_in_transaction(self, transaction: _Transaction, future: Future, fn, args, kwargs):
+        db = transaction.session
+        outer, db.job_savepoint = db.job_savepoint, None
+        try:
+            db.job_savepoint = db.begin_nested()
+            result = fn(db, *args, **kwargs)
+            if db.job_savepoint.is_active:
+                db.job_savepoint.commit()
+            future.set_result(result)
+        except BaseException as exc:
+            if db.job_savepoint is not None and db.job_savepoint.is_active:
+                db.job_savepoint.rollback()
+            future.set_exception(exc)
+        finally:
+            db.job_savepoint = outer
+
+    def _run_inline(self, future: Future, fn, args, kwargs):
+        db = SessionLocal()
+        try:
+            future.set_result(fn(db, *args, **kwargs))
+        except BaseException as exc:
+            db.rollback()
+            future.set_exception(exc)
+        finally:
+            db.close()
+
+    def _run(self):
+        db = self._session_factory()
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                batch = [job]
+                stopping = False
+                while len(batch) < self.max_batch:
+                    try:
+                        job = self._jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    batch.append(job)
+                self._run_batch(db, batch)
+                if stopping:
+                    break
+        finally:
+            db.close()
+
+    def _run_batch(self, db: _BatchSession, batch):
+        done = []
+        db.in_batch = True
+        try:
+            for fn, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                db.job_savepoint = None
+                try:
+                    # The first savepoint begins the transaction, which can
+                    # fail with "database is locked"; that fails this job
+                    db.job_savepoint = db.begin_nested()
+                    result = fn(db, *args, **kwargs)
+                    if db.job_savepoint.is_active:
+                        db.job_savepoint.commit()
+                    done.append((future, result))
+                except BaseException as exc:
+                    if db.job_savepoint is not None and db.job_savepoint.is_active:
+                        db.job_savepoint.rollback()
+                    future.set_exception(exc)
+            db.job_savepoint = None
+            db.in_batch = False
+            db.commit()
+        except Exception as exc:
+            logger.exception("Group commit of %s jobs failed", len(batch))
+            db.job_savepoint = None
+            db.in_batch = False
+            db.rollback()
+            # Every job not answered yet, including those the group never got to
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        finally:
+            # Results leave this thread; detach them so nobody lazy-loads
+            # through the writer's connection from another thread.
+            db.expunge_all()
+
+        self.batches += 1
+        self.jobs_done += len(done)
+        for future, result in done:
+            future.set_result(result)
+
+writer = DatabaseWriter()
@@ -0,0 +1,123 @@
+"""
+Version counters, strong ETags and conditional GETs for small, hot reads.
+
+Clients refetch the server list, a server, its channels and its roles on
+nearly every navigation, and those almost never change in between. Each of
+them has an in-memory version counter; crud mutators ``touch()`` the
+resources they change and the counters are bumped once the transaction has
+committed (a rolled back transaction bumps nothing). The ETag of a response
+is derived from the versions it depends on plus a per-process epoch, so it
+never matches a tag handed out before a restart.
+
+Endpoints call ``not_modified()`` before loading anything: when the request's
+``If-None-Match`` holds the current tag, the 304 is sent straight away, with
+no ORM query and no serialization; otherwise the tag and the route's
+``Cache-Control`` policy (``config.CACHE_CONTROL``) go on the full response.
+Reading the version before the data means a tag can be older than the body
+it is sent with, never newer, so a client can't keep a stale copy past a
+change.
+"""
+import hashlib
+import secrets
+import threading
+from typing import Optional
+
+from fastapi import Request, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import config
+
+EPOCH = secrets.token_hex(4)
+
+# Resource keys
+ALL_SERVERS = ("servers",)  # any server's own fields; part of every server list
+
+def server(server_id: int) -> tuple:
+    return ("server", server_id)
+
+def server_channels(server_id: int) -> tuple:
+    return ("channels", server_id)
+
+def server_roles(server_id: int) -> tuple:
+    return ("roles", server_id)
+
+def user_servers(user_id: int) -> tuple:
+    return ("user_servers", user_id)
+
+class VersionCounters:
+    def __init__(self):
+        self._versions: dict = {}
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.not_modified = 0
+
+    def get(self, key: tuple) -> int:
+        return self._versions.get(key, 0)
+
+    def bump(self, keys):
+        with self._lock:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            "epoch": EPOCH,
+            "resources": len(self._versions),
+            "checks": self.checks,
+            "not_modified": self.not_modified,
+        }
+
+versions = VersionCounters()
+
+def etag(*keys: tuple) -> str:
+    """Strong ETag for a response built from the given resources."""
+    state = repr([(key, versions.get(key)) for key in keys]).encode()
+    return f'"{EPOCH}-{hashlib.blake2b(state, digest_size=8).hexdigest()}"'
+
+def _matches(if_none_match: Optional[str], tag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so W/"x" matches "x"
+    return any(
+        candidate.strip().removeprefix("W/") == tag
+        for candidate in if_none_match.split(",")
+    )
+
+def not_modified(request: Request, response: Response, *keys: tuple, policy: str) -> Optional[Response]:
+    """
+    The 304 to return if the client's copy of ``keys`` is current, else None
+    after putting ETag and Cache-Control on ``response``. Call it before
+    querying the data.
+    """
+    tag = etag(*keys)
+    headers = {
+        "ETag": tag,
+        "Cache-Control": config.CACHE_CONTROL[policy],
+        "Vary": "Authorization",
+    }
+    versions.checks += 1
+    if _matches(request.headers.get("if-none-match"), tag):
+        versions.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# Bumping: crud records keys on the session, they're applied after commit
+_TOUCHED_KEY = "touched_versions"
+
+def touch(db: Session, *keys: tuple):
+    """Mark resources as changed; their versions are bumped when ``db`` commits."""
+    db.info.setdefault(_TOUCHED_KEY, set()).update(keys)
+
+@event.listens_for(Session, "after_commit")
+def _bump_touched(session: Session):
+    keys = session.info.pop(_TOUCHED_KEY, None)
+    if keys:
+        versions.bump(keys)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_touched(session: Session):
+    session.info.pop(_TOUCHED_KEY, None)
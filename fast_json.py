@@ -0,0 +1,91 @@
+"""
+Fast JSON path for list endpoints.
+
+With a ``response_model``, FastAPI validates the returned ORM objects against
+the schema, serializes the validated models back to Python objects and
+encodes those with the json module: three passes over every row, mostly in
+Python. For pages of 100 rows that is most of a request's CPU time.
+
+The fast path makes one pass. For flat schemas, ``project()`` maps the
+fields onto table columns, so the query returns plain rows in the schema's
+shape instead of ORM objects. Those rows were validated when they were
+written, so they are encoded as they are, with no pydantic at all. Nested
+schemas (messages with their author and reactions) still load ORM objects;
+a ``TypeAdapter(List[Schema])`` built once at import validates them and
+writes the JSON bytes inside pydantic-core. The bytes are sent as they are.
+The body is the same as the response_model path's, and routes keep their
+``response_model`` for the OpenAPI docs.
+
+``JSONResponse`` is the response class of these routes. Bytes pass through,
+anything else (the ``FAST_JSON_ENABLED = False`` path) is encoded with
+orjson when it's installed, and with the json module otherwise.
+
+``benchmarks/serialization.py`` compares the two paths per endpoint.
+"""
+import json
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import literal
+from sqlalchemy.engine import Row
+from starlette.responses import JSONResponse as _StarletteJSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(content) -> bytes:
+    """Compact UTF-8 JSON, with orjson when it's installed."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+class JSONResponse(_StarletteJSONResponse):
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+class ListSerializer:
+    """Rows to the JSON bytes of ``List[schema]``."""
+
+    def __init__(self, schema: type):
+        self.schema = schema
+        self.fields = tuple(schema.model_fields)
+        self.adapter = TypeAdapter(List[schema])
+
+    def dump(self, rows) -> bytes:
+        """
+        Projected rows (see project()) are already in the schema's shape and
+        are encoded directly; ORM objects go through the TypeAdapter.
+        """
+        if rows and isinstance(rows[0], Row):
+            return dumps([dict(zip(self.fields, row)) for row in rows])
+        return self.adapter.dump_json(self.adapter.validate_python(rows, from_attributes=True))
+
+    def response(self, rows, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+        return JSONResponse(self.dump(rows), headers=headers)
+
+def project(schema: type, model) -> list:
+    """
+    The ``model`` columns behind each field of a flat ``schema``, in field
+    order. Fields the model doesn't have select their (scalar) default.
+    """
+    columns = []
+    for name, field in schema.model_fields.items():
+        if isinstance(field.annotation, type) and issubclass(field.annotation, BaseModel):
+            raise TypeError(f"{schema.__name__}.{name} is nested; load ORM objects instead")
+        column = getattr(model, field.validation_alias or name, None)
+        if column is None:
+            if field.is_required() or isinstance(field.default, (list, dict)):
+                raise TypeError(f"{model.__name__} has no column for {schema.__name__}.{name}")
+            column = literal(field.default).label(name)
+        columns.append(column)
+    return columns
@@ -1,1684 +1,1892 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, UploadFile, File, WebSocket, WebSocketDisconnect, Form
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any
-import uvicorn
-from datetime import datetime, timedelta
-import json
-from jose import JWTError, jwt
-import socket
-import base64
-import websockets
-import os
-import shutil
-import uuid
-import asyncio
-import time
-import httpx
-import subprocess
-
-from database import *
-import models as models
-import schemas as schemas
-import auth as auth
-import crud as crud
-import config
-from audio_handler import audio_handler
-
-# In-memory storage for music queues and playback state
-# Structure: { channel_id: { 'queue': [{id, url, title, artist, duration}, ...], 'current_index': int, 'is_playing': bool, 'current_time': float } }
-music_players: Dict[int, Dict[str, Any]] = {}
-
-# Import User model explicitly
-from models import User, Channel, ServerMember, Message
-
-# Create database tables
-try:
-    # Only create tables if they don't exist
-    models.Base.metadata.create_all(bind=engine)
-    print("Database tables created successfully")
-except Exception as e:
-    print(f"Error creating database tables: {e}")
-
-app = FastAPI(title="Dump API")
-
-# Настройка CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "http://localhost:3000",
-        "http://localhost:3001",
-        "http://localhost:3002",
-        "http://127.0.0.1:3000",
-        "http://127.0.0.1:3001",
-        "http://127.0.0.1:3002",
-        "http://26.34.237.219:3000",
-        "https://26.34.237.219:3000",
-        "https://26.34.237.219:3001",
-        "https://26.34.237.219:3002",
-        "https://26.34.237.219:8000",
-    ],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-    expose_headers=["*"],
-    max_age=3600
-)
-
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
-
-manager = ConnectionManager()
-
-# Voice channel WebSocket connection manager
-class VoiceChannelManager:
-    def __init__(self):
-        self.voice_channels = {}  # channel_id -> set of user_ids
-        self.user_channels = {}   # user_id -> channel_id
-        self.audio_streams = {}   # (channel_id, user_id) -> {'input': stream, 'output': stream}
-        self.user_websockets = {} # user_id -> websocket
-        self.connection_locks = {} # channel_id -> asyncio.Lock
-        self._cleanup_task = None
-        self.user_states = {}     # user_id -> {'isMuted': bool, 'isDeafened': bool}
-
-    async def _start_cleanup_task(self):
-        """Запускает периодическую очистку неактивных соединений"""
-        if self._cleanup_task is None:
-            self._cleanup_task = asyncio.create_task(self._cleanup_inactive_connections())
-
-    async def _cleanup_inactive_connections(self):
-        """Периодически проверяет и очищает неактивные соединения"""
-        while True:
-            try:
-                await asyncio.sleep(300)  # Проверка каждые 5 минут
-                current_time = datetime.now()
-                
-                # Очистка неактивных WebSocket соединений
-                for user_id, websocket in list(self.user_websockets.items()):
-                    if not websocket.client_state.CONNECTED:
-                        await self.disconnect_user(user_id)
-                
-                # Очистка неиспользуемых аудио потоков
-                for stream_id, streams in list(self.audio_streams.items()):
-                    channel_id, user_id = stream_id
-                    if user_id not in self.user_websockets:
-                        audio_handler.close_stream(stream_id)
-                        del self.audio_streams[stream_id]
-            except Exception as e:
-                print(f"Error in cleanup task: {e}")
-
-    async def connect_user(self, websocket, channel_id, user_id):
-        try:
-            print(f"[VOICE] Attempting to connect user {user_id} to channel {channel_id}")
-            
-            # Получаем или создаем блокировку для канала
-            if channel_id not in self.connection_locks:
-                self.connection_locks[channel_id] = asyncio.Lock()
-            
-            async with self.connection_locks[channel_id]:
-                if channel_id not in self.voice_channels:
-                    self.voice_channels[channel_id] = set()
-                
-                # Проверяем, не подключен ли уже пользователь
-                if user_id in self.user_channels:
-                    old_channel_id = self.user_channels[user_id]
-                    if old_channel_id != channel_id:
-                        print(f"[VOICE] User {user_id} was in channel {old_channel_id}, disconnecting")
-                        await self.disconnect_user(user_id)
-                
-                # Добавляем пользователя в канал
-                self.voice_channels[channel_id].add(user_id)
-                self.user_channels[user_id] = channel_id
-                self.user_websockets[user_id] = websocket
-                
-                # Инициализируем состояние пользователя
-                self.user_states[user_id] = {
-                    'isMuted': False,
-                    'isDeafened': False,
-                    'isVideoEnabled': False,
-                    'isScreenSharing': False
-                }
-                
-                # Создаем аудио потоки
-                input_stream = audio_handler.create_input_stream((channel_id, user_id))
-                output_stream = audio_handler.create_output_stream((channel_id, user_id))
-                
-                if input_stream and output_stream:
-                    self.audio_streams[(channel_id, user_id)] = {
-                        'input': input_stream,
-                        'output': output_stream
-                    }
-                    print(f"[VOICE] Audio streams created for user {user_id} in channel {channel_id}")
-                else:
-                    raise RuntimeError("Failed to create audio streams")
-                
-                # Запускаем задачу очистки, если она еще не запущена
-                await self._start_cleanup_task()
-                
-                # Уведомляем других участников
-                await self.broadcast_user_joined(channel_id, user_id)
-                
-                # Отправляем список участников всем пользователям в канале
-                await self.send_participants_list(channel_id)
-                
-                print(f"[VOICE] User {user_id} successfully connected to channel {channel_id}")
-                
-                try:
-                    while True:
-                        try:
-                            data = await websocket.receive()
-                        except WebSocketDisconnect:
-                            print(f"[VOICE] User {user_id} disconnected")
-                            break
-                        except Exception as e:
-                            print(f"[VOICE] Exception in receive: {e}")
-                            break
-                            
-                        if data['type'] == 'websocket.disconnect':
-                            print(f"[VOICE] Disconnect received for user {user_id}")
-                            break
-                            
-                        if 'text' in data:
-                            try:
-                                msg = data['text']
-                                parsed = json.loads(msg)
-                                
-                                if parsed['type'] == 'audio':
-                                    print(f"[VOICE] Received audio from user {user_id}")
-                                    await self.handle_audio_data(channel_id, user_id, parsed['data'])
-                                elif parsed['type'] == 'video':
-                                    await self.broadcast_video(channel_id, user_id, parsed['data'])
-                                elif parsed['type'] == 'screen':
-                                    await self.broadcast_screen(channel_id, user_id, parsed['data'])
-                                elif parsed['type'] == 'state_update':
-                                    # Обновляем состояние пользователя
-                                    if user_id in self.user_states:
-                                        self.user_states[user_id].update(parsed.get('state', {}))
-                                        # Уведомляем других участников об изменении состояния
-                                        await self.broadcast_user_state(channel_id, user_id)
-                                elif parsed['type'] == 'join':
-                                    await self.send_participants_list(channel_id)
-                            except json.JSONDecodeError as e:
-                                print(f"Error decoding message from user {user_id}: {e}")
-                            except Exception as e:
-                                print(f"Error processing message from user {user_id}: {e}")
-                finally:
-                    await self.disconnect_user(user_id)
-        except Exception as e:
-            print(f"Error in connect_user: {e}")
-            await self.disconnect_user(user_id)
-            raise
-
-    async def disconnect_user(self, user_id):
-        try:
-            if user_id in self.user_channels:
-                channel_id = self.user_channels[user_id]
-                
-                # Удаляем пользователя из канала
-                if channel_id in self.voice_channels:
-                    self.voice_channels[channel_id].discard(user_id)
-                    if not self.voice_channels[channel_id]:
-                        del self.voice_channels[channel_id]
-                
-                # Закрываем аудио потоки
-                stream_id = (channel_id, user_id)
-                if stream_id in self.audio_streams:
-                    audio_handler.close_stream(stream_id)
-                    del self.audio_streams[stream_id]
-                
-                # Удаляем WebSocket соединение
-                if user_id in self.user_websockets:
-                    del self.user_websockets[user_id]
-                
-                # Удаляем информацию о канале пользователя
-                del self.user_channels[user_id]
-                
-                # Уведомляем других участников
-                await self.broadcast_user_left(channel_id, user_id)
-                await self.send_participants_list(channel_id)
-        except Exception as e:
-            print(f"Error in disconnect_user: {e}")
-
-    async def handle_audio_data(self, channel_id, sender_id, audio_data):
-        if channel_id in self.voice_channels:
-            for user_id in self.voice_channels[channel_id]:
-                if user_id != sender_id:
-                    try:
-                        websocket = self.user_websockets.get(user_id)
-                        if websocket and websocket.client_state.CONNECTED:
-                            # Проверяем, что аудио данные не пустые
-                            if not audio_data:
-                                print(f"Empty audio data from user {sender_id}")
-                                continue
-
-                            # Отправляем аудио данные
-                            await websocket.send_json({
-                                'type': 'audio',
-                                'sender_id': sender_id,
-                                'data': audio_data,
-                                'channel_id': channel_id,
-                                'timestamp': datetime.now().timestamp()
-                            })
-                            
-                            # Воспроизводим аудио локально
-                            stream_id = (channel_id, user_id)
-                            if stream_id in self.audio_streams:
-                                audio_handler.play_audio(stream_id, audio_data)
-                    except Exception as e:
-                        print(f"Error sending audio to user {user_id}: {e}")
-                        # Если не удалось отправить аудио, отключаем пользователя
-                        await self.disconnect_user(user_id)
-
-    async def broadcast_user_joined(self, channel_id, user_id):
-        if channel_id in self.voice_channels:
-            state = self.user_states.get(user_id, {})
-            message = {
-                'type': 'participant_joined',
-                'participant': {
-                    'id': user_id,
-                    'isMuted': state.get('isMuted', False),
-                    'isDeafened': state.get('isDeafened', False),
-                    'isVideoEnabled': state.get('isVideoEnabled', False),
-                    'isScreenSharing': state.get('isScreenSharing', False)
-                },
-                'channel_id': channel_id
-            }
-            print(f"[VOICE] Broadcasting user {user_id} joined to channel {channel_id}")
-            await self.broadcast_to_channel(channel_id, message)
-
-    async def broadcast_user_left(self, channel_id, user_id):
-        if channel_id in self.voice_channels:
-            message = {
-                'type': 'participant_left',
-                'userId': user_id
-            }
-            await self.broadcast_to_channel(channel_id, message)
-
-    async def broadcast_to_channel(self, channel_id, message):
-        if channel_id in self.voice_channels:
-            for user_id in self.voice_channels[channel_id]:
-                try:
-                    websocket = self.user_websockets.get(user_id)
-                    if websocket:
-                        await websocket.send_json(message)
-                except Exception as e:
-                    print(f"Error broadcasting to user {user_id}: {e}")
-                    # Если не удалось отправить сообщение, отключаем пользователя
-                    await self.disconnect_user(user_id)
-
-    async def broadcast_video(self, channel_id, sender_id, video_data):
-        if channel_id in self.voice_channels:
-            message = {
-                'type': 'video',
-                'sender_id': sender_id,
-                'data': video_data
-            }
-            await self.broadcast_to_channel(channel_id, message)
-
-    async def broadcast_screen(self, channel_id, sender_id, screen_data):
-        if channel_id in self.voice_channels:
-            message = {
-                'type': 'screen',
-                'sender_id': sender_id,
-                'data': screen_data
-            }
-            await self.broadcast_to_channel(channel_id, message)
-
-    async def broadcast_user_state(self, channel_id, user_id):
-        if channel_id in self.voice_channels:
-            state = self.user_states.get(user_id, {})
-            message = {
-                'type': 'participant_state',
-                'participant': {
-                    'id': user_id,
-                    'isMuted': state.get('isMuted', False),
-                    'isDeafened': state.get('isDeafened', False),
-                    'isVideoEnabled': state.get('isVideoEnabled', False),
-                    'isScreenSharing': state.get('isScreenSharing', False)
-                },
-                'channel_id': channel_id
-            }
-            await self.broadcast_to_channel(channel_id, message)
-
-    def cleanup(self):
-        # Clean up all audio streams
-        for stream_key in list(self.audio_streams.keys()):
-            try:
-                if 'input' in self.audio_streams[stream_key]:
-                    self.audio_streams[stream_key]['input'].stop_stream()
-                    self.audio_streams[stream_key]['input'].close()
-                if 'output' in self.audio_streams[stream_key]:
-                    self.audio_streams[stream_key]['output'].stop_stream()
-                    self.audio_streams[stream_key]['output'].close()
-            except Exception as e:
-                print(f"Error cleaning up audio stream {stream_key}: {e}")
-        self.audio_streams.clear()
-        audio_handler.cleanup()
-
-    async def send_participants_list(self, channel_id):
-        if channel_id in self.voice_channels:
-            participants = []
-            for user_id in self.voice_channels[channel_id]:
-                state = self.user_states.get(user_id, {})
-                participants.append({
-                    'id': user_id,
-                    'isMuted': state.get('isMuted', False),
-                    'isDeafened': state.get('isDeafened', False),
-                    'isVideoEnabled': state.get('isVideoEnabled', False),
-                    'isScreenSharing': state.get('isScreenSharing', False)
-                })
-            
-            message = {
-                'type': 'participants',
-                'participants': participants,
-                'channel_id': channel_id
-            }
-            
-            print(f"[VOICE] Sending participants list for channel {channel_id}: {participants}")
-            await self.broadcast_to_channel(channel_id, message)
-
-voice_manager = VoiceChannelManager()
-
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
-    try:
-        while True:
-            data = await websocket.receive_text()
-            # Handle incoming WebSocket messages here
-            await manager.broadcast(f"Message: {data}")
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        await manager.broadcast("Client disconnected")
-
-@app.websocket("/ws/voice/{channel_id}")
-async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: str):
-    user = None
-    db = None
-    try:
-        print(f"[{datetime.now()}] WebSocket connection attempt for channel {channel_id}")
-        
-        # Decode token and get user
-        try:
-            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-            user_email = payload.get("sub")
-            if not user_email:
-                print(f"[{datetime.now()}] Invalid token - no user email")
-                await websocket.close(code=4000, reason="Invalid token")
-                return
-        except jwt.ExpiredSignatureError:
-            print(f"[{datetime.now()}] Token expired, attempting to refresh")
-            # Try to refresh the token
-            try:
-                db = SessionLocal()
-                user = db.query(User).filter(User.email == payload.get("sub")).first()
-                if user:
-                    # Create new token
-                    access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
-                    new_token = auth.create_access_token(
-                        data={"sub": user.email}, expires_delta=access_token_expires
-                    )
-                    # Update last login
-                    user.last_login = datetime.now()
-                    db.commit()
-                    # Send new token to client
-                    await websocket.accept()
-                    await websocket.send_json({
-                        "type": "token_refresh",
-                        "token": new_token
-                    })
-                    token = new_token
-                else:
-                    await websocket.close(code=4000, reason="User not found")
-                    return
-            except Exception as e:
-                print(f"[{datetime.now()}] Error refreshing token: {str(e)}")
-                await websocket.close(code=4000, reason="Token refresh failed")
-                return
-        except jwt.JWTError as e:
-            print(f"[{datetime.now()}] JWT decode error: {str(e)}")
-            await websocket.close(code=4000, reason="Invalid token")
-            return
-
-        # Get user from database
-        if not db:
-            db = SessionLocal()
-        try:
-            user = db.query(User).filter(User.email == user_email).first()
-            if not user:
-                print(f"[{datetime.now()}] User not found for email: {user_email}")
-                await websocket.close(code=4000, reason="User not found")
-                return
-
-            # Get channel and verify user is a member
-            channel = db.query(Channel).filter(Channel.id == channel_id).first()
-            if not channel:
-                print(f"[{datetime.now()}] Channel not found: {channel_id}")
-                await websocket.close(code=4000, reason="Channel not found")
-                return
-
-            # Check if user is a member of the server
-            membership = db.query(ServerMember).filter(
-                ServerMember.server_id == channel.server_id,
-                ServerMember.user_id == user.id
-            ).first()
-            
-            if not membership:
-                print(f"[{datetime.now()}] User {user.id} is not a member of server {channel.server_id}")
-                await websocket.close(code=4000, reason="Not a member of this server")
-                return
-
-            # Accept the WebSocket connection
-            await websocket.accept()
-            print(f"[{datetime.now()}] User {user.username} connected to voice channel {channel_id}")
-
-            # Send initial connection success message
-            try:
-                await websocket.send_json({
-                    "type": "connection_status",
-                    "status": "connected",
-                    "message": "Successfully connected to voice channel"
-                })
-                print(f"[{datetime.now()}] Sent initial connection status to user {user.username}")
-            except Exception as e:
-                print(f"[{datetime.now()}] Error sending initial status: {str(e)}")
-                return
-
-            # Main message handling loop
-            while True:
-                try:
-                    data = await websocket.receive()
-                    print(f"[{datetime.now()}] Received data from user {user.username}: {data['type']}")
-                    
-                    if data["type"] == "websocket.disconnect":
-                        print(f"[{datetime.now()}] WebSocket disconnected for user {user.username}")
-                        break
-                        
-                    if data["type"] == "websocket.receive":
-                        if "text" in data:
-                            message = json.loads(data["text"])
-                            print(f"[{datetime.now()}] Received message from user {user.username}: {message}")
-                            
-                            # Handle different message types
-                            if message.get("type") == "join":
-                                print(f"[{datetime.now()}] User {user.username} joining voice channel")
-                                # Add user to voice channel participants
-                                await voice_manager.connect_user(websocket, channel_id, user.id)
-                                break
-                            elif message.get("type") == "leave":
-                                print(f"[{datetime.now()}] User {user.username} leaving voice channel")
-                                # Remove user from voice channel participants
-                                await voice_manager.disconnect_user(user.id)
-                                break
-                            elif message.get("type") == "audio":
-                                # Обработка аудио данных
-                                audio_data = message.get("data")
-                                if audio_data:
-                                    await voice_manager.handle_audio_data(channel_id, user.id, audio_data)
-                            elif message.get("type") == "ping":
-                                # Respond to ping with pong
-                                try:
-                                    await websocket.send_json({"type": "pong"})
-                                    print(f"[{datetime.now()}] Sent pong response to user {user.username}")
-                                except Exception as e:
-                                    print(f"[{datetime.now()}] Error sending pong: {str(e)}")
-                                    break
-                            else:
-                                # Echo the message back to the sender
-                                try:
-                                    await websocket.send_json({
-                                        "type": "echo",
-                                        "original_message": message
-                                    })
-                                except Exception as e:
-                                    print(f"[{datetime.now()}] Error echoing message: {str(e)}")
-                                    break
-                                
-                        elif "bytes" in data:
-                            # Handle binary audio data
-                            audio_data = data["bytes"]
-                            print(f"[{datetime.now()}] Received binary audio data from user {user.username}: {len(audio_data)} bytes")
-                            
-                            # Отправляем аудио другим пользователям
-                            await voice_manager.handle_audio_data(channel_id, user.id, audio_data)
-
-                except WebSocketDisconnect:
-                    print(f"[{datetime.now()}] WebSocket disconnected for user {user.username}")
-                    break
-                except Exception as e:
-                    print(f"[{datetime.now()}] Error processing message: {str(e)}")
-                    # Don't break the connection on general errors
-                    continue
-
-        except Exception as e:
-            print(f"[{datetime.now()}] Database error: {str(e)}")
-            try:
-                await websocket.close(code=4000, reason="Database error")
-            except Exception:
-                pass
-            return
-
-    except Exception as e:
-        print(f"[{datetime.now()}] Error in voice channel: {str(e)}")
-        try:
-            await websocket.close(code=4000, reason="Internal server error")
-        except Exception:
-            pass
-    finally:
-        # Clean up resources
-        if user and channel_id:
-            print(f"[{datetime.now()}] Cleaning up resources for user {user.username}")
-            await voice_manager.disconnect_user(user.id)
-        if db:
-            db.close()
-
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
-@app.post("/token")
-async def login_for_access_token(
-    request: Request,
-    form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
-):
-    try:
-        # Get client IP
-        client_ip = request.client.host
-        print(f"Login attempt from IP: {client_ip}")
-
-        # Debug logging
-        print(f"Login attempt for email: {form_data.username}")
-        print(f"Password received: {form_data.password}")
-        print(f"Password length: {len(form_data.password)}")
-        print(f"Password bytes: {[ord(c) for c in form_data.password]}")
-
-        # Get user and verify password
-        user = crud.get_user_by_email(db, form_data.username)
-        if not user:
-            print(f"User not found: {form_data.username}")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Incorrect email or password"
-            )
-
-        if not auth.verify_password(form_data.password, user.hashed_password):
-            print(f"Invalid password for user: {form_data.username}")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Incorrect email or password"
-            )
-
-        # Create access token
-        access_token = auth.create_access_token(data={"sub": user.email})
-        print(f"Login successful for user: {form_data.username}")
-
-        # Log successful attempt
-        crud.log_login_attempt(db, client_ip, True)
-
-        return {
-            "access_token": access_token,
-            "token_type": "bearer",
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "username": user.username,
-                "is_active": user.is_active
-            }
-        }
-    except HTTPException as he:
-        # Log failed attempt
-        crud.log_login_attempt(db, request.client.host, False)
-        raise he
-    except Exception as e:
-        print(f"Login error: {str(e)}")
-        crud.log_login_attempt(db, request.client.host, False)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="An error occurred during login"
-        )
-
-@app.post("/token/refresh")
-async def refresh_token(
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    try:
-        # Create new access token
-        access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = auth.create_access_token(
-            data={"sub": current_user.email}, expires_delta=access_token_expires
-        )
-        
-        # Update last login time
-        current_user.last_login = datetime.now()
-        db.commit()
-        
-        return {"access_token": access_token, "token_type": "bearer"}
-    except Exception as e:
-        print(f"Error refreshing token: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not refresh token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-
-@app.post("/users/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    print(f"Registration attempt for email: {user.email}")
-    print(f"Username: {user.username}")
-    print(f"Password length: {len(user.password)}")
-    
-    # Check if email is already registered
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
-        print(f"Email already registered: {user.email}")
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    # Check if username is already taken
-    db_user = crud.get_user_by_username(db, username=user.username)
-    if db_user:
-        print(f"Username already taken: {user.username}")
-        raise HTTPException(status_code=400, detail="Username already taken")
-    
-    print("Creating new user...")
-    new_user = crud.create_user(db=db, user=user)
-    print(f"User created successfully: id={new_user.id}, email={new_user.email}, username={new_user.username}")
-    return new_user
-
-@app.get("/users/me/", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
-    return current_user
-
-@app.put("/users/me/", response_model=schemas.User)
-def update_user_me(
-    user: schemas.UserUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    return crud.update_user(db=db, user_id=current_user.id, user=user)
-
-@app.get("/users/me/login-history/", response_model=List[schemas.LoginHistory])
-def read_login_history(
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 100
-):
-    return crud.get_login_history(db=db, user_id=current_user.id, skip=skip, limit=limit)
-
-@app.post("/servers/", response_model=schemas.Server)
-def create_server(
-    server: schemas.ServerCreate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    return crud.create_server(db=db, server=server, owner_id=current_user.id)
-
-@app.get("/servers/", response_model=List[schemas.Server])
-def read_servers(
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 100
-):
-    return crud.get_user_servers(db=db, user_id=current_user.id)
-
-@app.get("/servers/{server_id}", response_model=schemas.Server)
-def read_server(
-    server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    return db_server
-
-@app.put("/servers/{server_id}", response_model=schemas.Server)
-def update_server(
-    server_id: int,
-    server: schemas.ServerUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    updated_server = crud.update_server(db=db, server_id=server_id, server=server)
-    crud.create_audit_log(
-        db=db,
-        server_id=server_id,
-        user_id=current_user.id,
-        action="update_server",
-        target_type="server",
-        target_id=server_id,
-        changes=server.dict(exclude_unset=True)
-    )
-    return updated_server
-
-@app.delete("/servers/{server_id}")
-def delete_server(
-    server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    crud.create_audit_log(
-        db=db,
-        server_id=server_id,
-        user_id=current_user.id,
-        action="delete_server",
-        target_type="server",
-        target_id=server_id,
-        changes={}
-    )
-    return crud.delete_server(db=db, server_id=server_id)
-
-@app.post("/servers/{server_id}/roles/", response_model=schemas.Role)
-def create_role(
-    server_id: int,
-    role: schemas.RoleCreate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    created_role = crud.create_role(db=db, role=role, server_id=server_id)
-    crud.create_audit_log(
-        db=db,
-        server_id=server_id,
-        user_id=current_user.id,
-        action="create_role",
-        target_type="role",
-        target_id=created_role.id,
-        changes=role.dict()
-    )
-    return created_role
-
-@app.get("/servers/{server_id}/roles/", response_model=List[schemas.Role])
-def read_roles(
-    server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    return crud.get_server_roles(db=db, server_id=server_id)
-
-@app.put("/roles/{role_id}", response_model=schemas.Role)
-def update_role(
-    role_id: int,
-    role: schemas.RoleUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_role = crud.get_role(db=db, role_id=role_id)
-    if db_role is None:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_role.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    updated_role = crud.update_role(db=db, role_id=role_id, role=role)
-    crud.create_audit_log(
-        db=db,
-        server_id=db_role.server_id,
-        user_id=current_user.id,
-        action="update_role",
-        target_type="role",
-        target_id=role_id,
-        changes=role.dict(exclude_unset=True)
-    )
-    return updated_role
-
-@app.delete("/roles/{role_id}")
-def delete_role(
-    role_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_role = crud.get_role(db=db, role_id=role_id)
-    if db_role is None:
-        raise HTTPException(status_code=404, detail="Role not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_role.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    crud.create_audit_log(
-        db=db,
-        server_id=db_role.server_id,
-        user_id=current_user.id,
-        action="delete_role",
-        target_type="role",
-        target_id=role_id,
-        changes={}
-    )
-    return crud.delete_role(db=db, role_id=role_id)
-
-@app.post("/servers/{server_id}/channels/", response_model=schemas.Channel)
-def create_channel(
-    server_id: int,
-    channel: schemas.ChannelCreate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    created_channel = crud.create_channel(db=db, channel=channel, server_id=server_id)
-    crud.create_audit_log(
-        db=db,
-        server_id=server_id,
-        user_id=current_user.id,
-        action="create_channel",
-        target_type="channel",
-        target_id=created_channel.id,
-        changes=channel.dict()
-    )
-    return created_channel
-
-@app.get("/servers/{server_id}/channels/", response_model=List[schemas.Channel])
-def read_channels(
-    server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    return crud.get_server_channels(db=db, server_id=server_id)
-
-@app.put("/channels/{channel_id}", response_model=schemas.Channel)
-def update_channel(
-    channel_id: int,
-    channel: schemas.ChannelUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_channel.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    updated_channel = crud.update_channel(db=db, channel_id=channel_id, channel=channel)
-    crud.create_audit_log(
-        db=db,
-        server_id=db_channel.server_id,
-        user_id=current_user.id,
-        action="update_channel",
-        target_type="channel",
-        target_id=channel_id,
-        changes=channel.dict(exclude_unset=True)
-    )
-    return updated_channel
-
-@app.delete("/channels/{channel_id}")
-def delete_channel(
-    channel_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    db_server = crud.get_server(db=db, server_id=db_channel.server_id)
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
-    crud.create_audit_log(
-        db=db,
-        server_id=db_channel.server_id,
-        user_id=current_user.id,
-        action="delete_channel",
-        target_type="channel",
-        target_id=channel_id,
-        changes={}
-    )
-    return crud.delete_channel(db=db, channel_id=channel_id)
-
-@app.post("/channels/{channel_id}/messages", response_model=schemas.Message)
-async def create_message(
-    channel_id: int,
-    content: Optional[str] = Form(None),
-    file: Optional[UploadFile] = File(None),
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    # Check if channel exists
-    db_channel = crud.get_channel(db, channel_id)
-    if not db_channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    media_url = None
-    media_type = None
-
-    if file:
-        # Create media directory if it doesn't exist
-        os.makedirs("media", exist_ok=True)
-        
-        # Generate unique filename
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join("media", unique_filename)
-        
-        # Save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Determine media type
-        content_type = file.content_type
-        if content_type.startswith('image/'):
-            media_type = 'image'
-        elif content_type.startswith('video/'):
-            media_type = 'video'
-        elif content_type.startswith('audio/'):
-            media_type = 'audio'
-        else:
-            media_type = 'file'
-        
-        media_url = f"/media/{unique_filename}"
-    else:
-        media_type = 'text'
-
-    # Create message
-    message_data = schemas.MessageCreate(
-        content=content,
-        media_url=media_url,
-        media_type=media_type
-    )
-    
-    # Create the message in the database
-    db_message = crud.create_message(
-        db=db,
-        message=message_data,
-        author_id=current_user.id,
-        channel_id=channel_id
-    )
-    
-    # Get the full message with author information
-    return db.query(models.Message).filter(models.Message.id == db_message.id).first()
-
-@app.get("/channels/{channel_id}/messages/", response_model=List[schemas.Message])
-def read_messages(
-    channel_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 100
-):
-    db_channel = crud.get_channel(db=db, channel_id=channel_id)
-    if db_channel is None:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    return crud.get_channel_messages(db=db, channel_id=channel_id, skip=skip, limit=limit)
-
-@app.put("/messages/{message_id}", response_model=schemas.Message)
-def update_message(
-    message_id: int,
-    message: schemas.MessageUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_message = crud.get_message(db=db, message_id=message_id)
-    if db_message is None:
-        raise HTTPException(status_code=404, detail="Message not found")
-    if db_message.author_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.update_message(db=db, message_id=message_id, message=message)
-
-@app.delete("/messages/{message_id}")
-def delete_message(
-    message_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_message = crud.get_message(db=db, message_id=message_id)
-    if db_message is None:
-        raise HTTPException(status_code=404, detail="Message not found")
-    if db_message.author_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.delete_message(db=db, message_id=message_id)
-
-@app.post("/messages/{message_id}/reactions/{emoji}")
-def add_reaction(
-    message_id: int,
-    emoji: str,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_message = crud.get_message(db=db, message_id=message_id)
-    if db_message is None:
-        raise HTTPException(status_code=404, detail="Message not found")
-    return crud.add_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
-
-@app.delete("/messages/{message_id}/reactions/{emoji}")
-def remove_reaction(
-    message_id: int,
-    emoji: str,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    db_message = crud.get_message(db=db, message_id=message_id)
-    if db_message is None:
-        raise HTTPException(status_code=404, detail="Message not found")
-    return crud.remove_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
-
-@app.get("/servers/{server_id}/audit-logs/", response_model=List[schemas.AuditLog])
-def read_audit_logs(
-    server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 100
-):
-    db_server = crud.get_server(db=db, server_id=server_id)
-    if db_server is None:
-        raise HTTPException(status_code=404, detail="Server not found")
-    if db_server.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.get_server_audit_logs(db=db, server_id=server_id, skip=skip, limit=limit)
-
-# Media endpoints
-@app.get("/channels/{channel_id}/messages", response_model=List[schemas.Message])
-def get_messages(
-    channel_id: int,
-    skip: int = 0,
-    limit: int = 100,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    # Check if channel exists
-    db_channel = crud.get_channel(db, channel_id)
-    if not db_channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    # Check if user is a member of the server
-    membership = db.query(models.ServerMember).filter(
-        models.ServerMember.server_id == db_channel.server_id,
-        models.ServerMember.user_id == current_user.id
-    ).first()
-    
-    if not membership:
-        raise HTTPException(status_code=403, detail="Not a member of this server")
-    
-    return crud.get_channel_messages(db=db, channel_id=channel_id, skip=skip, limit=limit)
-
-@app.post("/channels/{channel_id}/media", response_model=schemas.Message)
-async def upload_media(
-    channel_id: int,
-    file: UploadFile = File(...),
-    content: Optional[str] = None,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    # Check if channel exists
-    db_channel = crud.get_channel(db, channel_id)
-    if not db_channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    
-    # Create media directory if it doesn't exist
-    os.makedirs("media", exist_ok=True)
-    
-    # Generate unique filename
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join("media", unique_filename)
-    
-    # Save file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # Determine media type
-    content_type = file.content_type
-    if content_type.startswith('image/'):
-        media_type = 'image'
-    elif content_type.startswith('video/'):
-        media_type = 'video'
-    elif content_type.startswith('audio/'):
-        media_type = 'audio'
-    else:
-        media_type = 'file'
-    
-    media_url = f"/media/{unique_filename}"
-    
-    # Create message
-    message_data = schemas.MessageCreate(
-        content=content,
-        media_url=media_url,
-        media_type=media_type
-    )
-    
-    return crud.create_message(
-        db=db,
-        message=message_data,
-        author_id=current_user.id,
-        channel_id=channel_id
-    )
-
-@app.get("/channels/{channel_id}/media/", response_model=List[schemas.Media])
-def get_channel_media(
-    channel_id: int,
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.get_channel_media(db, channel_id, skip, limit)
-
-@app.delete("/media/{media_id}")
-def delete_media(
-    media_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.delete_media(db, media_id)
-
-# Game endpoints
-@app.post("/channels/{channel_id}/games/", response_model=schemas.GameSession)
-def create_game(
-    channel_id: int,
-    game: schemas.GameSessionCreate,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.create_game_session(db, game, current_user.id, channel_id)
-
-@app.get("/channels/{channel_id}/games/", response_model=List[schemas.GameSession])
-def get_channel_games(
-    channel_id: int,
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.get_channel_games(db, channel_id, skip, limit)
-
-@app.post("/games/{game_id}/players/", response_model=schemas.GamePlayer)
-def join_game(
-    game_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.add_game_player(db, game_id, current_user.id)
-
-@app.put("/games/{game_id}/players/{user_id}", response_model=schemas.GamePlayer)
-def update_player_status(
-    game_id: int,
-    user_id: int,
-    player_data: Dict[str, Any],
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.update_game_player(db, game_id, user_id, player_data)
-
-# Music endpoints
-@app.get("/channels/{channel_id}/music/", response_model=List[schemas.MusicQueue])
-def get_music_queue(
-    channel_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    # Return the music queue from in-memory storage
-    player_state = music_players.get(channel_id, {'queue': []})
-    # Convert internal queue format to schema for response
-    return [schemas.MusicQueue(**track) for track in player_state['queue']]
-
-@app.post("/channels/{channel_id}/music/", response_model=schemas.MusicQueue)
-def add_to_queue(
-    channel_id: int,
-    music: schemas.MusicQueueCreate,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    print(f"[BACKEND] add_to_queue called for channel {channel_id} with URL {music.url}")
-    # Add the music track to the in-memory queue
-    if channel_id not in music_players:
-        music_players[channel_id] = {'queue': [], 'current_index': -1, 'is_playing': False, 'current_time': 0.0}
-
-    # --- Извлечение информации о треке с помощью yt-dlp ---
-    try:
-        # Команда для вызова yt-dlp и получения информации в формате JSON
-        # -f bestaudio: Выбираем наилучший аудиоформат
-        # --dump-single-json: Выводит информацию о треке в формате JSON
-        command = ['yt-dlp', '-f', 'bestaudio', '--dump-single-json', music.url]
-        
-        # Запускаем yt-dlp как подпроцесс
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        
-        # Парсим JSON вывод
-        video_info = json.loads(result.stdout)
-        
-        # Извлекаем нужные данные
-        # yt-dlp может возвращать разные поля в зависимости от источника.
-        # Попробуем использовать common fields. Возможно, для VK/Яндекс потребуются корректировки.
-        extracted_url = video_info.get('url') or video_info.get('original_url') or video_info.get('http_url')
-        title = video_info.get('title', 'Unknown Title')
-        # yt-dlp не всегда предоставляет отдельное поле для исполнителя.
-        # Можно попробовать использовать uploader или комбинировать поля.
-        artist = video_info.get('artist') or video_info.get('uploader') or 'Unknown Artist'
-        duration = int(video_info.get('duration', 0) or 0)
-        
-        if not extracted_url:
-             raise ValueError("Could not extract playable URL from the provided link.")
-
-        # Используем извлеченные данные для создания объекта трека
-        track_data = {
-            'id': len(music_players[channel_id]['queue']), # Assign a simple ID
-            'channel_id': channel_id,
-            'title': title,
-            'artist': artist,
-            'url': extracted_url, # Используем извлеченную URL
-            'duration': duration,
-            'added_by_id': current_user.id,
-            'created_at': datetime.utcnow(), # Add the missing created_at field
-            'position': len(music_players[channel_id]['queue']), # Use index as position
-            'status': "queued",
-            # Можно добавить другие поля, если yt-dlp их предоставляет (например, thumbnail)
-            'image_url': video_info.get('thumbnail')
-        }
-        
-    except FileNotFoundError:
-        raise HTTPException(status_code=500, detail="yt-dlp not found. Please install it.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error calling yt-dlp: {e.stderr}")
-        raise HTTPException(status_code=400, detail=f"Could not process the link: {e.stderr.strip()}")
-    except (json.JSONDecodeError, ValueError) as e:
-        print(f"Error processing yt-dlp output or invalid data: {e}")
-        raise HTTPException(status_code=500, detail="Failed to extract music information from the link.")
-    except Exception as e:
-        print(f"An unexpected error occurred during music extraction: {e}")
-        raise HTTPException(status_code=500, detail="An internal error occurred while processing the link.")
-    # --- Конец секции yt-dlp ---
-
-    # Add the track data to the queue
-    music_players[channel_id]['queue'].append(track_data)
-
-    # If this is the first track, set it as current and start playing
-    if len(music_players[channel_id]['queue']) == 1:
-        music_players[channel_id]['current_index'] = 0
-        music_players[channel_id]['is_playing'] = True
-        music_players[channel_id]['current_time'] = 0.0
-        print(f"[BACKEND] First track added, setting is_playing to True for channel {channel_id}")
-
-    # Return the added track (simplified response model mapping)
-    # Возвращаем объект, который соответствует схеме MusicQueue
-    response_track = schemas.MusicQueue(**track_data)
-    print(f"[BACKEND] add_to_queue finished for channel {channel_id}. Queue length: {len(music_players[channel_id]['queue'])}, Current index: {music_players[channel_id]['current_index']}, is_playing: {music_players[channel_id]['is_playing']}")
-    return response_track
-
-@app.put("/music/{music_id}/status", response_model=schemas.MusicQueue)
-def update_music_status(
-    music_id: int,
-    status: str,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.update_music_status(db, music_id, status)
-
-@app.delete("/music/{music_id}")
-def remove_from_queue(
-    music_id: int,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
-):
-    return crud.remove_from_music_queue(db, music_id)
-
-@app.put("/music/{music_id}/play")
-def play_specific_track(music_id: int, channel_id: int):
-    """Set a specific track from the queue as currently playing."""
-    player_state = music_players.get(channel_id)
-    if not player_state or not player_state['queue']:
-        raise HTTPException(status_code=400, detail="Music queue is empty or channel not found")
-
-    # Find the index of the track with the given music_id
-    try:
-        track_index = next((i for i, track in enumerate(player_state['queue']) if track.get('id') == music_id), -1)
-    except StopIteration:
-         track_index = -1
-
-    if track_index == -1:
-        raise HTTPException(status_code=404, detail="Track not found in queue")
-
-    player_state['current_index'] = track_index
-    player_state['is_playing'] = True
-    player_state['current_time'] = 0.0 # Reset time when playing a new track
-
-    return {"status": "success", "current_track": player_state['queue'][track_index]}
-
-@app.post("/servers/{server_id}/invite", response_model=schemas.InviteCode)
-def create_server_invite(
-    server_id: int,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    # Check if user is a member of the server
-    if not crud.is_user_server_member(db=db, user_id=current_user.id, server_id=server_id):
-        raise HTTPException(status_code=403, detail="Not a member of this server")
-    
-    # Create invite code
-    invite = crud.create_invite_code(db=db, server_id=server_id, user_id=current_user.id)
-    
-    # Log the action
-    crud.create_audit_log(
-        db=db,
-        server_id=server_id,
-        user_id=current_user.id,
-        action="create_invite",
-        target_type="invite",
-        target_id=invite.id,
-        changes={"code": invite.code}
-    )
-    
-    return invite
-
-@app.post("/servers/join/{invite_code}")
-async def join_server(
-    invite_code: str,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    # Get server by invite code
-    server = crud.get_server_by_invite_code(db, invite_code)
-    if not server:
-        raise HTTPException(status_code=404, detail="Invalid or expired invite code")
-    
-    # Check if user is already a member
-    if crud.is_user_server_member(db, current_user.id, server.id):
-        raise HTTPException(status_code=400, detail="Already a member of this server")
-    
-    # Add user to server
-    member = crud.add_user_to_server(db, current_user.id, server.id)
-    
-    # Log the action
-    crud.create_audit_log(
-        db=db,
-        server_id=server.id,
-        user_id=current_user.id,
-        action="join_server",
-        target_type="server",
-        target_id=server.id,
-        changes={}
-    )
-    
-    return {"message": "Successfully joined server", "server": server}
-
-@app.put("/users/{user_id}/credentials")
-def update_credentials(
-    user_id: int,
-    credentials: schemas.UserCredentialsUpdate,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
-):
-    # Only allow users to update their own credentials
-    if current_user.id != user_id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not enough permissions"
-        )
-    
-    return crud.update_user_credentials(
-        db=db,
-        user_id=user_id,
-        new_username=credentials.username,
-        new_password=credentials.password
-    )
-
-@app.put("/fix-credentials/{user_id}")
-def fix_swapped_credentials(
-    user_id: int,
-    db: Session = Depends(get_db)
-):
-    """
-    Fix swapped username and password for a user.
-    This is a temporary endpoint to fix the issue.
-    """
-    db_user = crud.get_user(db, user_id)
-    if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    # The current username is actually the password
-    current_password = db_user.username
-    # The current password hash is for the username
-    current_username = db_user.hashed_password
-    
-    # Update with correct values
-    db_user.username = current_username
-    db_user.hashed_password = current_password
-    
-    db.commit()
-    db.refresh(db_user)
-    
-    return {"message": "Credentials fixed successfully"}
-
-# Создаем директорию для медиафайлов
-MEDIA_DIR = "media"
-os.makedirs(MEDIA_DIR, exist_ok=True)
-
-# Эндпоинты для управления участниками сервера
-@app.post("/servers/{server_id}/members", response_model=schemas.ServerMemberResponse)
-def add_server_member(
-    server_id: int,
-    member: schemas.ServerMemberCreate,
-    db: Session = Depends(get_db)
-):
-    db_member = ServerMember(
-        server_id=server_id,
-        user_id=member.user_id,
-        role=member.role
-    )
-    db.add(db_member)
-    db.commit()
-    db.refresh(db_member)
-    return db_member
-
-@app.put("/servers/{server_id}/members/{user_id}")
-def update_member_role(
-    server_id: int,
-    user_id: int,
-    role: str,
-    db: Session = Depends(get_db)
-):
-    member = db.query(ServerMember).filter(
-        ServerMember.server_id == server_id,
-        ServerMember.user_id == user_id
-    ).first()
-    if not member:
-        raise HTTPException(status_code=404, detail="Member not found")
-    
-    member.role = role
-    db.commit()
-    return {"status": "success"}
-
-@app.delete("/servers/{server_id}/members/{user_id}")
-def remove_server_member(
-    server_id: int,
-    user_id: int,
-    db: Session = Depends(get_db)
-):
-    member = db.query(ServerMember).filter(
-        ServerMember.server_id == server_id,
-        ServerMember.user_id == user_id
-    ).first()
-    if not member:
-        raise HTTPException(status_code=404, detail="Member not found")
-    
-    db.delete(member)
-    db.commit()
-    return {"status": "success"}
-
-# Эндпоинт для загрузки медиафайлов
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    # Генерируем уникальное имя файла
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(MEDIA_DIR, unique_filename)
-    
-    # Сохраняем файл
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    return {
-        "filename": unique_filename,
-        "original_name": file.filename,
-        "url": f"/media/{unique_filename}"
-    }
-
-# Add static file serving for media
-from fastapi.staticfiles import StaticFiles
-app.mount("/media", StaticFiles(directory="media"), name="media")
-
-@app.get("/api/channels/{channel_id}/participants")
-def get_channel_participants(channel_id: int):
-    participants = []
-    if channel_id in voice_manager.voice_channels:
-        for user_id in voice_manager.voice_channels[channel_id]:
-            state = voice_manager.user_states.get(user_id, {})
-            participants.append({
-                "id": user_id,
-                "isMuted": state.get("isMuted", False),
-                "isDeafened": state.get("isDeafened", False),
-                "isVideoEnabled": state.get("isVideoEnabled", False),
-                "isScreenSharing": state.get("isScreenSharing", False)
-            })
-    return {"participants": participants}
-
-@app.get("/music/current-track")
-def get_current_track(channel_id: int):
-    print(f"[BACKEND] get_current_track called for channel {channel_id}")
-    """Get the current playing track for a channel."""
-    player_state = music_players.get(channel_id)
-    if not player_state or player_state['current_index'] == -1:
-        print(f"[BACKEND] get_current_track: No track playing for channel {channel_id}")
-        return {"current_track": None, "is_playing": False, "current_time": 0.0}
-
-    current_track = player_state['queue'][player_state['current_index']]
-    print(f"[BACKEND] get_current_track: Returning track {current_track.get('title')} for channel {channel_id}, is_playing: {player_state['is_playing']}")
-    return {
-        "current_track": current_track,
-        "is_playing": player_state['is_playing'],
-        "current_time": player_state['current_time'] # Placeholder for tracking time
-    }
-
-@app.put("/music/playback-state")
-def update_playback_state(channel_id: int, state: Dict[str, bool]):
-    print(f"[BACKEND] update_playback_state called for channel {channel_id} with state {state}")
-    """Update the playback state (play/pause) for a channel."""
-    player_state = music_players.get(channel_id)
-    if not player_state or player_state['current_index'] == -1:
-        raise HTTPException(status_code=400, detail="No track is currently playing or queued in this channel")
-
-    if 'is_playing' in state:
-        player_state['is_playing'] = state['is_playing']
-        print(f"[BACKEND] Playback state updated to is_playing: {player_state['is_playing']} for channel {channel_id}")
-
-    # In a real implementation, you would control audio playback here
-    # For now, we just update the state
-
-    return {"status": "success", "is_playing": player_state['is_playing']}
-
-@app.post("/music/skip-next")
-def skip_next_track(channel_id: int):
-    print(f"[BACKEND] skip_next_track called for channel {channel_id}")
-    """Skip to the next track in the queue for a channel."""
-    player_state = music_players.get(channel_id)
-    if not player_state or not player_state['queue']:
-        raise HTTPException(status_code=400, detail="Music queue is empty")
-
-    next_index = player_state['current_index'] + 1
-    if next_index < len(player_state['queue']):
-        player_state['current_index'] = next_index
-        player_state['is_playing'] = True # Assume playing after skipping
-        player_state['current_time'] = 0.0 # Reset time on skip
-        # In a real implementation, start playing the new track here
-        print(f"[BACKEND] Skipping to next track {next_index} for channel {channel_id}. Setting is_playing to True.")
-        return {"status": "success", "current_track": player_state['queue'][next_index]}
-    else:
-        # Reached end of queue
-        player_state['current_index'] = -1
-        player_state['is_playing'] = False
-        player_state['current_time'] = 0.0
-        print(f"[BACKEND] Reached end of queue for channel {channel_id}. Setting is_playing to False.")
-        return {"status": "success", "current_track": None, "message": "End of queue"}
-
-@app.post("/music/skip-previous")
-def skip_previous_track(channel_id: int):
-    print(f"[BACKEND] skip_previous_track called for channel {channel_id}")
-    """Skip to the previous track in the queue for a channel."""
-    player_state = music_players.get(channel_id)
-    if not player_state or not player_state['queue']:
-        raise HTTPException(status_code=400, detail="Music queue is empty")
-
-    prev_index = player_state['current_index'] - 1
-    if prev_index >= 0:
-        player_state['current_index'] = prev_index
-        player_state['is_playing'] = True # Assume playing after skipping
-        player_state['current_time'] = 0.0 # Reset time on skip
-        # In a real implementation, start playing the new track here
-        print(f"[BACKEND] Skipping to previous track {prev_index} for channel {channel_id}. Setting is_playing to True.")
-        return {"status": "success", "current_track": player_state['queue'][prev_index]}
-    else:
-        # Already at the beginning
-        print(f"[BACKEND] Already at beginning of queue for channel {channel_id}.")
-        return {"status": "success", "current_track": player_state['queue'][0], "message": "Already at the beginning"}
-
-if __name__ == "__main__":
-    def find_free_port(start_port=8000, max_port=8999):
-        for port in range(start_port, max_port + 1):
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.bind(('', port))
-                    return port
-            except OSError:
-                continue
-        return None
-
-    port = find_free_port()
-    if port is None:
-        print("No free ports available")
-        exit(1)
-        
-    print(f"Starting server on port {port}")
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, Query, UploadFile, File, WebSocket, WebSocketDisconnect, Form
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional, Dict, Any
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+import json
+from jose import JWTError, jwt
+import socket
+import base64
+import os
+import shutil
+import uuid
+import asyncio
+import time
+import subprocess
+
+from database import *
+import models as models
+import schemas as schemas
+import auth as auth
+import crud as crud
+import config
+from audio_handler import audio_handler
+from db_writer import writer
+import async_crud
+import batch
+import bootstrap
+import changes
+import compression
+import etags
+import fast_json
+import migrations
+import pagination
+import realtime
+import search
+from message_cache import message_cache
+import permissions
+from permissions import Access, Permission, authorize, channel_permission, permission_cache, server_permission
+from message_ingest import message_ingestor
+from maintenance import retention
+import sql_profiler
+from app_logging import setup_logging, shutdown_logging, get_logger, get_sampled_logger
+
+logger = get_logger("api")
+voice_log = get_logger("voice")
+voice_frame_log = get_sampled_logger("voice", "voice.frames")
+music_log = get_logger("music")
+music_poll_log = get_sampled_logger("music", "music.poll")
+
+# In-memory storage for music queues and playback state
+# Structure: { channel_id: { 'queue': [{id, url, title, artist, duration}, ...], 'current_index': int, 'is_playing': bool, 'current_time': float } }
+music_players: Dict[int, Dict[str, Any]] = {}
+
+# Import User model explicitly
+from models import User, Channel, ServerMember, Message
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Importing this module has no side effects; the schema, audio devices and
+    # background jobs are set up here, when the server actually starts
+    setup_logging()
+    try:
+        # Missing tables, then indexes/columns added after a database was created
+        await run_sync(migrations.create_schema)
+        logger.info("Database tables created successfully")
+    except Exception as e:
+        logger.error("Error creating database tables: %s", e)
+    try:
+        await run_sync(audio_handler.open)
+    except Exception as e:
+        voice_log.warning("Audio devices unavailable, voice playback disabled: %s", e)
+    if config.RETENTION_ENABLED:
+        retention.start()
+
+    yield
+
+    await run_sync(retention.stop)
+    # Commit whatever is still queued before the process exits
+    await message_ingestor.flush()
+    await run_sync(writer.stop)
+    shutdown_logging()
+
+app = FastAPI(title="Dump API", lifespan=lifespan)
+batch_dispatcher = batch.BatchDispatcher(app)
+
+if config.SQL_PROFILE_ENABLED:
+    sql_profiler.install()
+    app.add_middleware(sql_profiler.SQLProfilerMiddleware)
+
+if config.COMPRESSION_ENABLED:
+    app.add_middleware(compression.CompressionMiddleware)
+
+# Настройка CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=[
+        "http://localhost:3000",
+        "http://localhost:3001",
+        "http://localhost:3002",
+        "http://127.0.0.1:3000",
+        "http://127.0.0.1:3001",
+        "http://127.0.0.1:3002",
+        "http://26.34.237.219:3000",
+        "https://26.34.237.219:3000",
+        "https://26.34.237.219:3001",
+        "https://26.34.237.219:3002",
+        "https://26.34.237.219:8000",
+    ],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["*"],
+    max_age=3600
+)
+
+# Voice channel WebSocket connection manager
+class VoiceChannelManager:
+    def __init__(self):
+        self.voice_channels = {}  # channel_id -> set of user_ids
+        self.user_channels = {}   # user_id -> channel_id
+        self.audio_streams = {}   # (channel_id, user_id) -> {'input': stream, 'output': stream}
+        self.user_websockets = {} # user_id -> websocket
+        self.connection_locks = {} # channel_id -> asyncio.Lock
+        self._cleanup_task = None
+        self.user_states = {}     # user_id -> {'isMuted': bool, 'isDeafened': bool}
+
+    async def _start_cleanup_task(self):
+        """Запускает периодическую очистку неактивных соединений"""
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_inactive_connections())
+
+    async def _cleanup_inactive_connections(self):
+        """Периодически проверяет и очищает неактивные соединения"""
+        while True:
+            try:
+                await asyncio.sleep(300)  # Проверка каждые 5 минут
+                current_time = datetime.now()
+                
+                # Очистка неактивных WebSocket соединений
+                for user_id, websocket in list(self.user_websockets.items()):
+                    if not websocket.client_state.CONNECTED:
+                        await self.disconnect_user(user_id)
+                
+                # Очистка неиспользуемых аудио потоков
+                for stream_id, streams in list(self.audio_streams.items()):
+                    channel_id, user_id = stream_id
+                    if user_id not in self.user_websockets:
+                        audio_handler.close_stream(stream_id)
+                        del self.audio_streams[stream_id]
+            except Exception as e:
+                voice_log.error("Error in cleanup task: %s", e)
+
+    async def connect_user(self, websocket, channel_id, user_id):
+        try:
+            voice_log.debug("Attempting to connect user %s to channel %s", user_id, channel_id)
+            
+            # Получаем или создаем блокировку для канала
+            if channel_id not in self.connection_locks:
+                self.connection_locks[channel_id] = asyncio.Lock()
+            
+            async with self.connection_locks[channel_id]:
+                if channel_id not in self.voice_channels:
+                    self.voice_channels[channel_id] = set()
+                
+                # Проверяем, не подключен ли уже пользователь
+                if user_id in self.user_channels:
+                    old_channel_id = self.user_channels[user_id]
+                    if old_channel_id != channel_id:
+                        voice_log.debug("User %s was in channel %s, disconnecting", user_id, old_channel_id)
+                        await self.disconnect_user(user_id)
+                
+                # Добавляем пользователя в канал
+                self.voice_channels[channel_id].add(user_id)
+                self.user_channels[user_id] = channel_id
+                self.user_websockets[user_id] = websocket
+                
+                # Инициализируем состояние пользователя
+                self.user_states[user_id] = {
+                    'isMuted': False,
+                    'isDeafened': False,
+                    'isVideoEnabled': False,
+                    'isScreenSharing': False
+                }
+                
+                # Создаем аудио потоки; без аудио устройств пользователь
+                # подключается без воспроизведения на сервере
+                if audio_handler.available:
+                    input_stream = audio_handler.create_input_stream((channel_id, user_id))
+                    output_stream = audio_handler.create_output_stream((channel_id, user_id))
+
+                    if input_stream and output_stream:
+                        self.audio_streams[(channel_id, user_id)] = {
+                            'input': input_stream,
+                            'output': output_stream
+                        }
+                        voice_log.debug("Audio streams created for user %s in channel %s", user_id, channel_id)
+                    else:
+                        audio_handler.close_stream((channel_id, user_id))
+                        voice_log.warning("Audio streams unavailable for user %s in channel %s, connecting without playback", user_id, channel_id)
+                else:
+                    voice_log.debug("Audio unavailable, user %s joins channel %s without playback", user_id, channel_id)
+                
+                # Запускаем задачу очистки, если она еще не запущена
+                await self._start_cleanup_task()
+                
+                # Уведомляем других участников
+                await self.broadcast_user_joined(channel_id, user_id)
+                
+                # Отправляем список участников всем пользователям в канале
+                await self.send_participants_list(channel_id)
+                
+                voice_log.debug("User %s successfully connected to channel %s", user_id, channel_id)
+                
+                try:
+                    while True:
+                        try:
+                            data = await websocket.receive()
+                        except WebSocketDisconnect:
+                            voice_log.debug("User %s disconnected", user_id)
+                            break
+                        except Exception as e:
+                            voice_log.error("Exception in receive: %s", e)
+                            break
+                            
+                        if data['type'] == 'websocket.disconnect':
+                            voice_log.debug("Disconnect received for user %s", user_id)
+                            break
+                            
+                        if 'text' in data:
+                            try:
+                                msg = data['text']
+                                parsed = json.loads(msg)
+                                
+                                if parsed['type'] == 'audio':
+                                    voice_frame_log.debug("Received audio from user %s", user_id)
+                                    await self.handle_audio_data(channel_id, user_id, parsed['data'])
+                                elif parsed['type'] == 'video':
+                                    await self.broadcast_video(channel_id, user_id, parsed['data'])
+                                elif parsed['type'] == 'screen':
+                                    await self.broadcast_screen(channel_id, user_id, parsed['data'])
+                                elif parsed['type'] == 'state_update':
+                                    # Обновляем состояние пользователя
+                                    if user_id in self.user_states:
+                                        self.user_states[user_id].update(parsed.get('state', {}))
+                                        # Уведомляем других участников об изменении состояния
+                                        await self.broadcast_user_state(channel_id, user_id)
+                                elif parsed['type'] == 'join':
+                                    await self.send_participants_list(channel_id)
+                            except json.JSONDecodeError as e:
+                                voice_log.error("Error decoding message from user %s: %s", user_id, e)
+                            except Exception as e:
+                                voice_log.error("Error processing message from user %s: %s", user_id, e)
+                finally:
+                    await self.disconnect_user(user_id)
+        except Exception as e:
+            voice_log.error("Error in connect_user: %s", e)
+            await self.disconnect_user(user_id)
+            raise
+
+    async def disconnect_user(self, user_id):
+        try:
+            if user_id in self.user_channels:
+                channel_id = self.user_channels[user_id]
+                
+                # Удаляем пользователя из канала
+                if channel_id in self.voice_channels:
+                    self.voice_channels[channel_id].discard(user_id)
+                    if not self.voice_channels[channel_id]:
+                        del self.voice_channels[channel_id]
+                
+                # Закрываем аудио потоки
+                stream_id = (channel_id, user_id)
+                if stream_id in self.audio_streams:
+                    audio_handler.close_stream(stream_id)
+                    del self.audio_streams[stream_id]
+                
+                # Удаляем WebSocket соединение
+                if user_id in self.user_websockets:
+                    del self.user_websockets[user_id]
+                
+                # Удаляем информацию о канале пользователя
+                del self.user_channels[user_id]
+                
+                # Уведомляем других участников
+                await self.broadcast_user_left(channel_id, user_id)
+                await self.send_participants_list(channel_id)
+        except Exception as e:
+            voice_log.error("Error in disconnect_user: %s", e)
+
+    async def handle_audio_data(self, channel_id, sender_id, audio_data):
+        if channel_id in self.voice_channels:
+            for user_id in self.voice_channels[channel_id]:
+                if user_id != sender_id:
+                    try:
+                        websocket = self.user_websockets.get(user_id)
+                        if websocket and websocket.client_state.CONNECTED:
+                            # Проверяем, что аудио данные не пустые
+                            if not audio_data:
+                                voice_log.debug("Empty audio data from user %s", sender_id)
+                                continue
+
+                            # Отправляем аудио данные
+                            await websocket.send_json({
+                                'type': 'audio',
+                                'sender_id': sender_id,
+                                'data': audio_data,
+                                'channel_id': channel_id,
+                                'timestamp': datetime.now().timestamp()
+                            })
+                            
+                            # Воспроизводим аудио локально
+                            stream_id = (channel_id, user_id)
+                            if stream_id in self.audio_streams:
+                                audio_handler.play_audio(stream_id, audio_data)
+                    except Exception as e:
+                        voice_log.error("Error sending audio to user %s: %s", user_id, e)
+                        # Если не удалось отправить аудио, отключаем пользователя
+                        await self.disconnect_user(user_id)
+
+    async def broadcast_user_joined(self, channel_id, user_id):
+        if channel_id in self.voice_channels:
+            state = self.user_states.get(user_id, {})
+            message = {
+                'type': 'participant_joined',
+                'participant': {
+                    'id': user_id,
+                    'isMuted': state.get('isMuted', False),
+                    'isDeafened': state.get('isDeafened', False),
+                    'isVideoEnabled': state.get('isVideoEnabled', False),
+                    'isScreenSharing': state.get('isScreenSharing', False)
+                },
+                'channel_id': channel_id
+            }
+            voice_log.debug("Broadcasting user %s joined to channel %s", user_id, channel_id)
+            await self.broadcast_to_channel(channel_id, message)
+
+    async def broadcast_user_left(self, channel_id, user_id):
+        if channel_id in self.voice_channels:
+            message = {
+                'type': 'participant_left',
+                'userId': user_id
+            }
+            await self.broadcast_to_channel(channel_id, message)
+
+    async def broadcast_to_channel(self, channel_id, message):
+        if channel_id in self.voice_channels:
+            for user_id in self.voice_channels[channel_id]:
+                try:
+                    websocket = self.user_websockets.get(user_id)
+                    if websocket:
+                        await websocket.send_json(message)
+                except Exception as e:
+                    voice_log.error("Error broadcasting to user %s: %s", user_id, e)
+                    # Если не удалось отправить сообщение, отключаем пользователя
+                    await self.disconnect_user(user_id)
+
+    async def broadcast_video(self, channel_id, sender_id, video_data):
+        if channel_id in self.voice_channels:
+            message = {
+                'type': 'video',
+                'sender_id': sender_id,
+                'data': video_data
+            }
+            await self.broadcast_to_channel(channel_id, message)
+
+    async def broadcast_screen(self, channel_id, sender_id, screen_data):
+        if channel_id in self.voice_channels:
+            message = {
+                'type': 'screen',
+                'sender_id': sender_id,
+                'data': screen_data
+            }
+            await self.broadcast_to_channel(channel_id, message)
+
+    async def broadcast_user_state(self, channel_id, user_id):
+        if channel_id in self.voice_channels:
+            state = self.user_states.get(user_id, {})
+            message = {
+                'type': 'participant_state',
+                'participant': {
+                    'id': user_id,
+                    'isMuted': state.get('isMuted', False),
+                    'isDeafened': state.get('isDeafened', False),
+                    'isVideoEnabled': state.get('isVideoEnabled', False),
+                    'isScreenSharing': state.get('isScreenSharing', False)
+                },
+                'channel_id': channel_id
+            }
+            await self.broadcast_to_channel(channel_id, message)
+
+    def cleanup(self):
+        # Clean up all audio streams
+        for stream_key in list(self.audio_streams.keys()):
+            try:
+                if 'input' in self.audio_streams[stream_key]:
+                    self.audio_streams[stream_key]['input'].stop_stream()
+                    self.audio_streams[stream_key]['input'].close()
+                if 'output' in self.audio_streams[stream_key]:
+                    self.audio_streams[stream_key]['output'].stop_stream()
+                    self.audio_streams[stream_key]['output'].close()
+            except Exception as e:
+                voice_log.error("Error cleaning up audio stream %s: %s", stream_key, e)
+        self.audio_streams.clear()
+        audio_handler.cleanup()
+
+    async def send_participants_list(self, channel_id):
+        if channel_id in self.voice_channels:
+            participants = []
+            for user_id in self.voice_channels[channel_id]:
+                state = self.user_states.get(user_id, {})
+                participants.append({
+                    'id': user_id,
+                    'isMuted': state.get('isMuted', False),
+                    'isDeafened': state.get('isDeafened', False),
+                    'isVideoEnabled': state.get('isVideoEnabled', False),
+                    'isScreenSharing': state.get('isScreenSharing', False)
+                })
+            
+            message = {
+                'type': 'participants',
+                'participants': participants,
+                'channel_id': channel_id
+            }
+            
+            voice_log.debug("Sending participants list for channel %s: %s", channel_id, participants)
+            await self.broadcast_to_channel(channel_id, message)
+
+voice_manager = VoiceChannelManager()
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, token: str):
+    # Message events of the user's servers and channels, see realtime.py
+    await realtime.hub.serve(websocket, token)
+
+@app.websocket("/ws/voice/{channel_id}")
+async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: str):
+    user = None
+    db = None
+    try:
+        voice_log.debug("WebSocket connection attempt for channel %s", channel_id)
+        
+        # Decode token and get user
+        try:
+            payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+            user_email = payload.get("sub")
+            if not user_email:
+                voice_log.debug("Invalid token - no user email")
+                await websocket.close(code=4000, reason="Invalid token")
+                return
+        except jwt.ExpiredSignatureError:
+            voice_log.debug("Token expired, attempting to refresh")
+            # Try to refresh the token
+            try:
+                db = SessionLocal()
+                user = await run_sync(crud.get_user_by_email, db, payload.get("sub"))
+                if user:
+                    # Create new token
+                    access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
+                    new_token = auth.create_access_token(
+                        data={"sub": user.email}, expires_delta=access_token_expires
+                    )
+                    # Update last login
+                    await async_crud.update_last_login(user.id)
+                    # Send new token to client
+                    await websocket.accept()
+                    await websocket.send_json({
+                        "type": "token_refresh",
+                        "token": new_token
+                    })
+                    token = new_token
+                else:
+                    await websocket.close(code=4000, reason="User not found")
+                    return
+            except Exception as e:
+                voice_log.error("Error refreshing token: %s", e)
+                await websocket.close(code=4000, reason="Token refresh failed")
+                return
+        except jwt.JWTError as e:
+            voice_log.warning("JWT decode error: %s", e)
+            await websocket.close(code=4000, reason="Invalid token")
+            return
+
+        # Get user from database
+        if not db:
+            db = SessionLocal()
+        try:
+            user = await run_sync(crud.get_user_by_email, db, user_email)
+            if not user:
+                voice_log.debug("User not found for email: %s", user_email)
+                await websocket.close(code=4000, reason="User not found")
+                return
+
+            # Channel and membership in one (usually cached) lookup
+            access = await run_sync(permissions.resolve, db, user.id, channel_id=channel_id)
+            # Nothing else needs the session; don't hold a pooled connection for the whole call
+            await run_sync(db.close)
+            db = None
+
+            if access is None:
+                voice_log.debug("Channel not found: %s", channel_id)
+                await websocket.close(code=4000, reason="Channel not found")
+                return
+            if not access.can(Permission.VIEW_CHANNELS):
+                voice_log.debug("User %s is not a member of server %s", user.id, access.server_id)
+                await websocket.close(code=4000, reason="Not a member of this server")
+                return
+
+            # Accept the WebSocket connection
+            await websocket.accept()
+            voice_log.debug("User %s connected to voice channel %s", user.username, channel_id)
+
+            # Send initial connection success message
+            try:
+                await websocket.send_json({
+                    "type": "connection_status",
+                    "status": "connected",
+                    "message": "Successfully connected to voice channel"
+                })
+                voice_log.debug("Sent initial connection status to user %s", user.username)
+            except Exception as e:
+                voice_log.error("Error sending initial status: %s", e)
+                return
+
+            # Main message handling loop
+            while True:
+                try:
+                    data = await websocket.receive()
+                    voice_frame_log.debug("Received data from user %s: %s", user.username, data['type'])
+                    
+                    if data["type"] == "websocket.disconnect":
+                        voice_log.debug("WebSocket disconnected for user %s", user.username)
+                        break
+                        
+                    if data["type"] == "websocket.receive":
+                        if "text" in data:
+                            message = json.loads(data["text"])
+                            voice_frame_log.debug("Received message from user %s: %s", user.username, message.get("type"))
+                            
+                            # Handle different message types
+                            if message.get("type") == "join":
+                                voice_log.debug("User %s joining voice channel", user.username)
+                                # Add user to voice channel participants
+                                await voice_manager.connect_user(websocket, channel_id, user.id)
+                                break
+                            elif message.get("type") == "leave":
+                                voice_log.debug("User %s leaving voice channel", user.username)
+                                # Remove user from voice channel participants
+                                await voice_manager.disconnect_user(user.id)
+                                break
+                            elif message.get("type") == "audio":
+                                # Обработка аудио данных
+                                audio_data = message.get("data")
+                                if audio_data:
+                                    await voice_manager.handle_audio_data(channel_id, user.id, audio_data)
+                            elif message.get("type") == "ping":
+                                # Respond to ping with pong
+                                try:
+                                    await websocket.send_json({"type": "pong"})
+                                    voice_log.debug("Sent pong response to user %s", user.username)
+                                except Exception as e:
+                                    voice_log.error("Error sending pong: %s", e)
+                                    break
+                            else:
+                                # Echo the message back to the sender
+                                try:
+                                    await websocket.send_json({
+                                        "type": "echo",
+                                        "original_message": message
+                                    })
+                                except Exception as e:
+                                    voice_log.error("Error echoing message: %s", e)
+                                    break
+                                
+                        elif "bytes" in data:
+                            # Handle binary audio data
+                            audio_data = data["bytes"]
+                            voice_frame_log.debug("Received binary audio data from user %s: %s bytes", user.username, len(audio_data))
+                            
+                            # Отправляем аудио другим пользователям
+                            await voice_manager.handle_audio_data(channel_id, user.id, audio_data)
+
+                except WebSocketDisconnect:
+                    voice_log.debug("WebSocket disconnected for user %s", user.username)
+                    break
+                except Exception as e:
+                    voice_log.error("Error processing message: %s", e)
+                    # Don't break the connection on general errors
+                    continue
+
+        except Exception as e:
+            voice_log.error("Database error: %s", e)
+            try:
+                await websocket.close(code=4000, reason="Database error")
+            except Exception:
+                pass
+            return
+
+    except Exception as e:
+        voice_log.error("Error in voice channel: %s", e)
+        try:
+            await websocket.close(code=4000, reason="Internal server error")
+        except Exception:
+            pass
+    finally:
+        # Clean up resources
+        if user and channel_id:
+            voice_log.debug("Cleaning up resources for user %s", user.username)
+            await voice_manager.disconnect_user(user.id)
+        if db:
+            await run_sync(db.close)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+@app.post("/token")
+async def login_for_access_token(
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db = Depends(get_async_db)
+):
+    try:
+        # Get client IP
+        client_ip = request.client.host
+        logger.debug("Login attempt for email %s from IP %s", form_data.username, client_ip)
+
+        # Get user and verify password
+        user = await async_crud.get_user_by_email(db, form_data.username)
+        if not user:
+            logger.debug("User not found: %s", form_data.username)
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect email or password"
+            )
+
+        # bcrypt is deliberately slow, keep it off the event loop
+        if not await run_sync(auth.verify_password, form_data.password, user.hashed_password):
+            logger.debug("Invalid password for user: %s", form_data.username)
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect email or password"
+            )
+
+        # Create access token
+        access_token = auth.create_access_token(data={"sub": user.email})
+        logger.debug("Login successful for user: %s", form_data.username)
+
+        # Log successful attempt
+        await async_crud.log_login_attempt(client_ip, True)
+
+        return {
+            "access_token": access_token,
+            "token_type": "bearer",
+            "user": {
+                "id": user.id,
+                "email": user.email,
+                "username": user.username,
+                "is_active": user.is_active
+            }
+        }
+    except HTTPException as he:
+        # Log failed attempt
+        await async_crud.log_login_attempt(request.client.host, False)
+        raise he
+    except Exception as e:
+        logger.error("Login error: %s", e)
+        await async_crud.log_login_attempt(request.client.host, False)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An error occurred during login"
+        )
+
+@app.post("/token/refresh")
+async def refresh_token(
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    try:
+        # Create new access token
+        access_token_expires = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
+        access_token = auth.create_access_token(
+            data={"sub": current_user.email}, expires_delta=access_token_expires
+        )
+        
+        # Update last login time
+        await async_crud.update_last_login(current_user.id)
+        
+        return {"access_token": access_token, "token_type": "bearer"}
+    except Exception as e:
+        logger.error("Error refreshing token: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+@app.post("/users/", response_model=schemas.User)
+def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    logger.debug("Registration attempt for email: %s", user.email)
+    
+    # Check if email is already registered
+    db_user = crud.get_user_by_email(db, email=user.email)
+    if db_user:
+        logger.debug("Email already registered: %s", user.email)
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
+    # Check if username is already taken
+    db_user = crud.get_user_by_username(db, username=user.username)
+    if db_user:
+        logger.debug("Username already taken: %s", user.username)
+        raise HTTPException(status_code=400, detail="Username already taken")
+    
+    # bcrypt runs here rather than on the writer thread
+    hashed_password = auth.get_password_hash(user.password)
+    new_user = writer.call(crud.create_user, user=user, hashed_password=hashed_password)
+    logger.info("User created: id=%s, username=%s", new_user.id, new_user.username)
+    return new_user
+
+@app.get("/users/me/", response_model=schemas.User)
+def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
+    return current_user
+
+@app.put("/users/me/", response_model=schemas.User)
+def update_user_me(
+    user: schemas.UserUpdate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.update_user, user_id=current_user.id, user=user)
+
+@app.get("/users/me/login-history/", response_model=List[schemas.LoginHistory], response_class=fast_json.JSONResponse, dependencies=[Depends(query_budget(2))])
+def read_login_history(
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db),
+    skip: int = 0,
+    limit: int = 100
+):
+    columns = LOGIN_HISTORY_COLUMNS if config.FAST_JSON_ENABLED else None
+    rows = crud.get_login_history(db=db, user_id=current_user.id, skip=skip, limit=limit, columns=columns)
+    return list_response(LOGIN_HISTORY_LIST, rows)
+
+@app.get("/bootstrap")
+async def read_bootstrap(
+    channel_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """
+    User, servers (with channels, roles and member summaries), voice
+    participant counts and the newest message page of ``channel_id`` in one
+    streamed response; see bootstrap.py.
+    """
+    if channel_id is not None:
+        await run_sync(bootstrap.authorize_channel, current_user.id, channel_id)
+    voice = {channel: len(users) for channel, users in voice_manager.voice_channels.items() if users}
+    return StreamingResponse(
+        bootstrap.stream(current_user, channel_id, limit, voice),
+        media_type="application/json"
+    )
+
+@app.post("/batch", response_model=schemas.BatchResponse, response_class=fast_json.JSONResponse)
+async def run_batch(
+    request: Request,
+    batch_request: schemas.BatchRequest,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """
+    Run several API calls in order, authenticated once and sharing one
+    database session, optionally as one transaction; see batch.py.
+    """
+    return fast_json.JSONResponse(await batch_dispatcher.run(request, batch_request, current_user))
+
+@app.get("/sync", response_class=fast_json.JSONResponse, dependencies=[Depends(query_budget(9))])
+def sync_changes(
+    since: int = Query(..., ge=0),
+    limit: int = Query(config.SYNC_PAGE_SIZE, ge=1, le=config.SYNC_PAGE_SIZE),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Servers, channels, roles, members and message edits changed after the
+    ``since`` cursor (from /bootstrap or the previous page), with tombstones
+    for deletions; see changes.py. Follow ``cursor`` while ``has_more``; on
+    ``reset`` reload through /bootstrap.
+    """
+    return fast_json.JSONResponse(changes.read_changes(db, current_user.id, since, limit))
+
+@app.post("/servers/", response_model=schemas.Server)
+def create_server(
+    server: schemas.ServerCreate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.create_server, server=server, owner_id=current_user.id)
+
+@app.get("/servers/", response_model=List[schemas.Server], dependencies=[Depends(query_budget(2))])
+def read_servers(
+    request: Request,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db),
+    skip: int = 0,
+    limit: int = 100
+):
+    cached = etags.not_modified(
+        request, response, etags.user_servers(current_user.id), etags.ALL_SERVERS, policy="server_list"
+    )
+    if cached is not None:
+        return cached
+    return crud.get_user_servers(db=db, user_id=current_user.id)
+
+@app.get("/servers/{server_id}", response_model=schemas.Server, dependencies=[Depends(server_permission())])
+def read_server(
+    server_id: int,
+    request: Request,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    cached = etags.not_modified(request, response, etags.server(server_id), policy="server")
+    if cached is not None:
+        return cached
+    db_server = crud.get_server(db=db, server_id=server_id)
+    if db_server is None:
+        raise HTTPException(status_code=404, detail="Server not found")
+    return db_server
+
+@app.put("/servers/{server_id}", response_model=schemas.Server, dependencies=[Depends(server_permission(Permission.MANAGE_SERVER))])
+def update_server(
+    server_id: int,
+    server: schemas.ServerUpdate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(
+        crud.with_audit_log,
+        crud.update_server,
+        audit=dict(
+            server_id=server_id,
+            user_id=current_user.id,
+            action="update_server",
+            target_type="server",
+            changes=server.model_dump(exclude_unset=True)
+        ),
+        server_id=server_id,
+        server=server
+    )
+
+@app.delete("/servers/{server_id}", dependencies=[Depends(server_permission(Permission.MANAGE_SERVER))])
+def delete_server(
+    server_id: int,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(
+        crud.with_audit_log,
+        crud.delete_server,
+        audit=dict(
+            server_id=server_id,
+            user_id=current_user.id,
+            action="delete_server",
+            target_type="server",
+            target_id=server_id,
+            changes={}
+        ),
+        server_id=server_id
+    )
+
+@app.post("/servers/{server_id}/roles/", response_model=schemas.Role, dependencies=[Depends(server_permission(Permission.MANAGE_ROLES))])
+def create_role(
+    server_id: int,
+    role: schemas.RoleCreate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(
+        crud.with_audit_log,
+        crud.create_role,
+        audit=dict(
+            server_id=server_id,
+            user_id=current_user.id,
+            action="create_role",
+            target_type="role",
+            changes=role.model_dump()
+        ),
+        role=role,
+        server_id=server_id
+    )
+
+@app.get("/servers/{server_id}/roles/", response_model=List[schemas.Role], dependencies=[Depends(query_budget(3)), Depends(server_permission())])
+def read_roles(
+    server_id: int,
+    request: Request,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    cached = etags.not_modified(request, response, etags.server_roles(server_id), policy="roles")
+    if cached is not None:
+        return cached
+    return crud.get_server_roles(db=db, server_id=server_id)
+
+@app.put("/roles/{role_id}", response_model=schemas.Role)
+def update_role(
+    role_id: int,
+    role: schemas.RoleUpdate,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    db_role = crud.get_role(db=db, role_id=role_id)
+    if db_role is None:
+        raise HTTPException(status_code=404, detail="Role not found")
+    
+    authorize(db, current_user.id, Permission.MANAGE_ROLES, server_id=db_role.server_id)
+    
+    return writer.call(
+        crud.with_audit_log,
+        crud.update_role,
+        audit=dict(
+            server_id=db_role.server_id,
+            user_id=current_user.id,
+            action="update_role",
+            target_type="role",
+            changes=role.model_dump(exclude_unset=True)
+        ),
+        role_id=role_id,
+        role=role
+    )
+
+@app.delete("/roles/{role_id}")
+def delete_role(
+    role_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    db_role = crud.get_role(db=db, role_id=role_id)
+    if db_role is None:
+        raise HTTPException(status_code=404, detail="Role not found")
+    
+    authorize(db, current_user.id, Permission.MANAGE_ROLES, server_id=db_role.server_id)
+    
+    return writer.call(
+        crud.with_audit_log,
+        crud.delete_role,
+        audit=dict(
+            server_id=db_role.server_id,
+            user_id=current_user.id,
+            action="delete_role",
+            target_type="role",
+            target_id=role_id,
+            changes={}
+        ),
+        role_id=role_id
+    )
+
+@app.post("/servers/{server_id}/channels/", response_model=schemas.Channel, dependencies=[Depends(server_permission(Permission.MANAGE_CHANNELS))])
+def create_channel(
+    server_id: int,
+    channel: schemas.ChannelCreate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(
+        crud.with_audit_log,
+        crud.create_channel,
+        audit=dict(
+            server_id=server_id,
+            user_id=current_user.id,
+            action="create_channel",
+            target_type="channel",
+            changes=channel.model_dump()
+        ),
+        channel=channel,
+        server_id=server_id
+    )
+
+@app.get("/servers/{server_id}/channels/", response_model=List[schemas.Channel], dependencies=[Depends(query_budget(3)), Depends(server_permission())])
+def read_channels(
+    server_id: int,
+    request: Request,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    cached = etags.not_modified(request, response, etags.server_channels(server_id), policy="channels")
+    if cached is not None:
+        return cached
+    return crud.get_server_channels(db=db, server_id=server_id)
+
+@app.put("/channels/{channel_id}", response_model=schemas.Channel)
+def update_channel(
+    channel_id: int,
+    channel: schemas.ChannelUpdate,
+    current_user: models.User = Depends(auth.get_current_user),
+    access: Access = Depends(channel_permission(Permission.MANAGE_CHANNELS))
+):
+    return writer.call(
+        crud.with_audit_log,
+        crud.update_channel,
+        audit=dict(
+            server_id=access.server_id,
+            user_id=current_user.id,
+            action="update_channel",
+            target_type="channel",
+            changes=channel.model_dump(exclude_unset=True)
+        ),
+        channel_id=channel_id,
+        channel=channel
+    )
+
+@app.delete("/channels/{channel_id}")
+def delete_channel(
+    channel_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    access: Access = Depends(channel_permission(Permission.MANAGE_CHANNELS))
+):
+    result = writer.call(
+        crud.with_audit_log,
+        crud.delete_channel,
+        audit=dict(
+            server_id=access.server_id,
+            user_id=current_user.id,
+            action="delete_channel",
+            target_type="channel",
+            target_id=channel_id,
+            changes={}
+        ),
+        channel_id=channel_id
+    )
+    message_cache.drop(channel_id)
+    return result
+
+def _copy_upload(file: UploadFile, file_path: str):
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+def save_message_file(file: UploadFile):
+    """Save an uploaded attachment under media/ and return (url, media_type). Blocking."""
+    # Create media directory if it doesn't exist
+    os.makedirs("media", exist_ok=True)
+    
+    # Generate unique filename
+    file_extension = os.path.splitext(file.filename)[1]
+    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    _copy_upload(file, os.path.join("media", unique_filename))
+    
+    # Determine media type
+    content_type = file.content_type or ''
+    if content_type.startswith('image/'):
+        media_type = 'image'
+    elif content_type.startswith('video/'):
+        media_type = 'video'
+    elif content_type.startswith('audio/'):
+        media_type = 'audio'
+    else:
+        media_type = 'file'
+    
+    return f"/media/{unique_filename}", media_type
+
+@app.post("/channels/{channel_id}/messages", response_model=schemas.Message)
+async def create_message(
+    channel_id: int,
+    content: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    parent_id: Optional[int] = Form(None),
+    current_user: models.User = Depends(auth.get_current_user),
+    access: Access = Depends(channel_permission(Permission.SEND_MESSAGES)),
+    db = Depends(get_async_db)
+):
+    if parent_id is not None and await async_crud.get_message_channel_id(db, parent_id) != channel_id:
+        raise HTTPException(status_code=400, detail="Parent message not found in this channel")
+    
+    media_url = None
+    media_type = None
+
+    if file:
+        media_url, media_type = await run_sync(save_message_file, file)
+    else:
+        media_type = 'text'
+
+    # Create message
+    message_data = schemas.MessageCreate(
+        content=content,
+        media_url=media_url,
+        media_type=media_type,
+        parent_id=parent_id
+    )
+    
+    # Create the message in the database; it comes back with its author attached
+    created = await async_crud.create_message(
+        message=message_data,
+        author=current_user,
+        channel_id=channel_id
+    )
+    message_cache.add(created)
+    if created.parent_id is not None:
+        message_cache.reply_added(created)
+    realtime.message_created(access.server_id, created)
+    return created
+
+# Precompiled list serializers, see fast_json.py
+MESSAGE_LIST = fast_json.ListSerializer(schemas.Message)
+MEDIA_LIST = fast_json.ListSerializer(schemas.Media)
+AUDIT_LOG_LIST = fast_json.ListSerializer(schemas.AuditLog)
+LOGIN_HISTORY_LIST = fast_json.ListSerializer(schemas.LoginHistory)
+MEDIA_COLUMNS = fast_json.project(schemas.Media, models.Media)
+AUDIT_LOG_COLUMNS = fast_json.project(schemas.AuditLog, models.AuditLog)
+LOGIN_HISTORY_COLUMNS = fast_json.project(schemas.LoginHistory, models.LoginHistory)
+
+def list_response(serializer: fast_json.ListSerializer, rows, response: Optional[Response] = None):
+    """
+    ``rows`` as a ready JSON response, keeping the headers set on the
+    endpoint's ``response``; ORM objects are returned as they are (for the
+    response_model) when FAST_JSON_ENABLED is off.
+    """
+    if isinstance(rows, Response) or not config.FAST_JSON_ENABLED:
+        return rows
+    return serializer.response(rows, headers=dict(response.headers) if response is not None else None)
+
+def message_page(
+    db: Session,
+    response: Response,
+    channel_id: int,
+    limit: int,
+    cursor: Optional[str] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None
+):
+    """
+    Keyset page of channel history. The position comes from an opaque
+    ``cursor`` or a message id in ``before``/``after``; with neither the
+    newest page is returned. Cursors for the older (X-Next-Cursor) and newer
+    (X-Prev-Cursor) pages are returned as headers so the body stays a list.
+    """
+    before_key = after_key = None
+    if cursor:
+        try:
+            direction, key = pagination.decode_message_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if direction == pagination.AFTER:
+            after_key = key
+        else:
+            before_key = key
+    elif before is not None or after is not None:
+        anchor = crud.get_message_position(db, before if before is not None else after)
+        if anchor is None or anchor.channel_id != channel_id:
+            raise HTTPException(status_code=404, detail="Message not found")
+        if before is not None:
+            before_key = pagination.message_key(anchor)
+        else:
+            after_key = pagination.message_key(anchor)
+
+    if before_key is None and after_key is None:
+        # Newest page: served from the hot cache, or read deep enough to fill it
+        page = message_cache.get_newest(channel_id, limit)
+        if page is not None:
+            cached = Response(content=page.body, media_type="application/json")
+            set_page_cursors(cached, page.oldest, page.newest, page.count, limit)
+            return cached
+        generation = message_cache.generation(channel_id)
+        messages = crud.get_channel_messages(
+            db=db,
+            channel_id=channel_id,
+            limit=max(limit, message_cache.per_channel)
+        )
+        message_cache.fill(channel_id, generation, messages)
+        messages = messages[-limit:]
+    else:
+        messages = crud.get_channel_messages(
+            db=db,
+            channel_id=channel_id,
+            limit=limit,
+            before=before_key,
+            after=after_key
+        )
+
+    if messages:
+        set_page_cursors(
+            response,
+            pagination.message_key(messages[0]),
+            pagination.message_key(messages[-1]),
+            len(messages),
+            limit,
+            going_forward=after_key is not None
+        )
+    elif before_key is not None or after_key is not None:
+        # Empty page: hand the same position back so the client can poll it
+        direction = pagination.AFTER if after_key is not None else pagination.BEFORE
+        response.headers["X-Prev-Cursor" if after_key is not None else "X-Next-Cursor"] = \
+            pagination.encode_cursor(direction, *(after_key or before_key))
+    return messages
+
+def set_page_cursors(response: Response, oldest, newest, count: int, limit: int, going_forward: bool = False):
+    older, newer = pagination.page_cursors(oldest, newest, count, limit, going_forward)
+    if older:
+        response.headers["X-Next-Cursor"] = older
+    if newer:
+        response.headers["X-Prev-Cursor"] = newer
+
+@app.get("/channels/{channel_id}/messages/", response_model=List[schemas.Message], response_class=fast_json.JSONResponse, dependencies=[Depends(query_budget(5)), Depends(channel_permission())])
+def read_messages(
+    channel_id: int,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db),
+    cursor: Optional[str] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=100)
+):
+    page = message_page(db, response, channel_id, limit, cursor, before, after)
+    return list_response(MESSAGE_LIST, page, response)
+
+def message_server_id(db: Session, user_id: int, db_message: models.Message) -> int:
+    """Server of a message's channel, for realtime events (usually a permission cache hit)."""
+    return permissions.resolve(db, user_id, channel_id=db_message.channel_id).server_id
+
+@app.put("/messages/{message_id}", response_model=schemas.Message)
+def update_message(
+    message_id: int,
+    message: schemas.MessageUpdate,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    db_message = crud.get_message(db=db, message_id=message_id)
+    if db_message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if db_message.author_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    updated = writer.call(crud.update_message, message_id=message_id, message=message)
+    message_cache.update(updated)
+    realtime.message_updated(message_server_id(db, current_user.id, updated), updated)
+    return updated
+
+@app.delete("/messages/{message_id}")
+def delete_message(
+    message_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    db_message = crud.get_message(db=db, message_id=message_id)
+    if db_message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    server_id = message_server_id(db, current_user.id, db_message)
+    if db_message.author_id != current_user.id:
+        # Moderators can delete other people's messages
+        authorize(db, current_user.id, Permission.MANAGE_MESSAGES, channel_id=db_message.channel_id)
+    result = writer.call(crud.delete_message, message_id=message_id)
+    message_cache.remove(db_message.channel_id, message_id)
+    realtime.message_deleted(server_id, db_message.channel_id, message_id)
+    if db_message.parent_id is not None and message_cache.contains(db_message.channel_id, db_message.parent_id):
+        parent = crud.get_message(db=db, message_id=db_message.parent_id)
+        if parent is not None:
+            message_cache.update(parent)
+    return result
+
+@app.get("/messages/{message_id}/thread", response_model=List[schemas.ThreadMessage], dependencies=[Depends(query_budget(3))])
+def read_thread(
+    message_id: int,
+    depth: Optional[int] = Query(None, ge=1, le=config.THREAD_MAX_DEPTH),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """
+    A message and its replies, oldest first, each with its ``depth`` below
+    the root. ``depth`` limits how many reply levels are returned; channel
+    views only need ``reply_count``/``last_reply_at`` on the root.
+    """
+    thread = crud.get_thread(db, message_id, current_user.id, max_depth=depth or config.THREAD_MAX_DEPTH)
+    if not thread:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return thread
+
+@app.get("/messages/reactions", response_model=List[schemas.MessageReactionSummary], dependencies=[Depends(query_budget(2))])
+def read_reaction_summaries(
+    ids: List[int] = Query(...),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if len(ids) > 100:
+        raise HTTPException(status_code=400, detail="At most 100 message ids per request")
+    return crud.get_reaction_summaries(db=db, message_ids=ids, user_id=current_user.id)
+
+@app.get("/search/messages", response_model=List[schemas.MessageSearchHit], dependencies=[Depends(query_budget(2))])
+def search_messages(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    server_id: Optional[int] = None,
+    channel_id: Optional[int] = None,
+    author_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(config.SEARCH_PAGE_SIZE, ge=1, le=config.SEARCH_MAX_PAGE_SIZE),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """Full-text search in the caller's servers; next page via X-Next-Cursor."""
+    after = None
+    if cursor:
+        try:
+            after = search.decode_search_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    hits = search.search_messages(
+        db,
+        user_id=current_user.id,
+        query=q,
+        server_id=server_id,
+        channel_id=channel_id,
+        author_id=author_id,
+        limit=limit,
+        after=after
+    )
+    if len(hits) == limit:
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(pagination.AFTER, *search.hit_key(hits[-1]))
+    return hits
+
+@app.get("/users/me/mentions", response_model=List[schemas.Message], dependencies=[Depends(query_budget(3))])
+def read_my_mentions(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """Messages mentioning the caller, newest first; older pages via X-Next-Cursor."""
+    before_id = None
+    if cursor:
+        try:
+            direction, key = pagination.decode_cursor(cursor)
+            before_id = int(key[0])
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    messages = crud.get_user_mentions(db, current_user.id, limit=limit, before_id=before_id)
+    if len(messages) == limit:
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(pagination.BEFORE, messages[-1].id)
+    return messages
+
+@app.get("/stats/message-cache")
+def read_message_cache_stats(current_user: models.User = Depends(auth.get_stats_user)):
+    return message_cache.stats()
+
+@app.get("/stats/sql")
+def read_sql_stats(limit: int = Query(50, ge=1, le=200), current_user: models.User = Depends(auth.get_stats_user)):
+    return {
+        "sample_every": config.SQL_PROFILE_SAMPLE_EVERY,
+        "endpoints": sql_profiler.endpoint_totals.report(),
+        "slow_queries": sql_profiler.slow_queries.report(limit),
+    }
+
+@app.get("/stats/permissions")
+def read_permission_cache_stats(current_user: models.User = Depends(auth.get_stats_user)):
+    return permission_cache.stats()
+
+@app.get("/stats/http-cache")
+def read_http_cache_stats(current_user: models.User = Depends(auth.get_stats_user)):
+    return etags.versions.stats()
+
+@app.get("/stats/compression")
+def read_compression_stats(current_user: models.User = Depends(auth.get_stats_user)):
+    return compression.stats.report()
+
+@app.get("/stats/maintenance")
+def read_maintenance_stats(current_user: models.User = Depends(auth.get_stats_user)):
+    return retention.stats()
+
+@app.get("/stats/realtime")
+def read_realtime_stats(current_user: models.User = Depends(auth.get_stats_user)):
+    return realtime.hub.stats()
+
+def reactions_changed(db: Session, access: Access, db_message: models.Message):
+    """Pass a message's new reaction totals to the hot cache and realtime subscribers."""
+    cached = message_cache.contains(db_message.channel_id, db_message.id)
+    if cached or realtime.hub.listening(access.server_id, db_message.channel_id):
+        totals = crud.get_reaction_totals(db, db_message.id)
+        if cached:
+            message_cache.set_reactions(db_message.channel_id, db_message.id, totals)
+        realtime.reactions_changed(access.server_id, db_message.channel_id, db_message.id, totals)
+
+@app.post("/messages/{message_id}/reactions/{emoji}")
+def add_reaction(
+    message_id: int,
+    emoji: str,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    db_message = crud.get_message(db=db, message_id=message_id)
+    if db_message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    access = authorize(db, current_user.id, Permission.ADD_REACTIONS, channel_id=db_message.channel_id)
+    result = writer.call(crud.add_message_reaction, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    reactions_changed(db, access, db_message)
+    return result
+
+@app.delete("/messages/{message_id}/reactions/{emoji}")
+def remove_reaction(
+    message_id: int,
+    emoji: str,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    db_message = crud.get_message(db=db, message_id=message_id)
+    if db_message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    access = authorize(db, current_user.id, Permission.ADD_REACTIONS, channel_id=db_message.channel_id)
+    result = writer.call(crud.remove_message_reaction, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    reactions_changed(db, access, db_message)
+    return result
+
+@app.get("/servers/{server_id}/audit-logs/", response_model=List[schemas.AuditLog], response_class=fast_json.JSONResponse, dependencies=[Depends(query_budget(3)), Depends(server_permission(Permission.VIEW_AUDIT_LOG))])
+def read_audit_logs(
+    server_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db),
+    skip: int = 0,
+    limit: int = 100
+):
+    columns = AUDIT_LOG_COLUMNS if config.FAST_JSON_ENABLED else None
+    rows = crud.get_server_audit_logs(db=db, server_id=server_id, skip=skip, limit=limit, columns=columns)
+    return list_response(AUDIT_LOG_LIST, rows)
+
+# Media endpoints
+@app.get("/channels/{channel_id}/messages", response_model=List[schemas.Message], response_class=fast_json.JSONResponse, dependencies=[Depends(query_budget(5)), Depends(channel_permission())])
+def get_messages(
+    channel_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=100),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    page = message_page(db, response, channel_id, limit, cursor, before, after)
+    return list_response(MESSAGE_LIST, page, response)
+
+@app.post("/channels/{channel_id}/media", response_model=schemas.Message)
+async def upload_media(
+    channel_id: int,
+    file: UploadFile = File(...),
+    content: Optional[str] = None,
+    current_user: models.User = Depends(auth.get_current_user),
+    access: Access = Depends(channel_permission(Permission.SEND_MESSAGES))
+):
+    media_url, media_type = await run_sync(save_message_file, file)
+    
+    # Create message
+    message_data = schemas.MessageCreate(
+        content=content,
+        media_url=media_url,
+        media_type=media_type
+    )
+    
+    created = await async_crud.create_message(
+        message=message_data,
+        author=current_user,
+        channel_id=channel_id
+    )
+    message_cache.add(created)
+    realtime.message_created(access.server_id, created)
+    return created
+
+@app.get("/channels/{channel_id}/media/", response_model=List[schemas.Media], response_class=fast_json.JSONResponse, dependencies=[Depends(query_budget(3)), Depends(channel_permission())])
+def get_channel_media(
+    channel_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    columns = MEDIA_COLUMNS if config.FAST_JSON_ENABLED else None
+    return list_response(MEDIA_LIST, crud.get_channel_media(db, channel_id, skip, limit, columns=columns))
+
+@app.delete("/media/{media_id}")
+def delete_media(
+    media_id: int,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.delete_media, media_id=media_id)
+
+# Game endpoints
+@app.post("/channels/{channel_id}/games/", response_model=schemas.GameSession, dependencies=[Depends(channel_permission(Permission.SEND_MESSAGES))])
+def create_game(
+    channel_id: int,
+    game: schemas.GameSessionCreate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.create_game_session, game=game, created_by_id=current_user.id, channel_id=channel_id)
+
+@app.get("/channels/{channel_id}/games/", response_model=List[schemas.GameSession], dependencies=[Depends(query_budget(3)), Depends(channel_permission())])
+def get_channel_games(
+    channel_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return crud.get_channel_games(db, channel_id, skip, limit)
+
+@app.post("/games/{game_id}/players/", response_model=schemas.GamePlayer)
+def join_game(
+    game_id: int,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.add_game_player, game_id=game_id, user_id=current_user.id)
+
+@app.put("/games/{game_id}/players/{user_id}", response_model=schemas.GamePlayer)
+def update_player_status(
+    game_id: int,
+    user_id: int,
+    player_data: Dict[str, Any],
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.update_game_player, game_id=game_id, user_id=user_id, player_data=player_data)
+
+# Music endpoints
+@app.get("/channels/{channel_id}/music/", response_model=List[schemas.MusicQueue])
+def get_music_queue(
+    channel_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    # Return the music queue from in-memory storage
+    player_state = music_players.get(channel_id, {'queue': []})
+    # Convert internal queue format to schema for response
+    return [schemas.MusicQueue(**track) for track in player_state['queue']]
+
+@app.post("/channels/{channel_id}/music/", response_model=schemas.MusicQueue)
+def add_to_queue(
+    channel_id: int,
+    music: schemas.MusicQueueCreate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    music_log.debug("add_to_queue called for channel %s with URL %s", channel_id, music.url)
+    # Add the music track to the in-memory queue
+    if channel_id not in music_players:
+        music_players[channel_id] = {'queue': [], 'current_index': -1, 'is_playing': False, 'current_time': 0.0}
+
+    # --- Извлечение информации о треке с помощью yt-dlp ---
+    try:
+        # Команда для вызова yt-dlp и получения информации в формате JSON
+        # -f bestaudio: Выбираем наилучший аудиоформат
+        # --dump-single-json: Выводит информацию о треке в формате JSON
+        command = ['yt-dlp', '-f', 'bestaudio', '--dump-single-json', music.url]
+        
+        # Запускаем yt-dlp как подпроцесс
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        
+        # Парсим JSON вывод
+        video_info = json.loads(result.stdout)
+        
+        # Извлекаем нужные данные
+        # yt-dlp может возвращать разные поля в зависимости от источника.
+        # Попробуем использовать common fields. Возможно, для VK/Яндекс потребуются корректировки.
+        extracted_url = video_info.get('url') or video_info.get('original_url') or video_info.get('http_url')
+        title = video_info.get('title', 'Unknown Title')
+        # yt-dlp не всегда предоставляет отдельное поле для исполнителя.
+        # Можно попробовать использовать uploader или комбинировать поля.
+        artist = video_info.get('artist') or video_info.get('uploader') or 'Unknown Artist'
+        duration = int(video_info.get('duration', 0) or 0)
+        
+        if not extracted_url:
+             raise ValueError("Could not extract playable URL from the provided link.")
+
+        # Используем извлеченные данные для создания объекта трека
+        track_data = {
+            'id': len(music_players[channel_id]['queue']), # Assign a simple ID
+            'channel_id': channel_id,
+            'title': title,
+            'artist': artist,
+            'url': extracted_url, # Используем извлеченную URL
+            'duration': duration,
+            'added_by_id': current_user.id,
+            'created_at': datetime.utcnow(), # Add the missing created_at field
+            'position': len(music_players[channel_id]['queue']), # Use index as position
+            'status': "queued",
+            # Можно добавить другие поля, если yt-dlp их предоставляет (например, thumbnail)
+            'image_url': video_info.get('thumbnail')
+        }
+        
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="yt-dlp not found. Please install it.")
+    except subprocess.CalledProcessError as e:
+        logger.error("Error calling yt-dlp: %s", e.stderr)
+        raise HTTPException(status_code=400, detail=f"Could not process the link: {e.stderr.strip()}")
+    except (json.JSONDecodeError, ValueError) as e:
+        logger.error("Error processing yt-dlp output or invalid data: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to extract music information from the link.")
+    except Exception as e:
+        logger.error("An unexpected error occurred during music extraction: %s", e)
+        raise HTTPException(status_code=500, detail="An internal error occurred while processing the link.")
+    # --- Конец секции yt-dlp ---
+
+    # Add the track data to the queue
+    music_players[channel_id]['queue'].append(track_data)
+
+    # If this is the first track, set it as current and start playing
+    if len(music_players[channel_id]['queue']) == 1:
+        music_players[channel_id]['current_index'] = 0
+        music_players[channel_id]['is_playing'] = True
+        music_players[channel_id]['current_time'] = 0.0
+        music_log.debug("First track added, setting is_playing to True for channel %s", channel_id)
+
+    # Return the added track (simplified response model mapping)
+    # Возвращаем объект, который соответствует схеме MusicQueue
+    response_track = schemas.MusicQueue(**track_data)
+    music_log.debug("add_to_queue finished for channel %s. Queue length: %s, Current index: %s, is_playing: %s", channel_id, len(music_players[channel_id]['queue']), music_players[channel_id]['current_index'], music_players[channel_id]['is_playing'])
+    return response_track
+
+@app.put("/music/{music_id}/status", response_model=schemas.MusicQueue)
+def update_music_status(
+    music_id: int,
+    status: str,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.update_music_status, music_id=music_id, status=status)
+
+@app.delete("/music/{music_id}")
+def remove_from_queue(
+    music_id: int,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    return writer.call(crud.remove_from_music_queue, music_id=music_id)
+
+@app.put("/music/{music_id}/play")
+def play_specific_track(music_id: int, channel_id: int):
+    """Set a specific track from the queue as currently playing."""
+    player_state = music_players.get(channel_id)
+    if not player_state or not player_state['queue']:
+        raise HTTPException(status_code=400, detail="Music queue is empty or channel not found")
+
+    # Find the index of the track with the given music_id
+    try:
+        track_index = next((i for i, track in enumerate(player_state['queue']) if track.get('id') == music_id), -1)
+    except StopIteration:
+         track_index = -1
+
+    if track_index == -1:
+        raise HTTPException(status_code=404, detail="Track not found in queue")
+
+    player_state['current_index'] = track_index
+    player_state['is_playing'] = True
+    player_state['current_time'] = 0.0 # Reset time when playing a new track
+
+    return {"status": "success", "current_track": player_state['queue'][track_index]}
+
+@app.post("/servers/{server_id}/invite", response_model=schemas.InviteCode, dependencies=[Depends(server_permission(Permission.CREATE_INVITE))])
+def create_server_invite(
+    server_id: int,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    # Create invite code and log the action in one transaction
+    return writer.call(
+        crud.with_audit_log,
+        crud.create_invite_code,
+        audit=lambda invite: dict(
+            server_id=server_id,
+            user_id=current_user.id,
+            action="create_invite",
+            target_type="invite",
+            changes={"code": invite.code}
+        ),
+        server_id=server_id,
+        user_id=current_user.id
+    )
+
+@app.post("/servers/join/{invite_code}")
+async def join_server(
+    invite_code: str,
+    current_user: models.User = Depends(auth.get_current_user),
+    db = Depends(get_async_db)
+):
+    # Get server by invite code
+    server = await async_crud.get_server_by_invite_code(db, invite_code)
+    if not server:
+        raise HTTPException(status_code=404, detail="Invalid or expired invite code")
+    
+    # Check if user is already a member
+    if await async_crud.is_user_server_member(db, current_user.id, server.id):
+        raise HTTPException(status_code=400, detail="Already a member of this server")
+    
+    # Add user to server and log the action in one transaction
+    await async_crud.add_user_to_server(
+        current_user.id,
+        server.id,
+        audit=dict(
+            server_id=server.id,
+            user_id=current_user.id,
+            action="join_server",
+            target_type="server",
+            target_id=server.id,
+            changes={}
+        )
+    )
+    
+    return {"message": "Successfully joined server", "server": server}
+
+@app.put("/users/{user_id}/credentials")
+def update_credentials(
+    user_id: int,
+    credentials: schemas.UserCredentialsUpdate,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    # Only allow users to update their own credentials
+    if current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    return writer.call(
+        crud.update_user_credentials,
+        user_id=user_id,
+        new_username=credentials.username,
+        hashed_password=auth.get_password_hash(credentials.password)
+    )
+
+@app.put("/fix-credentials/{user_id}")
+def fix_swapped_credentials(user_id: int):
+    """
+    Fix swapped username and password for a user.
+    This is a temporary endpoint to fix the issue.
+    """
+    writer.call(crud.fix_swapped_credentials, user_id=user_id)
+    return {"message": "Credentials fixed successfully"}
+
+# Создаем директорию для медиафайлов
+MEDIA_DIR = "media"
+os.makedirs(MEDIA_DIR, exist_ok=True)
+
+# Эндпоинты для управления участниками сервера
+@app.post("/servers/{server_id}/members", response_model=schemas.ServerMemberResponse, dependencies=[Depends(server_permission(Permission.MANAGE_MEMBERS))])
+def add_server_member(
+    server_id: int,
+    member: schemas.ServerMemberCreate
+):
+    db_member = writer.call(crud.add_server_member, server_id=server_id, user_id=member.user_id, role=member.role)
+    # ServerMember.role is the custom role relationship; the response's role is role_type
+    return schemas.ServerMemberResponse(
+        id=db_member.id,
+        server_id=db_member.server_id,
+        user_id=db_member.user_id,
+        role=db_member.role_type,
+        joined_at=db_member.joined_at
+    )
+
+@app.put("/servers/{server_id}/members/{user_id}", dependencies=[Depends(server_permission(Permission.MANAGE_MEMBERS))])
+def update_member_role(
+    server_id: int,
+    user_id: int,
+    role: str
+):
+    writer.call(crud.update_member_role, server_id=server_id, user_id=user_id, role=role)
+    return {"status": "success"}
+
+@app.delete("/servers/{server_id}/members/{user_id}", dependencies=[Depends(server_permission(Permission.MANAGE_MEMBERS))])
+def remove_server_member(
+    server_id: int,
+    user_id: int
+):
+    writer.call(crud.remove_server_member, server_id=server_id, user_id=user_id)
+    return {"status": "success"}
+
+# Эндпоинт для загрузки медиафайлов
+@app.post("/upload")
+async def upload_file(file: UploadFile = File(...)):
+    # Генерируем уникальное имя файла
+    file_extension = os.path.splitext(file.filename)[1]
+    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    file_path = os.path.join(MEDIA_DIR, unique_filename)
+    
+    # Сохраняем файл
+    await run_sync(_copy_upload, file, file_path)
+    
+    return {
+        "filename": unique_filename,
+        "original_name": file.filename,
+        "url": f"/media/{unique_filename}"
+    }
+
+# Add static file serving for media
+from fastapi.staticfiles import StaticFiles
+app.mount("/media", StaticFiles(directory="media"), name="media")
+
+@app.get("/api/channels/{channel_id}/participants")
+def get_channel_participants(channel_id: int):
+    participants = []
+    if channel_id in voice_manager.voice_channels:
+        for user_id in voice_manager.voice_channels[channel_id]:
+            state = voice_manager.user_states.get(user_id, {})
+            participants.append({
+                "id": user_id,
+                "isMuted": state.get("isMuted", False),
+                "isDeafened": state.get("isDeafened", False),
+                "isVideoEnabled": state.get("isVideoEnabled", False),
+                "isScreenSharing": state.get("isScreenSharing", False)
+            })
+    return {"participants": participants}
+
+@app.get("/music/current-track")
+def get_current_track(channel_id: int):
+    music_poll_log.debug("get_current_track called for channel %s", channel_id)
+    """Get the current playing track for a channel."""
+    player_state = music_players.get(channel_id)
+    if not player_state or player_state['current_index'] == -1:
+        music_poll_log.debug("get_current_track: No track playing for channel %s", channel_id)
+        return {"current_track": None, "is_playing": False, "current_time": 0.0}
+
+    current_track = player_state['queue'][player_state['current_index']]
+    music_poll_log.debug("get_current_track: Returning track %s for channel %s, is_playing: %s", current_track.get('title'), channel_id, player_state['is_playing'])
+    return {
+        "current_track": current_track,
+        "is_playing": player_state['is_playing'],
+        "current_time": player_state['current_time'] # Placeholder for tracking time
+    }
+
+@app.put("/music/playback-state")
+def update_playback_state(channel_id: int, state: Dict[str, bool]):
+    music_log.debug("update_playback_state called for channel %s with state %s", channel_id, state)
+    """Update the playback state (play/pause) for a channel."""
+    player_state = music_players.get(channel_id)
+    if not player_state or player_state['current_index'] == -1:
+        raise HTTPException(status_code=400, detail="No track is currently playing or queued in this channel")
+
+    if 'is_playing' in state:
+        player_state['is_playing'] = state['is_playing']
+        music_log.debug("Playback state updated to is_playing: %s for channel %s", player_state['is_playing'], channel_id)
+
+    # In a real implementation, you would control audio playback here
+    # For now, we just update the state
+
+    return {"status": "success", "is_playing": player_state['is_playing']}
+
+@app.post("/music/skip-next")
+def skip_next_track(channel_id: int):
+    music_log.debug("skip_next_track called for channel %s", channel_id)
+    """Skip to the next track in the queue for a channel."""
+    player_state = music_players.get(channel_id)
+    if not player_state or not player_state['queue']:
+        raise HTTPException(status_code=400, detail="Music queue is empty")
+
+    next_index = player_state['current_index'] + 1
+    if next_index < len(player_state['queue']):
+        player_state['current_index'] = next_index
+        player_state['is_playing'] = True # Assume playing after skipping
+        player_state['current_time'] = 0.0 # Reset time on skip
+        # In a real implementation, start playing the new track here
+        music_log.debug("Skipping to next track %s for channel %s. Setting is_playing to True.", next_index, channel_id)
+        return {"status": "success", "current_track": player_state['queue'][next_index]}
+    else:
+        # Reached end of queue
+        player_state['current_index'] = -1
+        player_state['is_playing'] = False
+        player_state['current_time'] = 0.0
+        music_log.debug("Reached end of queue for channel %s. Setting is_playing to False.", channel_id)
+        return {"status": "success", "current_track": None, "message": "End of queue"}
+
+@app.post("/music/skip-previous")
+def skip_previous_track(channel_id: int):
+    music_log.debug("skip_previous_track called for channel %s", channel_id)
+    """Skip to the previous track in the queue for a channel."""
+    player_state = music_players.get(channel_id)
+    if not player_state or not player_state['queue']:
+        raise HTTPException(status_code=400, detail="Music queue is empty")
+
+    prev_index = player_state['current_index'] - 1
+    if prev_index >= 0:
+        player_state['current_index'] = prev_index
+        player_state['is_playing'] = True # Assume playing after skipping
+        player_state['current_time'] = 0.0 # Reset time on skip
+        # In a real implementation, start playing the new track here
+        music_log.debug("Skipping to previous track %s for channel %s. Setting is_playing to True.", prev_index, channel_id)
+        return {"status": "success", "current_track": player_state['queue'][prev_index]}
+    else:
+        # Already at the beginning
+        music_log.debug("Already at beginning of queue for channel %s.", channel_id)
+        return {"status": "success", "current_track": player_state['queue'][0], "message": "Already at the beginning"}
+
+if __name__ == "__main__":
+    def find_free_port(start_port=8000, max_port=8999):
+        for port in range(start_port, max_port + 1):
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.bind(('', port))
+                    return port
+            except OSError:
+                continue
+        return None
+
+    port = find_free_port()
+    if port is None:
+        print("No free ports available")
+        exit(1)
+        
+    print(f"Starting server on port {port}")
+    import uvicorn
     uvicorn.run(app, host=config.SERVER_IP, port=port) 
\ No newline at end of file
@@ -0,0 +1,292 @@
+"""
+Retention and compaction for append-only log tables.
+
+``login_history`` gets a row per login attempt and ``audit_logs`` one per
+admin action. The scheduler here wakes up every
+``RETENTION_INTERVAL_SECONDS`` and removes rows older than each table's
+retention window (``RETENTION_POLICIES``), ``RETENTION_BATCH_SIZE`` rows at
+a time. Every batch is its own short write job on the single writer, with a
+pause in between, so the write lock is never held for long and requests
+keep going while a large backlog is pruned.
+
+Tables with ``archive`` set are copied to gzip-compressed JSONL segments
+under ``RETENTION_ARCHIVE_DIR/<table>/`` before their rows are deleted; each
+batch is flushed to the segment first, so a crash can at worst archive a
+row twice, never lose it. After pruning, freed pages are returned to the
+file system with ``PRAGMA incremental_vacuum`` (needs
+``auto_vacuum=INCREMENTAL``, see the ``enable-incremental-vacuum`` command).
+
+Old rows have the lowest ids, so batches are picked by a rowid scan that
+stops after ``RETENTION_BATCH_SIZE`` matches; no index on the timestamp is
+needed.
+
+The sync change feed (``change_log``, see changes.py) is compacted in the
+same pass and the same batches: entries older than ``SYNC_RETENTION_DAYS``
+expire, then entries superseded by a later one for the same row go.
+
+    python maintenance.py run                        # one pass now
+    python maintenance.py enable-incremental-vacuum  # one-off full VACUUM
+"""
+import argparse
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import changes
+import config
+import models
+from database import engine, read_engine
+from db_writer import writer
+from app_logging import get_logger
+
+logger = get_logger("maintenance")
+
+# Table name -> (model, timestamp column)
+RETAINED_TABLES = {
+    "login_history": (models.LoginHistory, models.LoginHistory.login_time),
+    "audit_logs": (models.AuditLog, models.AuditLog.created_at),
+}
+
+# Delete jobs, run on the db writer
+def _delete_expired(db: Session, table: str, cutoff: datetime, limit: int) -> int:
+    model, timestamp = RETAINED_TABLES[table]
+    expired = select(model.id).where(timestamp < cutoff).order_by(model.id).limit(limit)
+    result = db.execute(delete(model.__table__).where(model.id.in_(expired.scalar_subquery())))
+    db.commit()
+    return result.rowcount
+
+def _delete_ids(db: Session, table: str, ids: List[int]) -> int:
+    model, _ = RETAINED_TABLES[table]
+    result = db.execute(delete(model.__table__).where(model.id.in_(ids)))
+    db.commit()
+    return result.rowcount
+
+def _incremental_vacuum(bind: Engine, pages: int) -> int:
+    # pysqlite's execute() steps the pragma once, which frees a single page;
+    # executescript() runs it to completion in its own short transaction.
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        cursor.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        after = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        connection.close()
+    return before - after
+
+class _Segment:
+    """One gzip JSONL archive file, created on first write."""
+
+    def __init__(self, directory: str, table: str):
+        self.directory = os.path.join(directory, table)
+        self.table = table
+        self.path = None
+        self._file = None
+
+    def write(self, rows: list):
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+            self.path = os.path.join(self.directory, f"{self.table}-{stamp}-{rows[0]['id']}.jsonl.gz")
+            self._file = gzip.open(self.path, "ab")
+        for row in rows:
+            self._file.write(json.dumps(row, default=str, ensure_ascii=False).encode() + b"\n")
+        # Rows must be on disk before they are deleted
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+        os.fsync(self._file.fileobj.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class RetentionScheduler:
+    def __init__(
+        self,
+        policies: dict = config.RETENTION_POLICIES,
+        interval: float = config.RETENTION_INTERVAL_SECONDS,
+        batch_size: int = config.RETENTION_BATCH_SIZE,
+        batch_pause_ms: float = config.RETENTION_BATCH_PAUSE_MS,
+        archive_dir: str = config.RETENTION_ARCHIVE_DIR,
+        vacuum_pages: int = config.RETENTION_VACUUM_PAGES
+    ):
+        self.policies = policies
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000
+        self.archive_dir = archive_dir
+        self.vacuum_pages = vacuum_pages
+        self.history: deque = deque(maxlen=20)
+        self._stop = threading.Event()
+        self._thread = None
+        self._run_lock = threading.Lock()
+        self._vacuum_warned = False
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop after the current batch; a run in progress resumes next time."""
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def run_once(self) -> dict:
+        """Prune every configured table, then vacuum. Returns the run's stats."""
+        with self._run_lock:
+            started = time.perf_counter()
+            stats = {"started_at": datetime.utcnow().isoformat(), "tables": {}}
+            for table, policy in self.policies.items():
+                if self._stop.is_set():
+                    break
+                try:
+                    stats["tables"][table] = self._prune(table, policy)
+                except Exception:
+                    logger.exception("Retention for %s failed", table)
+                    stats["tables"][table] = {"error": True}
+            if not self._stop.is_set():
+                try:
+                    stats["change_log"] = self._compact_change_log()
+                except Exception:
+                    logger.exception("Change log compaction failed")
+                    stats["change_log"] = {"error": True}
+            stats["vacuumed_pages"] = self._vacuum()
+            stats["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self.history.append(stats)
+            removed = sum(t.get("deleted", 0) for t in stats["tables"].values())
+            removed += sum(stats.get("change_log", {}).get(key, 0) for key in ("expired", "superseded"))
+            logger.info(
+                "Retention run removed %s rows, freed %s pages in %.1f ms",
+                removed, stats["vacuumed_pages"], stats["duration_ms"]
+            )
+            return stats
+
+    def stats(self) -> dict:
+        return {
+            "policies": self.policies,
+            "interval_seconds": self.interval,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "runs": list(self.history),
+        }
+
+    def _loop(self):
+        # First pass soon after startup, so frequent restarts don't starve it
+        delay = min(self.interval, 60)
+        while not self._stop.wait(delay):
+            delay = self.interval
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Retention run failed")
+
+    def _prune(self, table: str, policy: dict) -> dict:
+        cutoff = datetime.utcnow() - timedelta(days=policy["days"])
+        result = {"cutoff": cutoff.isoformat(), "deleted": 0, "batches": 0}
+        segment = _Segment(self.archive_dir, table) if policy.get("archive") else None
+        try:
+            while not self._stop.is_set():
+                if segment is not None:
+                    rows = self._read_expired(table, cutoff)
+                    if not rows:
+                        break
+                    segment.write(rows)
+                    deleted = writer.call(_delete_ids, table=table, ids=[row["id"] for row in rows])
+                    result["archived"] = result.get("archived", 0) + len(rows)
+                else:
+                    deleted = writer.call(_delete_expired, table=table, cutoff=cutoff, limit=self.batch_size)
+                    if not deleted:
+                        break
+                result["deleted"] += deleted
+                result["batches"] += 1
+                time.sleep(self.batch_pause)
+        finally:
+            if segment is not None:
+                segment.close()
+                result["segment"] = segment.path
+        return result
+
+    def _compact_change_log(self) -> dict:
+        cutoff = changes.expiry_cutoff()
+        result = {"cutoff": cutoff.isoformat(), "expired": 0, "superseded": 0, "batches": 0}
+        for key, job, kwargs in (
+            ("expired", changes.expire, {"cutoff": cutoff}),
+            ("superseded", changes.drop_superseded, {}),
+        ):
+            while not self._stop.is_set():
+                deleted = writer.call(job, limit=self.batch_size, **kwargs)
+                if not deleted:
+                    break
+                result[key] += deleted
+                result["batches"] += 1
+                time.sleep(self.batch_pause)
+        return result
+
+    def _read_expired(self, table: str, cutoff: datetime) -> list:
+        model, timestamp = RETAINED_TABLES[table]
+        with read_engine.connect() as conn:
+            rows = conn.execute(
+                select(model.__table__).where(timestamp < cutoff).order_by(model.id).limit(self.batch_size)
+            ).mappings().all()
+        return [dict(row) for row in rows]
+
+    def _vacuum(self) -> int:
+        if not self.vacuum_pages:
+            return 0
+        with read_engine.connect() as conn:
+            mode = conn.execute(text("PRAGMA auto_vacuum")).scalar()
+        if mode != 2:
+            if not self._vacuum_warned:
+                logger.info(
+                    "auto_vacuum is not INCREMENTAL, freed pages stay in the file; "
+                    "run: python maintenance.py enable-incremental-vacuum"
+                )
+                self._vacuum_warned = True
+            return 0
+        return _incremental_vacuum(engine, self.vacuum_pages)
+
+def enable_incremental_vacuum(bind: Engine = engine):
+    """
+    Switch the database to auto_vacuum=INCREMENTAL. This rewrites the whole
+    file with VACUUM, so run it while the server is stopped.
+    """
+    # VACUUM can't run inside a transaction, so bypass SQLAlchemy's
+    connection = bind.raw_connection()
+    try:
+        connection.isolation_level = None
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("VACUUM")
+        mode = cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        connection.close()
+    logger.info("auto_vacuum is now %s", {0: "NONE", 1: "FULL", 2: "INCREMENTAL"}.get(mode, mode))
+
+retention = RetentionScheduler()
+
+if __name__ == "__main__":
+    from app_logging import setup_logging
+
+    parser = argparse.ArgumentParser(description="Log table retention and compaction")
+    parser.add_argument("command", choices=["run", "enable-incremental-vacuum"])
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.command == "run":
+        print(json.dumps(retention.run_once(), indent=2, default=str))
+        writer.stop()
+    else:
+        enable_incremental_vacuum()
@@ -0,0 +1,106 @@
+"""
+@mentions, parsed when a message is written.
+
+``resolve()`` finds ``@username`` tokens in new or edited messages and maps
+them to users who are members of the message's server, filling the
+``Message.mentions`` JSON column before the INSERT/UPDATE. ``store()`` then
+mirrors them into ``message_mentions`` (primary key user_id, message_id), so
+"my mentions" is an index range scan instead of a scan over every message.
+Both run inside the crud transaction that writes the message.
+
+Messages written before the table existed are picked up by:
+
+    python mentions.py backfill [--batch 2000]
+"""
+import argparse
+import re
+import time
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import and_, delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import models
+from app_logging import get_logger
+
+logger = get_logger("mentions")
+
+MENTION_RE = re.compile(r"(?<![\w@])@([\w.\-]{3,32})")
+
+def parse_usernames(content: str) -> List[str]:
+    """``@username`` tokens in order of appearance, without duplicates."""
+    if not content:
+        return []
+    names = (match.rstrip(".-") for match in MENTION_RE.findall(content))
+    return list(dict.fromkeys(name for name in names if len(name) >= 3))
+
+def _lookup(db: Session, names: Set[str], channel_ids: Set[int]) -> Dict[Tuple[int, str], int]:
+    """(channel_id, username) -> user_id for users who can see those channels."""
+    if not names:
+        return {}
+    rows = db.execute(
+        select(models.Channel.id, models.User.username, models.User.id)
+        .join(models.ServerMember, models.ServerMember.server_id == models.Channel.server_id)
+        .join(models.User, models.User.id == models.ServerMember.user_id)
+        .where(models.Channel.id.in_(channel_ids), models.User.username.in_(names))
+    ).all()
+    return {(channel_id, username): user_id for channel_id, username, user_id in rows}
+
+def resolve(db: Session, messages: Iterable[models.Message]) -> None:
+    """Set ``message.mentions`` to the mentioned user ids, one query per batch."""
+    messages = list(messages)
+    parsed = [parse_usernames(m.content) for m in messages]
+    names = {name for message_names in parsed for name in message_names}
+    known = _lookup(db, names, {m.channel_id for m in messages})
+    for message, message_names in zip(messages, parsed):
+        user_ids = (known.get((message.channel_id, name)) for name in message_names)
+        message.mentions = [uid for uid in dict.fromkeys(user_ids) if uid is not None and uid != message.author_id]
+
+def store(db: Session, messages: Iterable[models.Message], replace: bool = False) -> None:
+    """
+    Write ``message_mentions`` rows for flushed messages. With ``replace``
+    the previous rows of those messages are removed first (edits).
+    """
+    messages = list(messages)
+    if replace:
+        unstore(db, [m.id for m in messages])
+    rows = [{"user_id": uid, "message_id": m.id} for m in messages for uid in (m.mentions or [])]
+    if rows:
+        db.execute(sqlite_insert(models.MessageMention).on_conflict_do_nothing(), rows)
+
+def unstore(db: Session, message_ids: List[int]) -> None:
+    db.execute(delete(models.MessageMention).where(models.MessageMention.message_id.in_(message_ids)))
+
+def backfill(batch_size: int = 2000, bind=None) -> int:
+    """Parse and store mentions for every existing message, one id range per transaction."""
+    from database import SessionLocal, engine
+
+    bind = bind or engine
+    with bind.connect() as conn:
+        max_id = conn.execute(select(models.Message.id).order_by(models.Message.id.desc()).limit(1)).scalar() or 0
+    total = 0
+    started = time.perf_counter()
+    for low in range(0, max_id, batch_size):
+        with SessionLocal(bind=bind) as db, db.begin():
+            messages = db.query(models.Message).filter(
+                and_(models.Message.id > low, models.Message.id <= low + batch_size),
+                models.Message.content.isnot(None)
+            ).all()
+            resolve(db, messages)
+            store(db, messages, replace=True)
+            total += sum(1 for m in messages if m.mentions)
+        logger.info("Scanned ids up to %s of %s, %s messages with mentions", min(low + batch_size, max_id), max_id, total)
+    logger.info("Mention backfill finished in %.1f s", time.perf_counter() - started)
+    return total
+
+if __name__ == "__main__":
+    from app_logging import setup_logging
+
+    parser = argparse.ArgumentParser(description="Message mention index maintenance")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch", type=int, default=2000, help="messages per transaction")
+    args = parser.parse_args()
+
+    setup_logging()
+    backfill(batch_size=args.batch)
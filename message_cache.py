@@ -0,0 +1,264 @@
+"""
+In-memory cache of the newest messages per channel.
+
+Almost every history request is for the newest page of a channel. For each
+recently read channel we keep a ring buffer with the last
+``MESSAGE_CACHE_PER_CHANNEL`` messages, already serialized to JSON, and
+answer newest-page requests by joining those bytes, without touching SQLite
+or pydantic. The buffer is filled by the first read and then kept current by
+the write paths (create, reply, edit, delete, reaction). Channels are evicted in
+LRU order once the cached bytes exceed ``MESSAGE_CACHE_MAX_BYTES``.
+
+Sync endpoints run on a thread pool, so all state is guarded by one lock.
+A fill started before a concurrent write to the same channel is discarded
+rather than installed over the newer state.
+
+Inside an atomic batch (``db_writer.transaction()``) writes reach the cache
+only once the batch has committed, through ``writer.on_commit()``, and the
+batch's own reads bypass the cache so they see its uncommitted writes.
+"""
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import config
+import schemas
+from db_writer import writer
+from app_logging import get_logger
+
+logger = get_logger("cache")
+
+# Rough per-entry cost on top of the JSON itself (tuple, model, list slot)
+_ENTRY_OVERHEAD = 512
+
+class _Entry:
+    __slots__ = ("key", "model", "data")
+
+    def __init__(self, message: schemas.Message):
+        self.key = (message.created_at, message.id)
+        self.model = message
+        self.data = message.model_dump_json().encode()
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + _ENTRY_OVERHEAD
+
+class _ChannelBuffer:
+    """Newest messages of one channel, oldest first, contiguous in history."""
+    __slots__ = ("entries", "keys", "size", "complete")
+
+    def __init__(self, entries: List[_Entry], complete: bool):
+        self.entries = entries
+        self.keys = [entry.key for entry in entries]
+        self.size = sum(entry.size for entry in entries)
+        # True when the buffer holds the channel's entire history
+        self.complete = complete
+
+    def index(self, message_id: int) -> Optional[int]:
+        for i in range(len(self.entries) - 1, -1, -1):
+            if self.entries[i].key[1] == message_id:
+                return i
+        return None
+
+class CachedPage:
+    """A newest page served from the cache: JSON body plus its edge keys."""
+    __slots__ = ("body", "oldest", "newest", "count")
+
+    def __init__(self, entries: List[_Entry]):
+        self.body = b"[" + b",".join(entry.data for entry in entries) + b"]"
+        self.count = len(entries)
+        self.oldest = entries[0].key if entries else None
+        self.newest = entries[-1].key if entries else None
+
+class MessageCache:
+    def __init__(
+        self,
+        per_channel: int = config.MESSAGE_CACHE_PER_CHANNEL,
+        max_bytes: int = config.MESSAGE_CACHE_MAX_BYTES,
+        enabled: bool = config.MESSAGE_CACHE_ENABLED
+    ):
+        self.per_channel = per_channel
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._channels: "OrderedDict[int, _ChannelBuffer]" = OrderedDict()
+        self._generations: Dict[int, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Reads
+    def get_newest(self, channel_id: int, limit: int) -> Optional[CachedPage]:
+        """The newest ``limit`` messages of a channel, or None on a miss."""
+        if not self.enabled or writer.in_transaction():
+            return None
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            if buffer is None or (len(buffer.entries) < limit and not buffer.complete):
+                self.misses += 1
+                return None
+            self._channels.move_to_end(channel_id)
+            self.hits += 1
+            return CachedPage(buffer.entries[-limit:])
+
+    def generation(self, channel_id: int) -> int:
+        """Token to pass to fill(); any later write to the channel invalidates it."""
+        with self._lock:
+            return self._generations.get(channel_id, 0)
+
+    def fill(self, channel_id: int, generation: int, messages: list):
+        """
+        Install the newest page read from the database (oldest first).
+        ``messages`` should be a full ``per_channel`` page; a shorter one
+        means the channel has no older messages.
+        """
+        if not self.enabled or writer.in_transaction():
+            return
+        entries = [_Entry(schemas.Message.model_validate(m, from_attributes=True)) for m in messages[-self.per_channel:]]
+        buffer = _ChannelBuffer(entries, complete=len(messages) < self.per_channel)
+        with self._lock:
+            if self._generations.get(channel_id, 0) != generation:
+                return
+            old = self._channels.pop(channel_id, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._channels[channel_id] = buffer
+            self._bytes += buffer.size
+            self._evict()
+
+    # Writes
+    def add(self, message):
+        """A new message was stored."""
+        self._apply(message.channel_id, self._add, message)
+
+    def update(self, message):
+        """A message was edited or its reactions changed."""
+        self._apply(message.channel_id, self._update, message)
+
+    def remove(self, channel_id: int, message_id: int):
+        self._apply(channel_id, self._remove, message_id)
+
+    def set_reactions(self, channel_id: int, message_id: int, totals: list):
+        reactions = [schemas.ReactionTotal.model_validate(t, from_attributes=True) for t in totals]
+        self.patch(channel_id, message_id, lambda model: {"reactions": reactions})
+
+    def reply_added(self, reply):
+        """Bump the cached parent's thread summary after a reply was stored."""
+        def bump(model: schemas.Message) -> dict:
+            latest = max(filter(None, (model.last_reply_at, reply.created_at)))
+            return {"reply_count": model.reply_count + 1, "last_reply_at": latest}
+        self.patch(reply.channel_id, reply.parent_id, bump)
+
+    def patch(self, channel_id: int, message_id: int, changes):
+        """
+        Change fields of a cached message in place. ``changes`` maps the
+        cached model to a dict of new field values and runs under the lock,
+        so concurrent patches of the same message don't lose updates.
+        """
+        self._apply(channel_id, self._patch, message_id, changes)
+
+    def contains(self, channel_id: int, message_id: int) -> bool:
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            return buffer is not None and buffer.index(message_id) is not None
+
+    def drop(self, channel_id: int):
+        """Forget a channel, e.g. when it is deleted."""
+        self._apply(channel_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "channels": len(self._channels),
+                "messages": sum(len(b.entries) for b in self._channels.values()),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+    # Internals
+    def _apply(self, channel_id: int, change, *args):
+        if not self.enabled:
+            return
+        # Serialize before taking the lock
+        prepared = None
+        if change in (self._add, self._update):
+            prepared = _Entry(schemas.Message.model_validate(args[0], from_attributes=True))
+        writer.on_commit(lambda: self._apply_now(channel_id, change, prepared, args))
+
+    def _apply_now(self, channel_id: int, change, prepared: Optional[_Entry], args: tuple):
+        with self._lock:
+            self._generations[channel_id] = self._generations.get(channel_id, 0) + 1
+            buffer = self._channels.get(channel_id)
+            if buffer is None:
+                return
+            if change is None:
+                del self._channels[channel_id]
+                self._bytes -= buffer.size
+                return
+            before = buffer.size
+            if prepared is not None:
+                change(buffer, prepared)
+            else:
+                change(buffer, *args)
+            self._bytes += buffer.size - before
+            self._evict()
+
+    # Called by _apply() with the lock held
+    def _add(self, buffer: _ChannelBuffer, entry: _Entry):
+        position = bisect.bisect_left(buffer.keys, entry.key)
+        if position < len(buffer.keys) and buffer.keys[position] == entry.key:
+            return
+        if position == 0 and not buffer.complete and buffer.entries:
+            # Older than anything cached: not part of the newest window
+            return
+        buffer.entries.insert(position, entry)
+        buffer.keys.insert(position, entry.key)
+        buffer.size += entry.size
+        while len(buffer.entries) > self.per_channel:
+            dropped = buffer.entries.pop(0)
+            buffer.keys.pop(0)
+            buffer.size -= dropped.size
+            buffer.complete = False
+
+    def _update(self, buffer: _ChannelBuffer, entry: _Entry):
+        i = buffer.index(entry.key[1])
+        if i is not None:
+            buffer.size += entry.size - buffer.entries[i].size
+            buffer.entries[i] = entry
+
+    def _remove(self, buffer: _ChannelBuffer, message_id: int):
+        i = buffer.index(message_id)
+        if i is not None:
+            buffer.size -= buffer.entries[i].size
+            del buffer.entries[i]
+            del buffer.keys[i]
+
+    def _patch(self, buffer: _ChannelBuffer, message_id: int, changes):
+        i = buffer.index(message_id)
+        if i is None:
+            return
+        model = buffer.entries[i].model
+        entry = _Entry(model.model_copy(update=changes(model)))
+        buffer.size += entry.size - buffer.entries[i].size
+        buffer.entries[i] = entry
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._channels) > 1:
+            channel_id, buffer = self._channels.popitem(last=False)
+            self._bytes -= buffer.size
+            self.evictions += 1
+            logger.debug("Evicted channel %s from message cache (%s bytes)", channel_id, buffer.size)
+
+message_cache = MessageCache()
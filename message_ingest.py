@@ -0,0 +1,121 @@
+"""
+Group-commit ingestion for new messages.
+
+Each posted message used to be its own writer job followed by a SELECT of
+the row it had just created. Here concurrent posts are gathered for up to
+``MESSAGE_INGEST_LINGER_MS`` (or until ``MESSAGE_INGEST_MAX_BATCH`` are
+waiting), inserted by one writer job with a single multi-row INSERT ...
+RETURNING, and every caller gets its own row back. The response is built
+from that row and the author the endpoint already has, without re-reading.
+
+If a batch fails, its messages are retried one by one so a single bad row
+only fails its own request.
+"""
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+import config
+import crud
+import models
+import schemas
+from db_writer import writer
+from app_logging import get_logger
+
+logger = get_logger("db.ingest")
+
+class MessageIngestor:
+    def __init__(
+        self,
+        linger_ms: float = config.MESSAGE_INGEST_LINGER_MS,
+        max_batch: int = config.MESSAGE_INGEST_MAX_BATCH
+    ):
+        self.linger = linger_ms / 1000
+        self.max_batch = max_batch
+        self._pending: list = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.batches = 0
+        self.messages = 0
+
+    async def submit(self, message: schemas.MessageCreate, author: models.User, channel_id: int) -> models.Message:
+        """Queue a message for the next batch and wait for its stored row."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        row = dict(
+            message.model_dump(),
+            author_id=author.id,
+            channel_id=channel_id,
+            created_at=datetime.utcnow()
+        )
+        if writer.in_transaction():
+            # part of an atomic batch: written on its transaction, not grouped
+            await self._write_one(row, author, future)
+            return await future
+        self._pending.append((row, author, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self._flush_now)
+        return await future
+
+    async def flush(self):
+        """Write whatever is pending now and wait for batches in flight, e.g. on shutdown."""
+        batch = self._take()
+        if batch:
+            await self._write(batch)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _take(self) -> list:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _flush_now(self):
+        batch = self._take()
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._write(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch: list):
+        try:
+            stored = await writer.run(crud.create_messages, rows=[row for row, _, _ in batch])
+        except Exception as exc:
+            if len(batch) == 1:
+                future = batch[0][2]
+                if not future.done():
+                    future.set_exception(exc)
+                return
+            logger.warning("Batch of %s messages failed, retrying one by one", len(batch), exc_info=True)
+            await asyncio.gather(*(self._write_one(row, author, future) for row, author, future in batch))
+            return
+
+        self.batches += 1
+        self.messages += len(batch)
+        for db_message, (_, author, future) in zip(stored, batch):
+            self._resolve(future, db_message, author)
+
+    async def _write_one(self, row: dict, author: models.User, future: asyncio.Future):
+        try:
+            stored = await writer.run(crud.create_messages, rows=[row])
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+            return
+        self._resolve(future, stored[0], author)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, db_message: models.Message, author: models.User):
+        # A brand-new message has no reactions; the author is the caller
+        set_committed_value(db_message, "author", author)
+        set_committed_value(db_message, "reaction_counts", [])
+        if not future.done():
+            future.set_result(db_message)
+
+message_ingestor = MessageIngestor()
@@ -0,0 +1,174 @@
+"""
+Versioned schema migrations.
+
+``create_all`` only creates missing tables and never alters existing ones,
+so indexes, constraints and columns added to ``models`` after a database was
+created are applied here. Each migration runs once, in its own short
+transaction, and is recorded in ``schema_migrations``. Statements are written
+to be no-ops on a fresh database where ``create_all`` already built the
+current schema.
+
+    python migrations.py          # apply pending migrations
+    python migrations.py status   # list applied / pending versions
+"""
+import sys
+import time
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+import models
+import search
+from database import engine
+from app_logging import get_logger
+
+logger = get_logger("migrations")
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+MIGRATIONS: List[Migration] = []
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS.append(Migration(version, description, fn))
+        return fn
+    return register
+
+def _create_indexes(conn: Connection, *names: str):
+    """Create the named indexes exactly as they are declared in models."""
+    wanted = set(names)
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                index.create(conn, checkfirst=True)
+                wanted.discard(index.name)
+    if wanted:
+        raise RuntimeError(f"Indexes not declared in models: {sorted(wanted)}")
+
+def _dedupe(conn: Connection, table: str, *columns: str):
+    """Delete duplicate rows so a unique index can be built, keeping the oldest."""
+    cols = ", ".join(columns)
+    result = conn.execute(text(
+        f"DELETE FROM {table} WHERE rowid NOT IN "
+        f"(SELECT MIN(rowid) FROM {table} GROUP BY {cols})"
+    ))
+    if result.rowcount:
+        logger.warning("Removed %s duplicate rows from %s", result.rowcount, table)
+
+@migration(1, "composite and unique indexes for hot query shapes")
+def _hot_query_indexes(conn: Connection):
+    _dedupe(conn, "server_members", "server_id", "user_id")
+    _create_indexes(
+        conn,
+        "ix_messages_channel_created",
+        "uq_server_members_server_user",
+        "ix_audit_logs_server_created",
+        "ix_login_history_user_ip_time",
+        "ix_media_channel_created",
+        "ix_music_queues_channel_position",
+    )
+
+@migration(2, "unique reactions and per-message reaction counts")
+def _reaction_counts(conn: Connection):
+    # Replaces the plain (message, user, emoji) index from the first cut of migration 1
+    conn.execute(text("DROP INDEX IF EXISTS ix_message_reactions_message_user_emoji"))
+    _dedupe(conn, "message_reactions", "message_id", "user_id", "emoji")
+    _create_indexes(conn, "uq_message_reactions_message_user_emoji")
+    models.MessageReactionCount.__table__.create(conn, checkfirst=True)
+    conn.execute(text(
+        "INSERT OR REPLACE INTO message_reaction_counts (message_id, emoji, count) "
+        "SELECT message_id, emoji, COUNT(*) FROM message_reactions GROUP BY message_id, emoji"
+    ))
+
+@migration(3, "full-text search table for messages")
+def _message_search(conn: Connection):
+    conn.execute(text(search.CREATE_FTS_TABLE))
+    has_messages = conn.execute(text("SELECT 1 FROM messages WHERE content IS NOT NULL LIMIT 1")).first()
+    if has_messages:
+        logger.warning("Existing messages aren't searchable yet, run: python search.py reindex")
+
+@migration(4, "message_mentions table")
+def _message_mentions(conn: Connection):
+    models.MessageMention.__table__.create(conn, checkfirst=True)
+    _create_indexes(conn, "ix_message_mentions_message")
+    has_messages = conn.execute(text("SELECT 1 FROM messages WHERE content LIKE '%@%' LIMIT 1")).first()
+    if has_messages:
+        logger.warning("Mentions in existing messages aren't indexed yet, run: python mentions.py backfill")
+
+@migration(5, "reply counters on messages")
+def _thread_counters(conn: Connection):
+    columns = {row[1] for row in conn.execute(text("PRAGMA table_info(messages)"))}
+    if "reply_count" not in columns:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0"))
+    if "last_reply_at" not in columns:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN last_reply_at DATETIME"))
+    _create_indexes(conn, "ix_messages_parent")
+    conn.execute(text(
+        "UPDATE messages SET "
+        "reply_count = (SELECT COUNT(*) FROM messages r WHERE r.parent_id = messages.id), "
+        "last_reply_at = (SELECT MAX(r.created_at) FROM messages r WHERE r.parent_id = messages.id) "
+        "WHERE id IN (SELECT parent_id FROM messages WHERE parent_id IS NOT NULL)"
+    ))
+
+@migration(6, "change_log table for delta sync")
+def _change_log(conn: Connection):
+    models.ChangeLogEntry.__table__.create(conn, checkfirst=True)
+    _create_indexes(conn, "ix_change_log_server_seq", "ix_change_log_user_seq", "ix_change_log_entity")
+
+def _ensure_version_table(bind: Engine):
+    with bind.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "description TEXT NOT NULL, "
+            "applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+        ))
+
+def applied_versions(bind: Engine = engine) -> set:
+    _ensure_version_table(bind)
+    with bind.connect() as conn:
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+def create_schema(bind: Engine = engine) -> List[int]:
+    """Create missing tables, then apply pending migrations (app startup, init_db)."""
+    models.Base.metadata.create_all(bind=bind)
+    return run_migrations(bind)
+
+def run_migrations(bind: Engine = engine) -> List[int]:
+    """
+    Apply pending migrations in version order and return the applied versions.
+    Each migration is its own transaction, so the write lock is only held for
+    the duration of one index build or backfill and readers keep going (WAL).
+    """
+    done = applied_versions(bind)
+    applied = []
+    for item in sorted(MIGRATIONS, key=lambda m: m.version):
+        if item.version in done:
+            continue
+        started = time.perf_counter()
+        with bind.begin() as conn:
+            item.upgrade(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": item.version, "description": item.description}
+            )
+        logger.info(
+            "Applied migration %s (%s) in %.1f ms",
+            item.version, item.description, (time.perf_counter() - started) * 1000
+        )
+        applied.append(item.version)
+    return applied
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        done = applied_versions()
+        for item in sorted(MIGRATIONS, key=lambda m: m.version):
+            state = "applied" if item.version in done else "pending"
+            print(f"{item.version:4}  {state:8} {item.description}")
+    else:
+        versions = create_schema()
+        print(f"Applied migrations: {versions or 'none'}")
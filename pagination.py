@@ -0,0 +1,52 @@
+"""
+Opaque keyset cursors.
+
+A cursor is the sort key of the row a page ends at plus the direction to
+continue in, packed into URL-safe base64 so clients treat it as a token.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+BEFORE = "b"
+AFTER = "a"
+
+def encode_cursor(direction: str, *key: Any) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    raw = json.dumps([direction, *values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, List[Any]]:
+    """Return ``(direction, key)``. Raises ValueError for anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, *key = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("Malformed cursor")
+    if direction not in (BEFORE, AFTER) or not key:
+        raise ValueError("Malformed cursor")
+    return direction, key
+
+def page_cursors(oldest, newest, count: int, limit: int, going_forward: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Cursors for the older and the newer page next to one whose edge keys
+    are ``oldest`` and ``newest``. A short page going back means the start
+    has been reached, so there is no older cursor.
+    """
+    if count == 0:
+        return None, None
+    older = encode_cursor(BEFORE, *oldest) if going_forward or count == limit else None
+    return older, encode_cursor(AFTER, *newest)
+
+def message_key(message) -> Tuple[datetime, int]:
+    return message.created_at, message.id
+
+def decode_message_cursor(cursor: str) -> Tuple[str, Tuple[datetime, int]]:
+    direction, key = decode_cursor(cursor)
+    try:
+        created_at, message_id = key
+        return direction, (datetime.fromisoformat(created_at), int(message_id))
+    except (TypeError, ValueError):
+        raise ValueError("Malformed cursor")
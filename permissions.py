@@ -0,0 +1,298 @@
+"""
+Server permissions as bitmasks, resolved once and cached.
+
+A member's effective permissions are the defaults of their ``role_type``
+plus whatever their custom role's ``Role.permissions`` JSON grants
+(``{"manage_channels": true, ...}``, keys are ``Permission`` names in any
+case). The server owner and ``ADMINISTRATOR`` have everything; non-members
+have nothing.
+
+Resolving costs one query: server (or channel -> server), owner, membership
+and role in a single join. Results are cached per (server_id, user_id) and
+channel ids are mapped to their server, so most requests authorize without
+touching the database. Invalidation is event driven: a session flush that
+touches a member, role, server or channel records the keys it affects, and
+they are dropped from the cache once the transaction commits. A lookup that
+raced with such a commit isn't stored.
+
+Endpoints take ``Depends(server_permission(Permission.X))`` or
+``Depends(channel_permission(Permission.X))``; where the server is only
+known after loading a row (roles, messages), call ``authorize()``.
+"""
+import enum
+import threading
+from collections import OrderedDict
+from functools import reduce
+from typing import NamedTuple, Optional
+
+from fastapi import Depends, HTTPException
+from sqlalchemy import and_, event, select
+from sqlalchemy.orm import Session
+
+import auth
+import config
+import models
+from database import get_read_db
+from app_logging import get_logger
+
+logger = get_logger("permissions")
+
+class Permission(enum.IntFlag):
+    NONE = 0
+    VIEW_CHANNELS = 1 << 0
+    SEND_MESSAGES = 1 << 1
+    ADD_REACTIONS = 1 << 2
+    CREATE_INVITE = 1 << 3
+    MANAGE_MESSAGES = 1 << 4
+    MANAGE_CHANNELS = 1 << 5
+    MANAGE_ROLES = 1 << 6
+    MANAGE_MEMBERS = 1 << 7
+    VIEW_AUDIT_LOG = 1 << 8
+    MANAGE_SERVER = 1 << 9
+    ADMINISTRATOR = 1 << 10
+
+ALL_PERMISSIONS = reduce(lambda a, b: a | b, Permission)
+
+_MEMBER_DEFAULTS = (
+    Permission.VIEW_CHANNELS | Permission.SEND_MESSAGES
+    | Permission.ADD_REACTIONS | Permission.CREATE_INVITE
+)
+ROLE_TYPE_DEFAULTS = {
+    "member": _MEMBER_DEFAULTS,
+    "moderator": _MEMBER_DEFAULTS | Permission.MANAGE_MESSAGES | Permission.VIEW_AUDIT_LOG,
+    "admin": ALL_PERMISSIONS,
+}
+
+def compile_role_permissions(data) -> Permission:
+    """Bitmask granted by a ``Role.permissions`` JSON object; unknown keys are ignored."""
+    granted = Permission.NONE
+    if not isinstance(data, dict):
+        return granted
+    for name, value in data.items():
+        flag = Permission.__members__.get(str(name).upper())
+        if flag is not None and value is True:
+            granted |= flag
+    if granted & Permission.ADMINISTRATOR:
+        return ALL_PERMISSIONS
+    return granted
+
+def effective_permissions(user_id: int, owner_id: int, member_id, role_type, role_permissions) -> Permission:
+    if user_id == owner_id:
+        return ALL_PERMISSIONS
+    if member_id is None:
+        return Permission.NONE
+    role_type = getattr(role_type, "value", role_type) or "member"
+    granted = ROLE_TYPE_DEFAULTS.get(role_type, _MEMBER_DEFAULTS) | compile_role_permissions(role_permissions)
+    return ALL_PERMISSIONS if granted & Permission.ADMINISTRATOR else granted
+
+class PermissionCache:
+    def __init__(self, max_entries: int = config.PERMISSION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, Permission]" = OrderedDict()
+        self._by_server: dict = {}  # server_id -> set of user ids with an entry
+        self._channels: "OrderedDict[int, int]" = OrderedDict()  # channel_id -> server_id
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.hits = 0
+        self.misses = 0
+
+    def add_listener(self, callback):
+        """Call ``callback(servers, members, channels)`` after every invalidate()."""
+        self._listeners.append(callback)
+
+    def generation(self) -> int:
+        """Token for store(); any invalidation in between makes the store a no-op."""
+        return self._generation
+
+    def get(self, server_id: int, user_id: int) -> Optional[Permission]:
+        with self._lock:
+            permissions = self._entries.get((server_id, user_id))
+            if permissions is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((server_id, user_id))
+            self.hits += 1
+            return permissions
+
+    def channel_server(self, channel_id: int) -> Optional[int]:
+        with self._lock:
+            return self._channels.get(channel_id)
+
+    def store(self, generation: int, server_id: int, user_id: int, permissions: Permission, channel_id: int = None):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[(server_id, user_id)] = permissions
+            self._entries.move_to_end((server_id, user_id))
+            self._by_server.setdefault(server_id, set()).add(user_id)
+            if channel_id is not None:
+                self._channels[channel_id] = server_id
+                self._channels.move_to_end(channel_id)
+            while len(self._entries) > self.max_entries:
+                (old_server, old_user), _ = self._entries.popitem(last=False)
+                self._discard_user(old_server, old_user)
+            while len(self._channels) > self.max_entries:
+                self._channels.popitem(last=False)
+
+    def invalidate(self, servers=(), members=(), channels=()):
+        """Drop whole servers, single (server_id, user_id) entries and channel mappings."""
+        with self._lock:
+            self._generation += 1
+            for server_id in servers:
+                for user_id in self._by_server.pop(server_id, ()):
+                    self._entries.pop((server_id, user_id), None)
+            for server_id, user_id in members:
+                self._entries.pop((server_id, user_id), None)
+                self._discard_user(server_id, user_id)
+            for channel_id in channels:
+                self._channels.pop(channel_id, None)
+        for callback in self._listeners:
+            try:
+                callback(servers=servers, members=members, channels=channels)
+            except Exception:
+                logger.exception("Permission invalidation listener failed")
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._by_server.clear()
+            self._channels.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "channels": len(self._channels),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    def _discard_user(self, server_id: int, user_id: int):
+        users = self._by_server.get(server_id)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._by_server[server_id]
+
+permission_cache = PermissionCache()
+
+# Resolution
+class Access(NamedTuple):
+    server_id: int
+    user_id: int
+    permissions: Permission
+
+    def can(self, permission: Permission) -> bool:
+        return (self.permissions & permission) == permission
+
+def _lookup_statement(user_id: int):
+    return select(
+        models.Server.id,
+        models.Server.owner_id,
+        models.ServerMember.id,
+        models.ServerMember.role_type,
+        models.Role.permissions
+    ).select_from(models.Server).outerjoin(
+        models.ServerMember,
+        and_(models.ServerMember.server_id == models.Server.id, models.ServerMember.user_id == user_id)
+    ).outerjoin(
+        models.Role,
+        and_(models.Role.id == models.ServerMember.role_id, models.Role.server_id == models.Server.id)
+    )
+
+def resolve(db: Session, user_id: int, server_id: int = None, channel_id: int = None) -> Optional[Access]:
+    """
+    Effective permissions of a user in a server, given the server or one of
+    its channels. None if the server (or channel) doesn't exist.
+    """
+    if server_id is None:
+        server_id = permission_cache.channel_server(channel_id)
+    if server_id is not None:
+        cached = permission_cache.get(server_id, user_id)
+        if cached is not None:
+            return Access(server_id, user_id, cached)
+
+    generation = permission_cache.generation()
+    statement = _lookup_statement(user_id)
+    if server_id is not None:
+        statement = statement.where(models.Server.id == server_id)
+    else:
+        statement = statement.join(models.Channel, models.Channel.server_id == models.Server.id)\
+            .where(models.Channel.id == channel_id)
+    row = db.execute(statement).first()
+    if row is None:
+        return None
+    server_id, owner_id, member_id, role_type, role_permissions = row
+    permissions = effective_permissions(user_id, owner_id, member_id, role_type, role_permissions)
+    permission_cache.store(generation, server_id, user_id, permissions, channel_id=channel_id)
+    return Access(server_id, user_id, permissions)
+
+def authorize(
+    db: Session,
+    user_id: int,
+    permission: Permission = Permission.VIEW_CHANNELS,
+    server_id: int = None,
+    channel_id: int = None
+) -> Access:
+    """resolve() and raise 404/403 unless the user has ``permission``."""
+    access = resolve(db, user_id, server_id=server_id, channel_id=channel_id)
+    if access is None:
+        raise HTTPException(status_code=404, detail="Server not found" if channel_id is None else "Channel not found")
+    if not access.permissions:
+        raise HTTPException(status_code=403, detail="Not a member of this server")
+    if not access.can(permission):
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return access
+
+def server_permission(permission: Permission = Permission.VIEW_CHANNELS):
+    """Dependency for routes with a ``server_id`` path parameter."""
+    def dependency(
+        server_id: int,
+        current_user: models.User = Depends(auth.get_current_user),
+        db: Session = Depends(get_read_db)
+    ) -> Access:
+        return authorize(db, current_user.id, permission, server_id=server_id)
+    return dependency
+
+def channel_permission(permission: Permission = Permission.VIEW_CHANNELS):
+    """Dependency for routes with a ``channel_id`` path parameter; 404s unknown channels."""
+    def dependency(
+        channel_id: int,
+        current_user: models.User = Depends(auth.get_current_user),
+        db: Session = Depends(get_read_db)
+    ) -> Access:
+        return authorize(db, current_user.id, permission, channel_id=channel_id)
+    return dependency
+
+# Invalidation: collect affected keys on flush, apply them after commit
+_CHANGES_KEY = "permission_changes"
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session: Session, flush_context):
+    changes = None
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, models.ServerMember):
+            key = ("members", (instance.server_id, instance.user_id))
+        elif isinstance(instance, (models.Role, models.Server)):
+            key = ("servers", instance.server_id if isinstance(instance, models.Role) else instance.id)
+        elif isinstance(instance, models.Channel) and instance in session.deleted:
+            key = ("channels", instance.id)
+        else:
+            continue
+        if changes is None:
+            changes = session.info.setdefault(_CHANGES_KEY, {"servers": set(), "members": set(), "channels": set()})
+        changes[key[0]].add(key[1])
+
+@event.listens_for(Session, "after_commit")
+def _apply_changes(session: Session):
+    changes = session.info.pop(_CHANGES_KEY, None)
+    if changes:
+        permission_cache.invalidate(**changes)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session: Session):
+    session.info.pop(_CHANGES_KEY, None)
@@ -0,0 +1,387 @@
+"""
+Realtime events over ``/ws?token=...``: a topic-based pub/sub hub.
+
+A connection subscribes to topics: ``("server", id)`` gets the events of all
+channels of a server, including channels created later, and
+``("channel", id)`` gets the events of one channel. On connect it is
+subscribed to every server the user can view; the client changes that with
+
+    {"op": "subscribe", "server_id": 1}      {"op": "unsubscribe", "channel_id": 7}
+    {"op": "ping"}
+
+Subscribing checks ``VIEW_CHANNELS`` like the REST endpoints do. Whenever a
+membership, role or server changes (the permission cache invalidation), the
+affected subscriptions are checked again. A subscription that lost access is
+dropped and the client gets ``{"type": "unsubscribed", ...}``.
+
+The write endpoints publish once their change has committed:
+
+    {"type": "message.created", "server_id": 1, "channel_id": 7, "message": {...}}
+    {"type": "message.updated", ...same shape}
+    {"type": "message.deleted", "server_id": 1, "channel_id": 7, "message_id": 42}
+    {"type": "message.reactions", "server_id": 1, "channel_id": 7, "message_id": 42,
+     "reactions": [{"emoji": "+1", "count": 3}]}
+
+An event is encoded once. Fan-out looks up the subscribers of the server and
+channel topics and puts the encoded text on each one's queue, so it costs
+O(subscribers) and never waits for a socket. Every connection has its own
+task that drains its queue to the socket. The queues are bounded
+(``REALTIME_QUEUE_SIZE``). A client that falls that far behind is
+disconnected with code 4008 instead of being sent a stream with gaps. It
+reconnects and catches up with ``GET /sync``. Events published inside an
+atomic ``/batch`` are sent once it commits and dropped if it rolls back.
+
+Sync endpoints publish from the thread pool. Fan-out always runs on the
+event loop, so the hub's state has no lock.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import TypeAdapter
+from sqlalchemy import select
+
+import auth
+import config
+import fast_json
+import models
+import schemas
+from database import ReadSessionLocal, run_sync
+from db_writer import writer
+from permissions import Permission, permission_cache, resolve
+from app_logging import get_logger
+
+logger = get_logger("realtime")
+
+MESSAGE = TypeAdapter(schemas.Message)
+REACTIONS = TypeAdapter(List[schemas.ReactionTotal])
+
+# Close code for clients whose queue overflowed
+CLOSE_TOO_SLOW = 4008
+
+def server_topic(server_id: int) -> tuple:
+    return ("server", server_id)
+
+def channel_topic(channel_id: int) -> tuple:
+    return ("channel", channel_id)
+
+class Subscriber:
+    """One /ws connection: its subscriptions and its outgoing queue."""
+
+    def __init__(self, websocket: WebSocket, user_id: int, queue_size: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: "asyncio.Queue" = asyncio.Queue(queue_size)
+        self.servers: Set[int] = set()
+        self.channels: Dict[int, int] = {}  # channel_id -> server_id
+        self.closed = False
+        self.sent = 0
+
+    def offer(self, payload: str) -> bool:
+        """Queue an event; False (and the connection is being closed) if the queue is full."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            self.closed = True
+            # Whatever is queued is moot now; the sender closes on the None
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return False
+
+    async def send_all(self):
+        """Drain the queue to the socket until the connection ends."""
+        while True:
+            payload = await self.queue.get()
+            if payload is None:
+                await self.websocket.close(code=CLOSE_TOO_SLOW, reason="Too slow, resync")
+                return
+            await self.websocket.send_text(payload)
+            self.sent += 1
+
+class RealtimeHub:
+    def __init__(self, queue_size: int = config.REALTIME_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._topics: Dict[tuple, Set[Subscriber]] = defaultdict(set)
+        self._users: Dict[int, Set[Subscriber]] = defaultdict(set)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self.published = 0
+        self.delivered = 0
+        self.overflows = 0
+        permission_cache.add_listener(self._access_changed)
+
+    # Publishing
+    def listening(self, server_id: int, channel_id: int) -> bool:
+        """Whether anyone is subscribed to events of ``channel_id``; lets publishers skip building them."""
+        return server_topic(server_id) in self._topics or channel_topic(channel_id) in self._topics
+
+    def publish(self, server_id: int, channel_id: int, payload: bytes):
+        """
+        Send an encoded event to the subscribers of the server and the
+        channel, once the current transaction() (if any) has committed.
+        Callable from any thread.
+        """
+        writer.on_commit(lambda: self._dispatch((server_topic(server_id), channel_topic(channel_id)), payload))
+
+    def _dispatch(self, topics: tuple, payload: bytes):
+        loop = self._loop
+        if loop is None:
+            return
+        text = payload.decode()
+        if threading.get_ident() == self._loop_thread:
+            self._fan_out(topics, text)
+        else:
+            loop.call_soon_threadsafe(self._fan_out, topics, text)
+
+    def _fan_out(self, topics: tuple, payload: str):
+        self.published += 1
+        seen = set()
+        for topic in topics:
+            for subscriber in tuple(self._topics.get(topic, ())):
+                if subscriber in seen:
+                    continue
+                seen.add(subscriber)
+                if subscriber.offer(payload):
+                    self.delivered += 1
+                else:
+                    self.overflows += 1
+                    logger.info("User %s fell %s events behind, disconnecting", subscriber.user_id, self.queue_size)
+                    self._remove(subscriber)
+
+    # Connections
+    async def serve(self, websocket: WebSocket, token: str):
+        """Run one /ws connection until it closes."""
+        user = await run_sync(_authenticate, token)
+        if user is None:
+            await websocket.close(code=4000, reason="Invalid token")
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+
+        server_ids = await run_sync(_visible_servers, user.id)
+
+        await websocket.accept()
+        subscriber = Subscriber(websocket, user.id, self.queue_size)
+        self._users[user.id].add(subscriber)
+        for server_id in server_ids:
+            self._subscribe(subscriber, server_topic(server_id), server_id)
+        sender = asyncio.create_task(subscriber.send_all())
+        subscriber.offer(_encode({"type": "ready", "server_ids": sorted(subscriber.servers)}))
+        try:
+            while not sender.done():
+                receiving = asyncio.ensure_future(websocket.receive_json())
+                await asyncio.wait((receiving, sender), return_when=asyncio.FIRST_COMPLETED)
+                if not receiving.done():
+                    receiving.cancel()
+                    break
+                try:
+                    message = receiving.result()
+                except ValueError:
+                    message = None  # not JSON
+                await self._handle(subscriber, message)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self._remove(subscriber)
+            if not sender.done():
+                sender.cancel()
+            elif not sender.cancelled() and sender.exception() is not None:
+                logger.debug("Sending to user %s failed: %s", user.id, sender.exception())
+
+    async def _handle(self, subscriber: Subscriber, message):
+        op = message.get("op") if isinstance(message, dict) else None
+        if op == "ping":
+            subscriber.offer(_encode({"type": "pong"}))
+            return
+        if op not in ("subscribe", "unsubscribe"):
+            subscriber.offer(_encode({"type": "error", "detail": "Unknown op"}))
+            return
+        server_id, channel_id = message.get("server_id"), message.get("channel_id")
+        if not isinstance(server_id, int) ^ isinstance(channel_id, int):
+            subscriber.offer(_encode({"type": "error", "detail": "Give server_id or channel_id"}))
+            return
+        target = {"server_id": server_id} if channel_id is None else {"channel_id": channel_id}
+
+        if op == "unsubscribe":
+            if channel_id is None:
+                self._unsubscribe(subscriber, server_topic(server_id))
+            else:
+                self._unsubscribe(subscriber, channel_topic(channel_id))
+            subscriber.offer(_encode({"type": "unsubscribed", **target}))
+            return
+
+        access = await run_sync(_access, subscriber.user_id, server_id, channel_id)
+        if access is None or not access.can(Permission.VIEW_CHANNELS):
+            subscriber.offer(_encode({"type": "error", "detail": "Not allowed", **target}))
+            return
+        if subscriber.closed:
+            return
+        if channel_id is None:
+            self._subscribe(subscriber, server_topic(server_id), server_id)
+        else:
+            self._subscribe(subscriber, channel_topic(channel_id), access.server_id)
+        subscriber.offer(_encode({"type": "subscribed", **target}))
+
+    def _subscribe(self, subscriber: Subscriber, topic: tuple, server_id: int):
+        self._topics[topic].add(subscriber)
+        if topic[0] == "server":
+            subscriber.servers.add(server_id)
+        else:
+            subscriber.channels[topic[1]] = server_id
+
+    def _unsubscribe(self, subscriber: Subscriber, topic: tuple):
+        subscribers = self._topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._topics[topic]
+        if topic[0] == "server":
+            subscriber.servers.discard(topic[1])
+        else:
+            subscriber.channels.pop(topic[1], None)
+
+    def _remove(self, subscriber: Subscriber):
+        for server_id in tuple(subscriber.servers):
+            self._unsubscribe(subscriber, server_topic(server_id))
+        for channel_id in tuple(subscriber.channels):
+            self._unsubscribe(subscriber, channel_topic(channel_id))
+        users = self._users.get(subscriber.user_id)
+        if users is not None:
+            users.discard(subscriber)
+            if not users:
+                del self._users[subscriber.user_id]
+
+    # Revocation: recheck subscriptions whose permissions may have changed
+    def _access_changed(self, servers=(), members=(), channels=()):
+        loop = self._loop
+        if loop is not None and self._users:
+            loop.call_soon_threadsafe(self._recheck_later, tuple(servers), tuple(members), tuple(channels))
+
+    def _recheck_later(self, servers: tuple, members: tuple, channels: tuple):
+        for channel_id in channels:
+            # Deleted channels
+            for subscriber in tuple(self._topics.get(channel_topic(channel_id), ())):
+                self._unsubscribe(subscriber, channel_topic(channel_id))
+                subscriber.offer(_encode({"type": "unsubscribed", "channel_id": channel_id}))
+        affected = set()
+        for server_id in servers:
+            for subscribers in self._users.values():
+                affected.update(
+                    (subscriber, server_id) for subscriber in subscribers
+                    if server_id in subscriber.servers or server_id in subscriber.channels.values()
+                )
+        for server_id, user_id in members:
+            affected.update(
+                (subscriber, server_id) for subscriber in self._users.get(user_id, ())
+                if server_id in subscriber.servers or server_id in subscriber.channels.values()
+            )
+        if affected:
+            asyncio.create_task(self._recheck(affected))
+
+    async def _recheck(self, affected: set):
+        pairs = {(subscriber.user_id, server_id) for subscriber, server_id in affected}
+        try:
+            allowed = await run_sync(_still_allowed, pairs)
+        except Exception:
+            logger.exception("Rechecking realtime subscriptions failed")
+            return
+        for subscriber, server_id in affected:
+            if (subscriber.user_id, server_id) in allowed or subscriber.closed:
+                continue
+            if server_id in subscriber.servers:
+                self._unsubscribe(subscriber, server_topic(server_id))
+                subscriber.offer(_encode({"type": "unsubscribed", "server_id": server_id}))
+            for channel_id, channel_server in tuple(subscriber.channels.items()):
+                if channel_server == server_id:
+                    self._unsubscribe(subscriber, channel_topic(channel_id))
+                    subscriber.offer(_encode({"type": "unsubscribed", "channel_id": channel_id}))
+
+    def stats(self) -> dict:
+        return {
+            "connections": sum(len(subscribers) for subscribers in self._users.values()),
+            "users": len(self._users),
+            "topics": len(self._topics),
+            "published": self.published,
+            "delivered": self.delivered,
+            "overflows": self.overflows,
+            "queue_size": self.queue_size,
+        }
+
+hub = RealtimeHub()
+
+def _encode(event: dict) -> str:
+    return fast_json.dumps(event).decode()
+
+# Database work, run off the event loop
+def _authenticate(token: str) -> Optional[models.User]:
+    with ReadSessionLocal() as db:
+        try:
+            return auth.get_current_user(token, db)
+        except HTTPException:
+            return None
+
+def _visible_servers(user_id: int) -> list:
+    with ReadSessionLocal() as db:
+        server_ids = db.scalars(
+            select(models.ServerMember.server_id)
+            .where(models.ServerMember.user_id == user_id, models.ServerMember.server_id.is_not(None))
+            .union(select(models.Server.id).where(models.Server.owner_id == user_id))
+        ).all()
+        visible = []
+        for server_id in server_ids:
+            access = resolve(db, user_id, server_id=server_id)
+            if access is not None and access.can(Permission.VIEW_CHANNELS):
+                visible.append(server_id)
+        return visible
+
+def _access(user_id: int, server_id: Optional[int], channel_id: Optional[int]):
+    with ReadSessionLocal() as db:
+        return resolve(db, user_id, server_id=server_id, channel_id=channel_id)
+
+def _still_allowed(pairs: set) -> set:
+    allowed = set()
+    with ReadSessionLocal() as db:
+        for user_id, server_id in pairs:
+            access = resolve(db, user_id, server_id=server_id)
+            if access is not None and access.can(Permission.VIEW_CHANNELS):
+                allowed.add((user_id, server_id))
+    return allowed
+
+# Events, published by the write endpoints after their change committed
+def _message_event(kind: bytes, server_id: int, message) -> bytes:
+    body = MESSAGE.dump_json(MESSAGE.validate_python(message, from_attributes=True))
+    return (
+        b'{"type":"' + kind + b'","server_id":' + str(server_id).encode()
+        + b',"channel_id":' + str(message.channel_id).encode() + b',"message":' + body + b"}"
+    )
+
+def message_created(server_id: int, message):
+    if hub.listening(server_id, message.channel_id):
+        hub.publish(server_id, message.channel_id, _message_event(b"message.created", server_id, message))
+
+def message_updated(server_id: int, message):
+    if hub.listening(server_id, message.channel_id):
+        hub.publish(server_id, message.channel_id, _message_event(b"message.updated", server_id, message))
+
+def message_deleted(server_id: int, channel_id: int, message_id: int):
+    if hub.listening(server_id, channel_id):
+        hub.publish(server_id, channel_id, fast_json.dumps({
+            "type": "message.deleted", "server_id": server_id,
+            "channel_id": channel_id, "message_id": message_id,
+        }))
+
+def reactions_changed(server_id: int, channel_id: int, message_id: int, totals: list):
+    """``totals``: the message's MessageReactionCount rows (crud.get_reaction_totals)."""
+    if hub.listening(server_id, channel_id):
+        reactions = REACTIONS.dump_json(REACTIONS.validate_python(totals, from_attributes=True))
+        hub.publish(server_id, channel_id, (
+            b'{"type":"message.reactions","server_id":' + str(server_id).encode()
+            + b',"channel_id":' + str(channel_id).encode() + b',"message_id":' + str(message_id).encode()
+            + b',"reactions":' + reactions + b"}"
+        ))
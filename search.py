@@ -0,0 +1,176 @@
+"""
+Full-text search over message content (SQLite FTS5).
+
+``messages_fts`` is an FTS5 table keyed by message id (its rowid). crud keeps
+it in step with the messages table inside the same transaction: created and
+edited messages are (re)indexed, deleted ones removed. Messages that existed
+before the table was added are indexed by the reindex command, which works
+in small batches so the server keeps running alongside it:
+
+    python search.py reindex [--batch 2000]
+
+Results are ranked with bm25, carry a highlighted snippet, and are paged by
+(rank, id) keyset cursors. Only servers the searching user belongs to are
+searched.
+"""
+import argparse
+import time
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import config
+import pagination
+from app_logging import get_logger
+
+logger = get_logger("search")
+
+FTS_TABLE = "messages_fts"
+
+CREATE_FTS_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+    "USING fts5(content, tokenize='unicode61 remove_diacritics 2')"
+)
+
+# Write side, called by crud with the session of the current transaction
+def index_messages(db: Session, messages: Iterable) -> None:
+    """Add or replace the index entries of the given (flushed) messages."""
+    rows = [{"id": m.id, "content": m.content} for m in messages if m.content]
+    if rows:
+        db.execute(text(f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, content) VALUES (:id, :content)"), rows)
+
+def reindex_message(db: Session, message) -> None:
+    """Refresh one message after an edit; messages without text are dropped."""
+    if message.content:
+        index_messages(db, [message])
+    else:
+        unindex_message(db, message.id)
+
+def unindex_message(db: Session, message_id: int) -> None:
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {"id": message_id})
+
+# Read side
+def build_match(query: str) -> str:
+    """
+    Turn user input into an FTS5 query: every word must match, the last one
+    as a prefix. Words are quoted, so FTS syntax characters in the input are
+    searched for literally instead of raising a syntax error.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if not terms:
+        return ""
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def search_messages(
+    db: Session,
+    user_id: int,
+    query: str,
+    server_id: Optional[int] = None,
+    channel_id: Optional[int] = None,
+    author_id: Optional[int] = None,
+    limit: int = config.SEARCH_PAGE_SIZE,
+    after: Optional[Tuple[float, int]] = None
+) -> list:
+    """
+    One page of hits, best first. ``after`` is the (rank, id) of the last hit
+    of the previous page. Each row has id, channel_id, server_id, author_id,
+    author_username, created_at, snippet and rank.
+    """
+    match = build_match(query)
+    if not match:
+        return []
+
+    opening, closing = config.SEARCH_SNIPPET_MARKERS
+    params = {
+        "match": match,
+        "user_id": user_id,
+        "limit": limit,
+        "open": opening,
+        "close": closing,
+        "tokens": config.SEARCH_SNIPPET_TOKENS,
+    }
+    filters = []
+    if server_id is not None:
+        filters.append("c.server_id = :server_id")
+        params["server_id"] = server_id
+    if channel_id is not None:
+        filters.append("m.channel_id = :channel_id")
+        params["channel_id"] = channel_id
+    if author_id is not None:
+        filters.append("m.author_id = :author_id")
+        params["author_id"] = author_id
+    if after is not None:
+        filters.append(f"(bm25({FTS_TABLE}) > :after_rank OR (bm25({FTS_TABLE}) = :after_rank AND m.id > :after_id))")
+        params["after_rank"], params["after_id"] = after
+
+    sql = f"""
+        SELECT m.id, m.channel_id, c.server_id, m.author_id, u.username AS author_username,
+               m.created_at,
+               snippet({FTS_TABLE}, 0, :open, :close, '…', :tokens) AS snippet,
+               bm25({FTS_TABLE}) AS rank
+        FROM {FTS_TABLE}
+        JOIN messages m ON m.id = {FTS_TABLE}.rowid
+        JOIN channels c ON c.id = m.channel_id
+        JOIN server_members sm ON sm.server_id = c.server_id AND sm.user_id = :user_id
+        JOIN users u ON u.id = m.author_id
+        WHERE {FTS_TABLE} MATCH :match {''.join(' AND ' + f for f in filters)}
+        ORDER BY rank, m.id
+        LIMIT :limit
+    """
+    return db.execute(text(sql), params).mappings().all()
+
+def hit_key(hit) -> Tuple[float, int]:
+    return hit["rank"], hit["id"]
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    direction, key = pagination.decode_cursor(cursor)
+    try:
+        rank, message_id = key
+        return float(rank), int(message_id)
+    except (TypeError, ValueError):
+        raise ValueError("Malformed cursor")
+
+# Backfill
+def reindex(batch_size: int = 2000, bind=None) -> int:
+    """
+    Index every message with content, one id range of ``batch_size`` per
+    transaction. Each batch is a single INSERT ... SELECT, so an edit or
+    delete racing with it can't leave stale text behind. Safe to run while
+    the server is up and to re-run: entries are replaced, not duplicated.
+    Messages created after the start are indexed by crud anyway.
+    """
+    from database import engine
+
+    bind = bind or engine
+    with bind.connect() as conn:
+        max_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM messages")).scalar()
+    total = 0
+    started = time.perf_counter()
+    for low in range(0, max_id, batch_size):
+        with bind.begin() as conn:
+            total += conn.execute(
+                text(
+                    f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, content) "
+                    "SELECT id, content FROM messages "
+                    "WHERE id > :low AND id <= :high AND content IS NOT NULL"
+                ),
+                {"low": low, "high": low + batch_size}
+            ).rowcount
+        logger.info("Indexed %s messages (ids up to %s of %s)", total, min(low + batch_size, max_id), max_id)
+    with bind.begin() as conn:
+        conn.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"))
+    logger.info("Reindex finished: %s messages in %.1f s", total, time.perf_counter() - started)
+    return total
+
+if __name__ == "__main__":
+    from app_logging import setup_logging
+
+    parser = argparse.ArgumentParser(description="Message search index maintenance")
+    parser.add_argument("command", choices=["reindex"])
+    parser.add_argument("--batch", type=int, default=2000, help="messages per transaction")
+    args = parser.parse_args()
+
+    setup_logging()
+    reindex(batch_size=args.batch)
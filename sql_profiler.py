@@ -0,0 +1,237 @@
+"""
+Per-request SQL profiling.
+
+One in ``SQL_PROFILE_SAMPLE_EVERY`` requests is profiled: cursor execute
+hooks on every engine time its statements, and the totals are attributed to
+the request through a context variable (shared with the thread pool copies
+of the request context, like ``database.QueryCounter``). Profiled responses
+get a ``Server-Timing`` header (``db`` = time spent in SQLite, ``app`` = the
+whole request) that browser dev tools show next to the request.
+
+Statements slower than ``SQL_SLOW_QUERY_MS`` go into a rolling slow-query
+log, keyed by normalized SQL (literals and IN lists collapsed) so repeats of
+one query shape are aggregated. ``EXPLAIN QUERY PLAN`` for a logged query is
+only run when the log is read, on a read-only connection.
+
+Unsampled requests cost one counter increment in the middleware and one
+ContextVar lookup per statement; with ``SQL_PROFILE_ENABLED`` off the hooks
+aren't installed at all.
+"""
+import contextvars
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import event
+
+import config
+import database
+from app_logging import get_logger
+
+logger = get_logger("db.profile")
+
+_profile = contextvars.ContextVar("sql_profile", default=None)
+
+class RequestProfile:
+    __slots__ = ("method", "path", "queries", "db_seconds", "slowest")
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.queries = 0
+        self.db_seconds = 0.0
+        # (seconds, statement, parameters) of the slowest statements, slowest first
+        self.slowest: List[tuple] = []
+
+    def record(self, seconds: float, statement: str, parameters):
+        self.queries += 1
+        self.db_seconds += seconds
+        if len(self.slowest) < config.SQL_PROFILE_KEEP_SLOWEST or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement, parameters))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[config.SQL_PROFILE_KEEP_SLOWEST:]
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+def normalize_sql(statement: str) -> str:
+    """Collapse whitespace, literals and IN lists so one query shape has one key."""
+    statement = _LITERAL_RE.sub("?", statement)
+    statement = _IN_LIST_RE.sub("(...)", statement)
+    return _SPACE_RE.sub(" ", statement).strip()
+
+class SlowQueryLog:
+    def __init__(self, size: int = config.SQL_SLOW_LOG_SIZE, threshold_ms: float = config.SQL_SLOW_QUERY_MS):
+        self.size = size
+        self.threshold = threshold_ms / 1000
+        self._recent: deque = deque(maxlen=size)
+        # normalized SQL -> aggregate, least recently seen first
+        self._shapes: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, statement: str, parameters, profile: RequestProfile):
+        sql = normalize_sql(statement)
+        entry = {
+            "sql": sql,
+            "ms": round(seconds * 1000, 2),
+            "endpoint": f"{profile.method} {profile.path}",
+            "at": datetime.utcnow().isoformat(),
+        }
+        with self._lock:
+            self._recent.append(entry)
+            shape = self._shapes.pop(sql, None)
+            if shape is None:
+                shape = {"sql": sql, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": None,
+                         "statement": statement, "parameters": parameters}
+            shape["count"] += 1
+            shape["total_ms"] += entry["ms"]
+            shape["max_ms"] = max(shape["max_ms"], entry["ms"])
+            self._shapes[sql] = shape
+            while len(self._shapes) > self.size:
+                self._shapes.popitem(last=False)
+        logger.warning("Slow query (%.1f ms) in %s: %s", entry["ms"], entry["endpoint"], sql[:500])
+
+    def report(self, limit: int = 50) -> dict:
+        """Slowest query shapes with their plans, plus the most recent slow queries."""
+        with self._lock:
+            shapes = sorted(self._shapes.values(), key=lambda s: s["max_ms"], reverse=True)[:limit]
+            recent = list(self._recent)[-limit:]
+        for shape in shapes:
+            if shape["plan"] is None:
+                shape["plan"] = explain(shape["statement"], shape["parameters"])
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "shapes": [
+                {key: shape[key] for key in ("sql", "count", "total_ms", "max_ms", "plan")}
+                for shape in shapes
+            ],
+            "recent": recent,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._shapes.clear()
+
+def explain(statement: str, parameters) -> Optional[List[str]]:
+    """EXPLAIN QUERY PLAN lines for a statement, or None if it can't be explained."""
+    if not statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE")):
+        return None
+    try:
+        with database.read_engine.connect() as conn:
+            cursor = conn.connection.cursor()
+            try:
+                rows = cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+            finally:
+                cursor.close()
+    except Exception as exc:
+        return [f"unavailable: {exc}"]
+    return [row[3] for row in rows]
+
+class EndpointTotals:
+    """Query count and SQLite time per endpoint, over the profiled requests."""
+
+    def __init__(self):
+        self._totals: dict = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, profile: RequestProfile):
+        with self._lock:
+            totals = self._totals.setdefault(key, {"requests": 0, "queries": 0, "db_ms": 0.0, "max_queries": 0})
+            totals["requests"] += 1
+            totals["queries"] += profile.queries
+            totals["db_ms"] += profile.db_seconds * 1000
+            totals["max_queries"] = max(totals["max_queries"], profile.queries)
+
+    def report(self) -> list:
+        with self._lock:
+            items = [dict(totals, endpoint=key) for key, totals in self._totals.items()]
+        for item in items:
+            item["avg_queries"] = round(item["queries"] / item["requests"], 2)
+            item["avg_db_ms"] = round(item["db_ms"] / item["requests"], 2)
+            item["db_ms"] = round(item["db_ms"], 2)
+        return sorted(items, key=lambda item: item["db_ms"], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._totals.clear()
+
+slow_queries = SlowQueryLog()
+endpoint_totals = EndpointTotals()
+
+# Engine hooks
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _profile.get() is not None:
+        context._profile_started = time.perf_counter()
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile.get()
+    if profile is None:
+        return
+    started = getattr(context, "_profile_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    profile.record(seconds, statement, parameters)
+    if seconds >= slow_queries.threshold:
+        slow_queries.add(seconds, statement, None if executemany else parameters, profile)
+
+def install(engines=None):
+    engines = engines or {database.engine, database.writer_engine, database.read_engine}
+    if database.async_engine is not None:
+        engines.add(database.async_engine.sync_engine)
+    for engine in engines:
+        if not event.contains(engine, "before_cursor_execute", _before_execute):
+            event.listen(engine, "before_cursor_execute", _before_execute)
+            event.listen(engine, "after_cursor_execute", _after_execute)
+
+class SQLProfilerMiddleware:
+    """ASGI middleware profiling one in ``sample_every`` HTTP requests."""
+
+    def __init__(self, app, sample_every: int = config.SQL_PROFILE_SAMPLE_EVERY):
+        self.app = app
+        self.sample_every = sample_every
+        self._counter = itertools.count()
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not self.sample_every
+            or next(self._counter) % self.sample_every
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = _profile.set(profile)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timing = (
+                    f'db;dur={profile.db_seconds * 1000:.1f};desc="{profile.queries} queries", '
+                    f"app;dur={(time.perf_counter() - started) * 1000:.1f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _profile.reset(token)
+            # The router has filled in the matched endpoint by now
+            endpoint = scope.get("endpoint")
+            name = getattr(endpoint, "__name__", None) or profile.path
+            endpoint_totals.add(f"{profile.method} {name}", profile)
+            if profile.queries and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "%s %s: %s queries, %.1f ms in SQLite; slowest: %s",
+                    profile.method, profile.path, profile.queries, profile.db_seconds * 1000,
+                    "; ".join(f"{s * 1000:.1f} ms {normalize_sql(sql)[:200]}" for s, sql, _ in profile.slowest)
+                )
@@ -0,0 +1,59 @@
+"""
+Shared test setup. config reads its switches at import time, so the scratch
+database and the dev/test guards (event-loop guard, strict loading) are set
+here, before any app module is imported.
+"""
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix="dump-tests-")
+os.environ["DUMP_DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ["DUMP_DB_LOOP_GUARD"] = "1"
+os.environ["DUMP_DB_STRICT"] = "1"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Uploads go to media/ under the working directory
+os.chdir(_tmp)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import config  # noqa: E402
+import main  # noqa: E402
+
+# Background jobs would add their statements to the per-request query counts
+config.RETENTION_ENABLED = False
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+def _register(client, name: str) -> dict:
+    email = f"{name}@example.com"
+    response = client.post("/users/", json={"email": email, "username": name, "password": "pw123456"})
+    assert response.status_code == 200, response.text
+    token = client.post("/token", data={"username": email, "password": "pw123456"}).json()["access_token"]
+    return {"id": response.json()["id"], "token": token, "headers": {"Authorization": f"Bearer {token}"}}
+
+@pytest.fixture(scope="session")
+def world(client):
+    """alice owns a server with a channel and a few messages; bob is a member."""
+    alice, bob = _register(client, "alice"), _register(client, "bob")
+    server_id = client.post("/servers/", json={"name": "srv"}, headers=alice["headers"]).json()["id"]
+    channel_id = client.post(
+        f"/servers/{server_id}/channels/", json={"name": "general", "type": "text"}, headers=alice["headers"]
+    ).json()["id"]
+    code = client.post(f"/servers/{server_id}/invite", headers=alice["headers"]).json()["code"]
+    assert client.post(f"/servers/join/{code}", headers=bob["headers"]).status_code == 200
+    message_ids = [
+        client.post(f"/channels/{channel_id}/messages", data={"content": f"hello @bob {i}"},
+                    headers=alice["headers"]).json()["id"]
+        for i in range(3)
+    ]
+    return SimpleNamespace(
+        alice=alice, bob=bob, server_id=server_id, channel_id=channel_id, message_ids=message_ids
+    )
@@ -0,0 +1,132 @@
+"""
+POST /batch with ``"atomic": true``: the sub-requests share the writer's
+transaction, see their own writes and are rolled back together.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import config
+import main
+from message_cache import message_cache
+
+@pytest.fixture(scope="module")
+def space(client, world):
+    """A server of alice's, deleted afterwards, so the writes here stay out of ``world``."""
+    headers = world.alice["headers"]
+    server_id = client.post("/servers/", json={"name": "batches"}, headers=headers).json()["id"]
+    channel_id = client.post(
+        f"/servers/{server_id}/channels/", json={"name": "general", "type": "text"}, headers=headers
+    ).json()["id"]
+    message_id = client.post(f"/channels/{channel_id}/messages", data={"content": "hi"}, headers=headers).json()["id"]
+    yield SimpleNamespace(headers=headers, server_id=server_id, channel_id=channel_id, message_id=message_id)
+    assert client.delete(f"/servers/{server_id}", headers=headers).status_code == 200
+
+def _batch(client, headers: dict, *requests) -> dict:
+    response = client.post("/batch", json={"requests": list(requests), "atomic": True}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+# Answered 404 inside the batch, which rolls it back
+_FAIL = {"path": "/messages/999999/thread"}
+
+def test_reads_own_writes(client, space):
+    headers = space.headers
+    result = _batch(
+        client, headers,
+        {"method": "POST", "path": f"/servers/{space.server_id}/channels/", "body": {"name": "batched", "type": "text"}},
+        {"path": f"/servers/{space.server_id}/channels/"},
+    )
+    assert result["committed"] is True
+    created, listed = result["responses"]
+    assert created["status"] == 200
+    assert created["body"]["id"] in [channel["id"] for channel in listed["body"]]
+
+def test_rollback_undoes_channel(client, space):
+    headers = space.headers
+    result = _batch(
+        client, headers,
+        {"method": "POST", "path": f"/servers/{space.server_id}/channels/", "body": {"name": "gone", "type": "text"}},
+        _FAIL,
+        {"path": f"/servers/{space.server_id}/channels/"},
+    )
+    assert result["committed"] is False
+    assert [item["status"] for item in result["responses"]] == [200, 404, 424]
+    channels = client.get(f"/servers/{space.server_id}/channels/", headers=headers).json()
+    assert "gone" not in [channel["name"] for channel in channels]
+
+def test_rollback_undoes_message_edit(client, space):
+    headers = space.headers
+    message_id = space.message_id
+    before = client.get(f"/channels/{space.channel_id}/messages", headers=headers).json()
+    result = _batch(
+        client, headers,
+        {"method": "PUT", "path": f"/messages/{message_id}", "body": {"content": "edited"}},
+        _FAIL,
+    )
+    assert result["responses"][0]["status"] == 200
+    assert result["responses"][0]["body"]["content"] == "edited"
+    assert result["committed"] is False
+    # The hot cache never saw the edit and wasn't thrown away
+    assert message_cache.contains(space.channel_id, message_id)
+    after = client.get(f"/channels/{space.channel_id}/messages", headers=headers).json()
+    assert after == before
+
+def test_commit_updates_cache(client, space):
+    headers = space.headers
+    message_id = space.message_id
+    client.get(f"/channels/{space.channel_id}/messages", headers=headers)
+    result = _batch(client, headers, {"method": "PUT", "path": f"/messages/{message_id}", "body": {"content": "kept"}})
+    assert result["committed"] is True
+    hits = message_cache.hits
+    messages = client.get(f"/channels/{space.channel_id}/messages", headers=headers).json()
+    assert message_cache.hits == hits + 1
+    assert {"id": message_id, "content": "kept"}.items() <= next(m for m in messages if m["id"] == message_id).items()
+
+def test_rollback_undoes_profile_update(client, world):
+    headers = world.bob["headers"]
+    result = _batch(
+        client, headers,
+        {"method": "PUT", "path": "/users/me/", "body": {"bio": "batched"}},
+        _FAIL,
+    )
+    assert result["responses"][0]["status"] == 200
+    assert result["committed"] is False
+    assert client.get("/users/me/", headers=headers).json().get("bio") != "batched"
+
+def test_refuses_slow_writes(client, space):
+    result = _batch(
+        client, space.headers,
+        {"method": "POST", "path": f"/servers/{space.server_id}/channels/", "body": {"name": "refused", "type": "text"}},
+        {"method": "POST", "path": "/upload"},
+    )
+    assert result["committed"] is False
+    assert [item["status"] for item in result["responses"]] == [424, 400]
+    channels = client.get(f"/servers/{space.server_id}/channels/", headers=space.headers).json()
+    assert "refused" not in [channel["name"] for channel in channels]
+
+def test_timeout_rolls_back_and_releases_writer(client, space, monkeypatch):
+    dispatcher = main.batch_dispatcher
+    call = dispatcher._call
+
+    async def slow_call(request, item):
+        if item.path.endswith("/thread"):
+            await asyncio.sleep(5)
+        return await call(request, item)
+
+    monkeypatch.setattr(config, "BATCH_ATOMIC_TIMEOUT", 0.2)
+    monkeypatch.setattr(dispatcher, "_call", slow_call)
+    result = _batch(
+        client, space.headers,
+        {"method": "POST", "path": f"/servers/{space.server_id}/channels/", "body": {"name": "late", "type": "text"}},
+        {"path": f"/messages/{space.message_id}/thread"},
+        {"path": f"/servers/{space.server_id}/channels/"},
+    )
+    assert result["committed"] is False
+    assert [item["status"] for item in result["responses"]] == [200, 504, 424]
+    # The writer is free again
+    response = client.put(f"/messages/{space.message_id}", json={"content": "after"}, headers=space.headers)
+    assert response.status_code == 200
+    channels = client.get(f"/servers/{space.server_id}/channels/", headers=space.headers).json()
+    assert "late" not in [channel["name"] for channel in channels]
@@ -0,0 +1,82 @@
+"""
+DatabaseWriter: every submitted job gets an answer, even when the group's
+transaction can't be started or committed.
+"""
+from concurrent.futures import Future
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from database import writer_engine
+from db_writer import DatabaseWriter, _BatchSession, _Transaction
+
+def _locked():
+    return OperationalError("BEGIN IMMEDIATE", {}, Exception("database is locked"))
+
+class _FailingSession(_BatchSession):
+    fail_begin = ()  # indexes of the begin_nested() calls that raise
+    fail_commit = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.begins = 0
+
+    def begin_nested(self):
+        self.begins += 1
+        if self.begins - 1 in self.fail_begin:
+            raise _locked()
+        return super().begin_nested()
+
+    def commit(self):
+        if self.fail_commit and not self.in_batch:
+            raise _locked()
+        super().commit()
+
+def _run(session_class, jobs: int = 3):
+    writer = DatabaseWriter()
+    db = sessionmaker(bind=writer_engine, class_=session_class, expire_on_commit=False)()
+    batch = [(lambda db, i=i: i, (), {}, Future()) for i in range(jobs)]
+    try:
+        writer._run_batch(db, batch)
+    finally:
+        db.close()
+    futures = [job[3] for job in batch]
+    assert all(future.done() for future in futures)
+    return futures
+
+def test_begin_fails_for_every_job():
+    class Session(_FailingSession):
+        fail_begin = range(3)
+
+    for future in _run(Session):
+        with pytest.raises(OperationalError, match="database is locked"):
+            future.result(timeout=0)
+
+def test_begin_fails_for_one_job():
+    class Session(_FailingSession):
+        fail_begin = (1,)
+
+    first, second, third = _run(Session)
+    assert first.result(timeout=0) == 0
+    with pytest.raises(OperationalError):
+        second.result(timeout=0)
+    assert third.result(timeout=0) == 2
+
+def test_commit_fails_every_job():
+    class Session(_FailingSession):
+        fail_begin = (1,)
+        fail_commit = True
+
+    for future in _run(Session):
+        with pytest.raises(OperationalError):
+            future.result(timeout=0)
+
+def test_closed_transaction_refuses_late_jobs():
+    # e.g. a batch sub-request still running after the batch timed out
+    transaction = _Transaction()
+    transaction.close()
+    future = Future()
+    DatabaseWriter()._run_in_transaction(transaction, future, lambda db: 1, (), {})
+    with pytest.raises(RuntimeError, match="already ended"):
+        future.result(timeout=0)
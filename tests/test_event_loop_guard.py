@@ -0,0 +1,70 @@
+"""
+DB_LOOP_GUARD: a blocking query on the event loop thread raises, and the
+async endpoints work with the guard on (conftest turns it on).
+"""
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+import config
+from database import SessionLocal, run_sync
+
+def _select_one() -> int:
+    with SessionLocal() as db:
+        return db.execute(text("SELECT 1")).scalar()
+
+def test_guard_is_on():
+    assert config.DB_LOOP_GUARD
+
+def test_sync_query_on_loop_thread_raises():
+    async def on_loop():
+        return _select_one()
+
+    with pytest.raises(RuntimeError, match="event loop thread"):
+        asyncio.run(on_loop())
+
+def test_run_sync_query_is_allowed():
+    async def off_loop():
+        return await run_sync(_select_one)
+
+    assert asyncio.run(off_loop()) == 1
+
+def test_async_endpoints(client, world):
+    # Each of these is an ``async def`` route; a blocking query in one of them
+    # raises under the guard and surfaces here as an exception or a 500.
+    alice, bob = world.alice["headers"], world.bob["headers"]
+    assert client.post("/token", data={"username": "alice@example.com", "password": "pw123456"}).status_code == 200
+    assert client.post("/token", data={"username": "alice@example.com", "password": "wrong"}).status_code == 401
+    assert client.post("/token/refresh", headers=alice).status_code == 200
+
+    response = client.post(f"/channels/{world.channel_id}/messages", data={"content": "hi"}, headers=alice)
+    assert response.status_code == 200
+    reply = client.post(
+        f"/channels/{world.channel_id}/messages",
+        data={"content": "re", "parent_id": str(response.json()["id"])},
+        headers=bob,
+    )
+    assert reply.status_code == 200
+
+    response = client.post(
+        f"/channels/{world.channel_id}/media", files={"file": ("a.txt", b"abc", "text/plain")}, headers=alice
+    )
+    assert response.status_code == 200
+
+    code = client.post(f"/servers/{world.server_id}/invite", headers=alice).json()["code"]
+    assert client.post(f"/servers/join/{code}", headers=bob).status_code == 400  # already a member
+
+    response = client.get(f"/bootstrap?channel_id={world.channel_id}", headers=alice)
+    assert response.status_code == 200
+    assert response.json()["messages"]
+
+    response = client.post("/batch", json={"requests": [{"path": "/servers/"}]}, headers=alice)
+    assert response.status_code == 200
+    assert response.json()["responses"][0]["status"] == 200
+
+def test_realtime_websocket(client, world):
+    with client.websocket_connect(f"/ws?token={world.alice['token']}") as websocket:
+        assert websocket.receive_json() == {"type": "ready", "server_ids": [world.server_id]}
+        websocket.send_json({"op": "subscribe", "channel_id": world.channel_id})
+        assert websocket.receive_json()["type"] == "subscribed"
@@ -0,0 +1,154 @@
+"""
+Query counts of the list endpoints, run under DUMP_DB_STRICT=1 (conftest):
+lazy loads raise and going over a route's query_budget() fails. The counts
+are exact, so a new per-row query or a lost eager load shows up here even
+while it fits the budget. The permission and message caches are cleared
+first, so every count includes the auth and permission lookups.
+"""
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+import config
+import database
+from message_cache import message_cache
+from permissions import permission_cache
+
+def _engines():
+    engines = {database.engine, database.read_engine, database.writer_engine}
+    if database.async_engine is not None:
+        engines.add(database.async_engine.sync_engine)
+    return engines
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    for engine in _engines():
+        event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        for engine in _engines():
+            event.remove(engine, "before_cursor_execute", record)
+
+@pytest.fixture
+def get(client):
+    def get(path: str, headers: dict):
+        permission_cache.clear()
+        message_cache.clear()
+        with count_queries() as statements:
+            response = client.get(path, headers=headers)
+        assert response.status_code == 200, response.text
+        return response, len(statements)
+    return get
+
+def test_strict_mode_is_on():
+    assert config.DB_STRICT_LOADING
+
+def test_servers(get, world):
+    response, queries = get("/servers/", world.alice["headers"])
+    assert [server["id"] for server in response.json()] == [world.server_id]
+    assert queries == 2
+
+@pytest.fixture(scope="module")
+def thread(client, world):
+    """A role, a reply chain under the first message and reactions on it."""
+    alice, bob = world.alice["headers"], world.bob["headers"]
+    response = client.post(
+        f"/servers/{world.server_id}/roles/", json={"name": "mods", "color": "#00ff00", "permissions": {}}, headers=alice
+    )
+    assert response.status_code == 200, response.text
+    root = world.message_ids[0]
+    parent = root
+    for i in range(3):
+        parent = client.post(
+            f"/channels/{world.channel_id}/messages",
+            data={"content": f"reply {i}", "parent_id": str(parent)},
+            headers=bob if i % 2 == 0 else alice,
+        ).json()["id"]
+    for emoji, headers in (("heart", alice), ("heart", bob), ("fire", bob)):
+        assert client.post(f"/messages/{root}/reactions/{emoji}", headers=headers).status_code == 200
+    return root
+
+def test_channels(get, world):
+    response, queries = get(f"/servers/{world.server_id}/channels/", world.alice["headers"])
+    assert [channel["id"] for channel in response.json()] == [world.channel_id]
+    assert queries == 3
+
+def test_roles(get, world, thread):
+    response, queries = get(f"/servers/{world.server_id}/roles/", world.alice["headers"])
+    assert [role["name"] for role in response.json()] == ["mods"]
+    assert queries == 3
+
+def test_members(get, world):
+    # Member summaries are listed per server by /bootstrap
+    response, queries = get("/bootstrap", world.bob["headers"])
+    members = response.json()["servers"][0]["members"]
+    assert members
+    assert queries == 6
+
+def test_messages_newest_page(get, client, world, thread):
+    path = f"/channels/{world.channel_id}/messages?limit=50"
+    response, queries = get(path, world.alice["headers"])
+    assert len(response.json()) >= len(world.message_ids) + 3
+    assert queries == 4
+    # Served from the hot cache once filled
+    permission_cache.clear()
+    with count_queries() as statements:
+        assert client.get(path, headers=world.alice["headers"]).status_code == 200
+    assert len(statements) == 2  # user and permission lookups, no message query
+
+def test_messages_older_page(get, client, world, thread):
+    first = client.get(f"/channels/{world.channel_id}/messages?limit=2", headers=world.alice["headers"])
+    cursor = first.headers["X-Next-Cursor"]
+    response, queries = get(f"/channels/{world.channel_id}/messages?limit=2&cursor={cursor}", world.alice["headers"])
+    assert len(response.json()) == 2
+    assert queries == 4
+
+def test_thread(get, world, thread):
+    response, queries = get(f"/messages/{thread}/thread", world.alice["headers"])
+    assert len(response.json()) == 4
+    assert queries == 3
+
+def test_reaction_summaries(get, world, thread):
+    ids = "&".join(f"ids={message_id}" for message_id in world.message_ids)
+    response, queries = get(f"/messages/reactions?{ids}", world.bob["headers"])
+    assert {r["emoji"] for r in response.json()[0]["reactions"]} == {"heart", "fire"}
+    assert queries == 2
+
+def test_search(get, world):
+    response, queries = get("/search/messages?q=hello", world.bob["headers"])
+    assert len(response.json()) >= len(world.message_ids)
+    assert queries == 2
+
+def test_mentions(get, world):
+    response, queries = get("/users/me/mentions", world.bob["headers"])
+    assert len(response.json()) >= len(world.message_ids)
+    assert queries == 3
+
+def test_audit_logs(get, world):
+    response, queries = get(f"/servers/{world.server_id}/audit-logs/", world.alice["headers"])
+    assert response.json()
+    assert queries == 3
+
+def test_login_history(get, world):
+    response, queries = get("/users/me/login-history/", world.alice["headers"])
+    assert queries == 2
+
+def test_media(get, world):
+    response, queries = get(f"/channels/{world.channel_id}/media/", world.alice["headers"])
+    assert queries == 3
+
+def test_games(get, world):
+    response, queries = get(f"/channels/{world.channel_id}/games/", world.alice["headers"])
+    assert queries == 3
+
+def test_sync(get, world, thread):
+    response, queries = get("/sync?since=0", world.bob["headers"])
+    assert response.json()["channels"]
+    assert queries == 7
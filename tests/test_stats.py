@@ -0,0 +1,18 @@
+"""
+The /stats endpoints are only open to the users in config.STATS_USERS.
+"""
+import pytest
+
+import config
+
+STATS = ["sql", "message-cache", "permissions", "http-cache", "compression", "maintenance", "realtime"]
+
+@pytest.mark.parametrize("name", STATS)
+def test_forbidden_by_default(client, world, name):
+    assert client.get(f"/stats/{name}", headers=world.bob["headers"]).status_code == 403
+
+@pytest.mark.parametrize("name", STATS)
+def test_allowed_for_stats_users(client, world, monkeypatch, name):
+    monkeypatch.setattr(config, "STATS_USERS", {"alice@example.com"})
+    assert client.get(f"/stats/{name}", headers=world.alice["headers"]).status_code == 200
+    assert client.get(f"/stats/{name}", headers=world.bob["headers"]).status_code == 403